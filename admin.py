@@ -0,0 +1,105 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file deals with
+# maintenance jobs under /admin. These are meant to be triggered by App Engine cron or by an operator
+# holding the ADMIN_TOKEN.
+
+from flask import Blueprint, current_app, request
+from os import environ as env
+import hmac
+import boat_names
+import counters
+import storage
+import responses
+import users
+import versions
+import auth
+import admission
+import jobs
+import sessions
+import list_cache
+
+client = storage.get_backend()
+
+bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+# App Engine strips X-Appengine-Cron from outside requests, so there its presence means the call came from
+# cron. Anywhere else (the memory and sqlite backends run off App Engine) any client could send it, so only
+# the ADMIN_TOKEN is accepted.
+def on_app_engine():
+    return bool(env.get("GAE_ENV") or env.get("GAE_APPLICATION"))
+
+
+def is_authorized(request):
+    if on_app_engine() and request.headers.get('X-Appengine-Cron') == 'true':
+        return True
+    admin_token = env.get("ADMIN_TOKEN")
+    supplied = request.headers.get('X-Admin-Token', '')
+    return bool(admin_token) and hmac.compare_digest(supplied, admin_token)
+
+
+@bp.route('/counters/rebuild', methods=['GET', 'POST'])
+def rebuild_counters():
+    if not is_authorized(request):
+        return (not_authorized(), 403)
+    totals = counters.rebuild(client)
+    # Cached list pages carry the old total_items
+    list_cache.cache.clear()
+    return responses.json_response({"boats": totals[counters.BOATS], "loads": totals[counters.LOADS]})
+
+
+# Reserves the names of boats created before name reservations existed. Boats that share a name with an
+# older boat are listed in "duplicates" so they can be renamed.
+@bp.route('/boat_names/rebuild', methods=['GET', 'POST'])
+def rebuild_boat_names():
+    if not is_authorized(request):
+        return (not_authorized(), 403)
+    return responses.json_response(boat_names.rebuild(client))
+
+
+# Re-keys users created before users were keyed by their Auth0 subject. Safe to run more than once.
+@bp.route('/users/migrate', methods=['POST'])
+def migrate_users():
+    if not is_authorized(request):
+        return (not_authorized(), 403)
+    return responses.json_response(users.migrate_user_keys(client))
+
+
+# Queues the boat delete jobs that have not finished, such as those left behind by a stopped instance
+@bp.route('/jobs/resume', methods=['GET', 'POST'])
+def resume_jobs():
+    if not is_authorized(request):
+        return (not_authorized(), 403)
+    return responses.json_response({"queued": jobs.resume()})
+
+
+# Deletes every session that has expired, one batch at a time. Sessions are also evicted a batch at a time
+# while the login pages are in use, so this is only needed after a quiet spell.
+@bp.route('/sessions/evict', methods=['GET', 'POST'])
+def evict_sessions():
+    if not is_authorized(request):
+        return (not_authorized(), 403)
+    interface = current_app.session_interface
+    if not isinstance(interface, sessions.ServerSessionInterface):
+        return responses.json_response({"evicted": 0})
+    evicted = 0
+    while True:
+        batch = interface.evict()
+        evicted += batch
+        if batch < interface.evict_batch:
+            return responses.json_response({"evicted": evicted})
+
+
+# Hit/miss counters for the caches in front of Auth0 and the storage backend, and for the list page cache
+@bp.route('/stats', methods=['GET'])
+def cache_stats():
+    if not is_authorized(request):
+        return (not_authorized(), 403)
+    stats = {"jwks": auth.jwks_store.stats(), "token_cache": auth.payload_cache.stats(),
+             "version_cache": versions.cache.stats(), "admission": admission.stats(), "list_cache": list_cache.cache.stats()}
+    if hasattr(client, "stats"):
+        stats["entity_cache"] = client.stats()
+    return responses.json_response(stats)
+
+
+not_authorized = responses.Error("You are not allowed to run maintenance jobs")
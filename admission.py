@@ -0,0 +1,231 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file decides whether a
+# request to the API blueprints is served or turned away, so that a slow backend makes the instance shed
+# load quickly instead of letting every worker thread pile up behind it. Requests are split into classes:
+#   read   - GET of one entity, such as /boats/<id>
+#   list   - GET of a list, an export or a page of related entities
+#   write  - everything else
+# Each class may have a limited number of requests in flight. Once a class is full, a few more requests may
+# wait a short time for a slot; the rest get a 503 with Retry-After straight away. Before that, each owner
+# (the JWT "sub" of a token verified before, or else the client address) draws from a token bucket. An
+# owner whose bucket is empty is only turned away while its class is at least half full, so one tenant
+# cannot take every slot, but a busy client on a quiet instance is not slowed down. The token is not
+# verified here: that can mean fetching the JWKS, which is exactly the slow work the limits are there to
+# bound, so it is left to the handler, inside its slot. A streamed response such as an export keeps its slot
+# until the body has been sent. In-flight counts, queue depths and rejections are reported at /metrics and
+# /admin/stats. Settings:
+#   ADMISSION_READ_LIMIT, ADMISSION_LIST_LIMIT, ADMISSION_WRITE_LIMIT  - requests in flight (0 means no limit)
+#   ADMISSION_QUEUE_SIZE        - requests that may wait for a slot in each class
+#   ADMISSION_QUEUE_TIMEOUT_MS  - how long they may wait
+#   ADMISSION_OWNER_RATE        - requests per second each owner may make (0 means no limit)
+#   ADMISSION_OWNER_BURST       - requests an owner may make at once before the rate applies
+#   ADMISSION_RETRY_AFTER       - seconds sent in Retry-After when a class is full
+
+import math
+import threading
+import time
+from os import environ as env
+
+from flask import g, request
+
+import auth
+import entity_cache
+import metrics
+import responses
+
+READ = "read"
+LIST = "list"
+WRITE = "write"
+
+DEFAULT_LIMITS = {READ: 32, LIST: 8, WRITE: 16}
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_QUEUE_TIMEOUT_MS = 100
+DEFAULT_OWNER_RATE = 50
+DEFAULT_OWNER_BURST = 100
+DEFAULT_RETRY_AFTER = 1
+OWNER_BUCKETS = 10000
+OWNER_BUCKET_TTL = 600
+
+# Only the API is limited; the login pages, /metrics, /admin and the warmup request always get through
+LIMITED_BLUEPRINTS = ("boats", "loads", "users", "batch", "jobs")
+
+
+class Gate(object):
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    # Returns True once the request holds a slot, or False if it should be turned away
+    def acquire(self):
+        with self.condition:
+            if self.limit <= 0 or (self.in_flight < self.limit and self.waiting == 0):
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def contended(self):
+        return self.limit > 0 and (self.in_flight * 2 >= self.limit or self.waiting > 0)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def stats(self):
+        return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting,
+                "queue_size": self.queue_size, "admitted": self.admitted, "rejected": self.rejected,
+                "timed_out": self.timed_out}
+
+
+class TokenBuckets(object):
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = entity_cache.LRUCache(OWNER_BUCKETS, OWNER_BUCKET_TTL)
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    # Returns 0 if the owner may go ahead, or else the number of seconds until it may. When enforce is False
+    # the owner always goes ahead, but an empty bucket stays empty.
+    def take(self, owner, enforce=True):
+        if self.rate <= 0:
+            return 0
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.get(owner)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens < 1:
+                self.buckets.set(owner, (tokens, now))
+                if not enforce:
+                    return 0
+                self.rejected += 1
+                return (1 - tokens) / self.rate
+            self.buckets.set(owner, (tokens - 1, now))
+            return 0
+
+    def stats(self):
+        return {"rate": self.rate, "burst": self.burst, "owners": len(self.buckets.entries),
+                "rejected": self.rejected}
+
+
+queue_size = int(env.get("ADMISSION_QUEUE_SIZE", str(DEFAULT_QUEUE_SIZE)))
+queue_timeout = float(env.get("ADMISSION_QUEUE_TIMEOUT_MS", str(DEFAULT_QUEUE_TIMEOUT_MS))) / 1000.0
+gates = {name: Gate(int(env.get("ADMISSION_" + name.upper() + "_LIMIT", str(limit))), queue_size, queue_timeout)
+         for name, limit in DEFAULT_LIMITS.items()}
+owners = TokenBuckets(float(env.get("ADMISSION_OWNER_RATE", str(DEFAULT_OWNER_RATE))),
+                      float(env.get("ADMISSION_OWNER_BURST", str(DEFAULT_OWNER_BURST))))
+retry_after = int(env.get("ADMISSION_RETRY_AFTER", str(DEFAULT_RETRY_AFTER)))
+
+
+def route_class(request):
+    if request.method in ("GET", "HEAD"):
+        rule = request.url_rule.rule
+        if rule.endswith(">") and not rule.endswith("/export"):
+            return READ
+        return LIST
+    return WRITE
+
+
+# Only a token found in the payload cache, which holds verified tokens alone, is trusted for its "sub". Any
+# other request counts against its client address: a claim read from an unverified token is chosen by the
+# client, so a fresh one on every request would never run out. The handler verifies the token itself.
+def owner_of(request):
+    auth_header = request.headers.get('Authorization', '').split()
+    if len(auth_header) == 2:
+        payload = auth.payload_cache.peek(auth_header[1])
+        if payload is not None and "sub" in payload:
+            return payload["sub"]
+    return "address:" + str(request.remote_addr)
+
+
+def busy_response(error, seconds):
+    response = error()
+    response.status_code = 503
+    response.headers.set('Retry-After', str(max(1, int(math.ceil(seconds)))))
+    return response
+
+
+def admit():
+    if request.blueprint not in LIMITED_BLUEPRINTS or request.url_rule is None:
+        return None
+    gate = gates[route_class(request)]
+    wait = owners.take(owner_of(request), gate.contended())
+    if wait > 0:
+        return busy_response(owner_rate_exceeded, wait)
+    if not gate.acquire():
+        return busy_response(server_busy, retry_after)
+    g.admission_gate = gate
+    return None
+
+
+# The request context, and with it teardown_request, ends as soon as the response is returned, before a
+# streamed body is read. Such a response gives its slot back when it is closed instead.
+def hold_while_streaming(response):
+    if response.is_streamed:
+        gate = g.pop("admission_gate", None)
+        if gate is not None:
+            response.call_on_close(gate.release)
+    return response
+
+
+def release(exc=None):
+    gate = g.pop("admission_gate", None)
+    if gate is not None:
+        gate.release()
+
+
+def stats():
+    return {"classes": {name: gate.stats() for name, gate in gates.items()}, "owners": owners.stats()}
+
+
+def install(app):
+    app.before_request(admit)
+    app.after_request(hold_while_streaming)
+    app.teardown_request(release)
+
+
+metrics.registry.add(metrics.Gauge(
+    "admission_in_flight", "Requests being served in each class.", ("class",),
+    lambda: {(name,): gate.in_flight for name, gate in gates.items()}))
+metrics.registry.add(metrics.Gauge(
+    "admission_queue_depth", "Requests waiting for a slot in each class.", ("class",),
+    lambda: {(name,): gate.waiting for name, gate in gates.items()}))
+metrics.registry.add(metrics.Gauge(
+    "admission_limit", "Requests allowed in flight in each class.", ("class",),
+    lambda: {(name,): gate.limit for name, gate in gates.items()}))
+metrics.registry.add(metrics.Gauge(
+    "admission_rejected_total", "Requests turned away, by class and reason.", ("class", "reason"),
+    lambda: dict([((name, "queue_full"), gate.rejected) for name, gate in gates.items()] +
+                 [((name, "queue_timeout"), gate.timed_out) for name, gate in gates.items()] +
+                 [(("owner", "rate"), owners.rejected)]), kind="counter"))
+
+server_busy = responses.Error("The server is busy, try again shortly")
+owner_rate_exceeded = responses.Error("Too many requests for this user, try again shortly")
@@ -0,0 +1,149 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file is the ASGI
+# entry point. The Flask app stays a WSGI app; each request is handed to a bounded pool of threads, so an
+# event-loop server such as uvicorn can hold many slow connections open while only ASGI_THREADS requests
+# are doing work at once. Requests beyond that wait in the pool's queue instead of starting new threads.
+#
+# Run it with:
+#   uvicorn asgi:application --host 0.0.0.0 --port 8080
+# Settings:
+#   ASGI_THREADS  - requests served at the same time
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os import environ as env
+
+from main import app
+
+DEFAULT_THREADS = 32
+
+executor = ThreadPoolExecutor(max_workers=int(env.get("ASGI_THREADS", str(DEFAULT_THREADS))),
+                              thread_name_prefix="asgi")
+
+
+class WSGIResponse(object):
+    def __init__(self):
+        self.status = None
+        self.headers = []
+        self.written = []
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = int(status.split(" ", 1)[0])
+        self.headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        return self.write
+
+    # The write() callable of PEP 3333, for apps that write some of the body before returning the iterable.
+    # What is written is kept and sent ahead of the iterable's chunks.
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def content_length(self):
+        return any(name == b"content-length" for name, _ in self.headers)
+
+
+def build_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        # The whole body has been read already, so a chunked request can be read without a Content-Length
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope["headers"]:
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+            continue
+        name = "HTTP_" + name
+        # Repeated headers are joined the way a WSGI server would
+        environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+# Runs the WSGI app up to its first chunk. A response with a Content-Length is read to the end in the same
+# thread, since it is already in memory; a streamed one (such as an export) is read one chunk at a time.
+# Anything passed to write() comes first in both cases.
+def start(environ):
+    response = WSGIResponse()
+    result = app.wsgi_app(environ, response.start_response)
+    if response.content_length():
+        try:
+            return response, b"".join(response.written + list(result)), None
+        finally:
+            close(result)
+    return response, None, result
+
+
+def close(result):
+    if hasattr(result, "close"):
+        result.close()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        raise RuntimeError("Unsupported ASGI scope " + scope["type"])
+    body = await read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    response, body, result = await loop.run_in_executor(executor, start, build_environ(scope, body))
+    await send({"type": "http.response.start", "status": response.status, "headers": response.headers})
+    if body is not None:
+        await send({"type": "http.response.body", "body": body})
+        return
+    stream = iter(result)
+    try:
+        for chunk in response.written:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        while True:
+            chunk = await loop.run_in_executor(executor, next, stream, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await loop.run_in_executor(executor, close, result)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,142 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file verifies the
+# Auth0 JWTs sent to the protected endpoints. It has no Flask app of its own, so the blueprints can import
+# it without importing main.
+
+import time
+
+from flask import g
+from jose import jwt
+
+import fanout
+import jwks
+import metrics
+import token_cache
+
+# Update the values of the following 3 variables
+CLIENT_ID = '0UqR7wkDo4ZJpEnvPZFZUyR6ubrplQcG'
+CLIENT_SECRET = 'wwTvRRm_n-S1NkT-eO68RlwtJ40QWysoYUdF1mO-MCtFWYR-LFzmLNyYaNvOrGgZ'
+DOMAIN = 'cs493-singmanb-wk7.us.auth0.com'
+# For example
+# DOMAIN = 'fall21.us.auth0.com'
+
+ALGORITHMS = ["RS256"]
+
+jwks_store = jwks.KeyStore("https://" + DOMAIN + "/.well-known/jwks.json")
+payload_cache = token_cache.PayloadCache()
+
+# This code is adapted from https://auth0.com/docs/quickstart/backend/python/01-authorization?_ga=2.46956069.349333901.1589042886-466012638.1589042885#create-the-jwt-validation-decorator
+
+class AuthError(Exception):
+    def __init__(self, error, status_code):
+        self.error = error
+        self.status_code = status_code
+
+
+# Verify the JWT in the request's Authorization header. The payload is kept on the request context so
+# handlers can call this more than once without verifying the token again.
+def verify_jwt(request):
+    payload = g.get("jwt_payload")
+    if payload is not None:
+        return payload
+    started = time.perf_counter()
+    try:
+        pending = g.pop("jwt_pending", None)
+        if pending is not None:
+            payload = pending.result()
+            g.jwt_payload = payload
+            return payload
+        if 'Authorization' in request.headers:
+            auth_header = request.headers['Authorization'].split()
+            token = auth_header[1]
+        else:
+            raise AuthError({"code": "no auth header",
+                             "description":
+                                 "Authorization header is missing"}, 401)
+        payload = verify_token(token)
+        g.jwt_payload = payload
+        return payload
+    finally:
+        metrics.record_jwt_wait(time.perf_counter() - started)
+
+
+# Starts verifying the request's token on the fan-out pool, so a handler can read from storage in the
+# meantime. The next verify_jwt call waits for the result, including any AuthError. Tokens that are
+# already in the payload cache are used straight away, since handing them to another thread would cost
+# more than the lookup.
+def prefetch_jwt(request):
+    if g.get("jwt_payload") is not None or g.get("jwt_pending") is not None:
+        return
+    auth_header = request.headers.get('Authorization', '').split()
+    if len(auth_header) != 2:
+        return
+    payload = payload_cache.get(auth_header[1])
+    if payload is not None:
+        g.jwt_payload = payload
+    else:
+        g.jwt_pending = fanout.submit(verify_token, auth_header[1])
+
+
+# Verify a bearer token, skipping the signature check for tokens that were verified before and have not expired
+def verify_token(token):
+    started = time.perf_counter()
+    payload = payload_cache.get(token)
+    if payload is not None:
+        metrics.record_jwt("cached", started)
+        return payload
+    try:
+        payload = check_token(token)
+    except AuthError:
+        metrics.record_jwt("failed", started)
+        raise
+    metrics.record_jwt("verified", started)
+    return payload
+
+
+def check_token(token):
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Invalid header. "
+                             "Use an RS256 signed JWT Access Token"}, 401)
+    if unverified_header["alg"] == "HS256":
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Invalid header. "
+                             "Use an RS256 signed JWT Access Token"}, 401)
+    try:
+        rsa_key = jwks_store.get_key(unverified_header.get("kid"))
+    except jwks.JWKSUnavailable:
+        raise AuthError({"code": "jwks_unavailable",
+                         "description":
+                             "Unable to fetch the signing keys"}, 503)
+    if rsa_key:
+        try:
+            payload = jwt.decode(
+                token,
+                rsa_key,
+                algorithms=ALGORITHMS,
+                audience=CLIENT_ID,
+                issuer="https://" + DOMAIN + "/"
+            )
+        except jwt.ExpiredSignatureError:
+            raise AuthError({"code": "token_expired",
+                             "description": "token is expired"}, 401)
+        except jwt.JWTClaimsError:
+            raise AuthError({"code": "invalid_claims",
+                             "description":
+                                 "incorrect claims,"
+                                 " please check the audience and issuer"}, 401)
+        except Exception:
+            raise AuthError({"code": "invalid_header",
+                             "description":
+                                 "Unable to parse authentication"
+                                 " token."}, 401)
+        payload_cache.put(token, payload)
+        return payload
+    else:
+        raise AuthError({"code": "no_rsa_key",
+                         "description":
+                             "No RSA key in JWKS"}, 401)
@@ -0,0 +1,422 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file deals with
+# the batch endpoints /loads:batch, /boats:batch and /boats/<boat_id>/loads. Each request carries a JSON
+# array of up to MAX_BATCH_SIZE items, which are checked with the same rules as the single-item endpoints
+# and written with put_multi/delete_multi in chunks. The response reports the outcome of every item.
+
+from flask import Blueprint, request
+import constants
+import counters
+import storage
+import responses
+import versions
+import boat_names
+import boats
+import loads
+import auth
+import list_cache
+import jobs
+
+client = storage.get_backend()
+
+bp = Blueprint('batch', __name__)
+
+MAX_BATCH_SIZE = 500
+# Keeps every transaction well below Datastore's 500 mutations per commit, leaving room for the
+# counter shards and the boats that are rewritten along with their loads
+CHUNK_SIZE = 250
+
+
+@bp.route('/loads:batch', methods=['POST','PATCH','DELETE'])
+def loads_batch():
+    if 'application/json' not in request.accept_mimetypes:
+        return (loads.json_not_accepted_in_request(), 406)
+    items = request.get_json(silent=True)
+    if not is_valid_batch(items):
+        return (invalid_batch(), 400)
+    if request.method == 'POST':
+        results = create_loads(items)
+    elif request.method == 'PATCH':
+        results = update_loads(items)
+    else:
+        results = delete_loads(items)
+    return responses.json_response({"results": results})
+
+
+@bp.route('/boats:batch', methods=['POST','PATCH','DELETE'])
+def boats_batch():
+    if 'application/json' not in request.accept_mimetypes:
+        return (boats.json_not_accepted_in_request(), 406)
+    payload = auth.verify_jwt(request)
+    owner = payload["sub"]
+    items = request.get_json(silent=True)
+    if not is_valid_batch(items):
+        return (invalid_batch(), 400)
+    if request.method == 'POST':
+        results = create_boats(items, owner)
+    elif request.method == 'PATCH':
+        results = update_boats(items, owner)
+    else:
+        results = delete_boats(items, owner)
+    return responses.json_response({"results": results})
+
+
+# Assigns every load id in the body to the boat in a single transaction
+@bp.route('/boats/<boat_id>/loads', methods=['POST'])
+def boats_assign_loads(boat_id):
+    if 'application/json' not in request.accept_mimetypes:
+        return (boats.json_not_accepted_in_request(), 406)
+    payload = auth.verify_jwt(request)
+    owner = payload["sub"]
+    items = request.get_json(silent=True)
+    if not is_valid_batch(items, MAX_BATCH_SIZE - 1):
+        return (invalid_batch(), 400)
+    boat_key = client.key(constants.boats, int(boat_id))
+    results, load_keys = parse_ids(items, constants.loads)
+
+    def assign_loads():
+        entities = client.get_multi([boat_key] + list(load_keys.values()))
+        found = {entity.key: entity for entity in entities}
+        boat = found.get(boat_key)
+        if boat is None:
+            return (boats.load_or_boat_does_not_exist(), 404)
+        if boat["owner"] != owner:
+            return (boats.wrong_owner_for_relationship(), 403)
+        assigned = []
+        carriers = boats.existing_carriers([found[load_key] for load_key in load_keys.values()
+                                            if load_key in found])
+        for index, load_key in load_keys.items():
+            load = found.get(load_key)
+            if load is None:
+                results[index] = item_error(boats.load_or_boat_does_not_exist(), 404)
+            elif load["carrier"] is not None and load["carrier"]["id"] in carriers:
+                results[index] = item_error(boats.existing_boat_error(), 403)
+            else:
+                load.update({"carrier": {"id": boat.key.id, "name": boat["name"]}})
+                boat["loads"].append({"id": load.key.id})
+                versions.bump(load)
+                assigned.append(load)
+                results[index] = item_result(load.key, 204)
+        if len(assigned) != 0:
+            versions.bump(boat)
+            client.put_multi(assigned + [boat])
+        return responses.json_response({"results": results})
+    result = client.run_in_transaction(assign_loads)
+    list_cache.written([owner], loads=True)
+    return result
+
+
+def create_loads(items):
+    results = [None] * len(items)
+    pending = []
+    for index, content in enumerate(items):
+        error = loads.new_load_error(content)
+        if error is not None:
+            results[index] = item_error(error, 400)
+            continue
+        new_load = client.entity(client.key(constants.loads))
+        new_load.update({"volume": content["volume"], "item": content["item"],
+                         "creation_date": content["creation_date"], "carrier": None})
+        pending.append((index, new_load))
+    for chunk in chunks(pending):
+        new_loads = [new_load for _, new_load in chunk]
+
+        def create_chunk():
+            for new_load in new_loads:
+                versions.created(new_load)
+            client.put_multi(new_loads)
+            counters.increment(client, counters.LOADS, len(new_loads))
+        client.run_in_transaction(create_chunk)
+        list_cache.written(loads=True)
+        for index, new_load in chunk:
+            results[index] = item_result(new_load.key, 201)
+    return results
+
+
+def update_loads(items):
+    results, keys, patches = parse_patches(items, constants.loads, loads.load_patch_error)
+    for chunk in chunks(list(keys.items())):
+
+        def update_chunk():
+            found = {load.key: load for load in client.get_multi([key for _, key in chunk])}
+            changed = []
+            for index, key in chunk:
+                load = found.get(key)
+                if load is None:
+                    results[index] = item_error(loads.missing_load_id(), 404)
+                    continue
+                loads.apply_load_patch(load, patches[index])
+                versions.bump(load)
+                changed.append(load)
+                results[index] = item_result(key, 204)
+            if len(changed) != 0:
+                client.put_multi(changed)
+        client.run_in_transaction(update_chunk)
+        list_cache.written(loads=True)
+    return results
+
+
+# Loads that are on a boat are removed from that boat in the same transaction that deletes them
+def delete_loads(items):
+    results, keys = parse_ids(items, constants.loads)
+    for chunk in chunks(list(keys.items())):
+        carrier_owners = set()
+
+        def delete_chunk():
+            found = {load.key: load for load in client.get_multi([key for _, key in chunk])}
+            boat_keys = set()
+            deleted_ids = set()
+            for index, key in chunk:
+                load = found.get(key)
+                if load is None:
+                    results[index] = item_error(loads.missing_load_id(), 404)
+                    continue
+                if load["carrier"] is not None:
+                    boat_keys.add(client.key(constants.boats, int(load["carrier"]["id"])))
+                deleted_ids.add(key.id)
+                results[index] = item_result(key, 204)
+            if len(boat_keys) != 0:
+                carriers = client.get_multi(list(boat_keys))
+                for boat in carriers:
+                    boat["loads"] = [item for item in boat["loads"] if item["id"] not in deleted_ids]
+                    versions.bump(boat)
+                    carrier_owners.add(boat["owner"])
+                if len(carriers) != 0:
+                    client.put_multi(carriers)
+            if len(deleted_ids) != 0:
+                deleted_keys = [client.key(constants.loads, load_id) for load_id in deleted_ids]
+                client.delete_multi(deleted_keys)
+                for key in deleted_keys:
+                    versions.deleted(key)
+                counters.increment(client, counters.LOADS, -len(deleted_ids))
+        client.run_in_transaction(delete_chunk)
+        list_cache.written(carrier_owners, loads=True)
+    return results
+
+
+# Names are reserved in the same transaction as the boats, so ids are allocated before the chunks run
+def create_boats(items, owner):
+    results = [None] * len(items)
+    valid = []
+    claimed_names = set()
+    for index, content in enumerate(items):
+        error = boats.new_boat_error(content)
+        if error is not None:
+            results[index] = item_error(error, 400)
+            continue
+        name_key = boat_names.reservation_key(client, content["name"])
+        if name_key in claimed_names:
+            results[index] = item_error(boats.boat_name_already_exists(), 403)
+            continue
+        claimed_names.add(name_key)
+        valid.append((index, content))
+    pending = []
+    for (index, content), key in zip(valid, client.allocate_keys(constants.boats, len(valid))):
+        new_boat = client.entity(key)
+        new_boat.update({"name": content["name"], "type": content["type"],
+                         "length": content["length"], "loads": [], "owner": owner})
+        pending.append((index, new_boat))
+    # Each boat also writes its name reservation
+    weights = {index: 2 for index, _ in pending}
+    for chunk in chunks(pending, weights):
+
+        def create_chunk():
+            name_keys = [boat_names.reservation_key(client, new_boat["name"]) for _, new_boat in chunk]
+            taken = set(entity.key for entity in client.get_multi(name_keys))
+            created = []
+            for (index, new_boat), name_key in zip(chunk, name_keys):
+                if name_key in taken:
+                    results[index] = item_error(boats.boat_name_already_exists(), 403)
+                    continue
+                created.append((index, new_boat))
+            if len(created) != 0:
+                new_boats = [new_boat for _, new_boat in created]
+                for new_boat in new_boats:
+                    versions.created(new_boat)
+                client.put_multi(new_boats + [boat_names.reservation(client, new_boat["name"], new_boat.key)
+                                              for new_boat in new_boats])
+                counters.increment(client, counters.BOATS, len(new_boats))
+                counters.increment(client, counters.owner_boats(owner), len(new_boats))
+            return created
+        created = client.run_in_transaction(create_chunk)
+        list_cache.written([owner])
+        for index, new_boat in created:
+            results[index] = item_result(new_boat.key, 201)
+    return results
+
+
+def update_boats(items, owner):
+    results, keys, patches = parse_patches(items, constants.boats, boats.boat_patch_error)
+    # Two renames in one batch may not take the same name. Clashes with other boats are caught by the
+    # name reservations inside each chunk's transaction.
+    claimed_names = set()
+    for index in list(keys):
+        name = patches[index].get("name")
+        if name is None:
+            continue
+        name_key = boat_names.reservation_key(client, name)
+        if name_key in claimed_names:
+            results[index] = item_error(boats.boat_name_already_exists(), 403)
+            del keys[index]
+            continue
+        claimed_names.add(name_key)
+    # A rename writes the boat, the new reservation and deletes the old one
+    weights = {index: 3 if "name" in patches[index] else 1 for index in keys}
+    for chunk in chunks(list(keys.items()), weights):
+
+        def update_chunk():
+            found = {boat.key: boat for boat in client.get_multi([key for _, key in chunk])}
+            changed = []
+            for index, key in chunk:
+                boat = found.get(key)
+                content = patches[index]
+                if boat is None:
+                    results[index] = item_error(boats.missing_boat_id(), 404)
+                    continue
+                if boat["owner"] != owner:
+                    results[index] = item_error(boats.wrong_owner_for_relationship(), 403)
+                    continue
+                if "name" in content and content["name"] != boat["name"]:
+                    if not boat_names.rename(client, boat["name"], content["name"], key):
+                        results[index] = item_error(boats.boat_name_already_exists(), 403)
+                        continue
+                boats.apply_boat_patch(boat, content)
+                versions.bump(boat)
+                changed.append(boat)
+                results[index] = item_result(key, 204)
+            if len(changed) != 0:
+                client.put_multi(changed)
+        client.run_in_transaction(update_chunk)
+        list_cache.written([owner])
+    return results
+
+
+# The loads of every deleted boat are unassigned in the same transaction as the delete, except on boats
+# with more than jobs.INLINE_UNASSIGN_LIMIT loads, which are handed to a job (the item's status is 202)
+def delete_boats(items, owner):
+    results, keys = parse_ids(items, constants.boats)
+    found = {boat.key: boat for boat in client.get_multi(list(keys.values()))} if len(keys) != 0 else {}
+    weights = {index: 1 if key not in found else 3 if len(found[key]["loads"]) > jobs.INLINE_UNASSIGN_LIMIT
+               else 2 + len(found[key]["loads"]) for index, key in keys.items()}
+    for chunk in chunks(list(keys.items()), weights):
+        job_keys = []
+
+        def delete_chunk():
+            del job_keys[:]
+            current = {boat.key: boat for boat in client.get_multi([key for _, key in chunk])}
+            deleted = []
+            deleted_boats = []
+            load_keys = []
+            for index, key in chunk:
+                boat = current.get(key)
+                if boat is None:
+                    results[index] = item_error(boats.missing_boat_id(), 404)
+                    continue
+                if boat["owner"] != owner:
+                    results[index] = item_error(boats.wrong_owner(), 403)
+                    continue
+                deleted.append(key)
+                deleted_boats.append(boat)
+                if len(boat["loads"]) > jobs.INLINE_UNASSIGN_LIMIT:
+                    job_key = client.allocate_keys(constants.jobs, 1)[0]
+                    jobs.new_unassign_job(job_key, boat, owner)
+                    job_keys.append(job_key)
+                    results[index] = dict(item_result(key, 202), job=item_result(job_key, jobs.QUEUED))
+                    continue
+                load_keys.extend(client.key(constants.loads, int(each["id"])) for each in boat["loads"])
+                results[index] = item_result(key, 204)
+            deleted_ids = set(key.id for key in deleted)
+            if len(load_keys) != 0:
+                loads_on_boats = [load for load in client.get_multi(load_keys)
+                                  if load["carrier"] is not None and load["carrier"]["id"] in deleted_ids]
+                for load in loads_on_boats:
+                    load.update({"carrier": None})
+                    versions.bump(load)
+                if len(loads_on_boats) != 0:
+                    client.put_multi(loads_on_boats)
+            if len(deleted) != 0:
+                boat_names.release(client, deleted_boats)
+                client.delete_multi(deleted)
+                for key in deleted:
+                    versions.deleted(key)
+                counters.increment(client, counters.BOATS, -len(deleted))
+                counters.increment(client, counters.owner_boats(owner), -len(deleted))
+        client.run_in_transaction(delete_chunk)
+        list_cache.written([owner], loads=True)
+        for job_key in job_keys:
+            jobs.enqueue(job_key.id)
+    return results
+
+
+def is_valid_batch(items, max_size=MAX_BATCH_SIZE):
+    return isinstance(items, list) and 0 < len(items) <= max_size
+
+
+# Turns a list of ids (or {"id": ...} objects) into keys by position. Ids that are not valid or that
+# appear more than once get an error result straight away.
+def parse_ids(items, kind):
+    results = [None] * len(items)
+    keys = {}
+    seen = set()
+    for index, item in enumerate(items):
+        item_id = item.get("id") if isinstance(item, dict) else item
+        try:
+            item_id = int(item_id)
+        except (TypeError, ValueError):
+            results[index] = item_error(invalid_item_id(), 400)
+            continue
+        if item_id in seen:
+            results[index] = item_error(duplicate_item(), 400)
+            continue
+        seen.add(item_id)
+        keys[index] = client.key(kind, item_id)
+    return results, keys
+
+
+# Like parse_ids, but each item is {"id": ..., <attributes to change>} and is validated with the
+# PATCH rules of the single-item endpoint
+def parse_patches(items, kind, patch_error):
+    results, keys = parse_ids(items, kind)
+    patches = {}
+    for index in list(keys):
+        item = items[index]
+        content = {name: value for name, value in item.items() if name != "id"} if isinstance(item, dict) else None
+        error = patch_error(content)
+        if error is not None:
+            results[index] = item_error(error, 400)
+            del keys[index]
+            continue
+        patches[index] = content
+    return results, keys, patches
+
+
+# Splits the work into chunks whose total weight (entities written) stays under CHUNK_SIZE
+def chunks(pending, weights=None):
+    chunk = []
+    size = 0
+    for entry in pending:
+        weight = weights.get(entry[0], 1) if weights else 1
+        if len(chunk) != 0 and size + weight > CHUNK_SIZE:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(entry)
+        size += weight
+    if len(chunk) != 0:
+        yield chunk
+
+
+def item_result(key, status):
+    return {"status": status, "id": key.id, "self": responses.link(key.kind, key.id)}
+
+
+def item_error(error, status):
+    result = {"status": status}
+    result.update(error.payload)
+    return result
+
+
+invalid_batch = responses.Error("The request body must be a JSON array of between 1 and " + str(MAX_BATCH_SIZE) +
+                                " items")
+invalid_item_id = responses.Error("The item does not have a valid id")
+duplicate_item = responses.Error("The same id appears more than once in the batch")
@@ -0,0 +1,178 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file compares the
+# ASGI entry point with plain WSGI under many concurrent connections and a slow storage backend. The WSGI
+# side gives every connection its own thread, the way a threaded WSGI server does; the ASGI side keeps every
+# connection as a coroutine on one event loop and lets asgi.py hand the work to its bounded pool. Both run
+# the same read-heavy mix (GET /boats/<id>, GET /loads/<id>, GET /boats, GET /loads) and the results are
+# printed as JSON with requests per second, p50/p95/p99 latency and the peak number of threads.
+#
+# Usage, from the repository root:
+#   python -m benchmarks.asgi_vs_wsgi --connections 256 --duration 10 --rpc-latency-ms 5 --asgi-threads 32
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ROUTES = ("GET /boats/<id>", "GET /loads/<id>", "GET /boats", "GET /loads")
+
+
+def pick_request(chooser, boat_ids, load_ids):
+    route = chooser.choice(ROUTES)
+    if route == "GET /boats/<id>":
+        return route, "/boats/" + str(chooser.choice(boat_ids))
+    if route == "GET /loads/<id>":
+        return route, "/loads/" + str(chooser.choice(load_ids))
+    return route, route[4:]
+
+
+def http_scope(path, headers):
+    return {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": path, "raw_path": path.encode("ascii"), "query_string": b"",
+            "root_path": "", "headers": headers, "client": ("127.0.0.1", 50000),
+            "server": ("localhost", 8080)}
+
+
+class ThreadCounter(object):
+    def __init__(self):
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+
+    def watch(self):
+        while not self.stopped.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+async def asgi_connection(application, recorder, headers, boat_ids, load_ids, deadline, chooser):
+    while time.perf_counter() < deadline:
+        route, path = pick_request(chooser, boat_ids, load_ids)
+        status = []
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                await asyncio.sleep(3600)
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+
+        started = time.perf_counter()
+        await application(http_scope(path, headers), receive, send)
+        recorder.record(route, time.perf_counter() - started, status[0])
+
+
+def run_asgi(options, recorder, token, boat_ids, load_ids):
+    import asgi
+    headers = [(b"authorization", b"Bearer " + token.encode("ascii")), (b"accept", b"application/json")]
+
+    async def clients():
+        deadline = time.perf_counter() + options.duration
+        await asyncio.gather(*[asgi_connection(asgi.application, recorder, headers, boat_ids, load_ids,
+                                               deadline, random.Random(index))
+                               for index in range(options.connections)])
+    asyncio.run(clients())
+
+
+def wsgi_connection(app, recorder, token, boat_ids, load_ids, deadline, chooser):
+    client = app.test_client()
+    headers = {"Authorization": "Bearer " + token, "Accept": "application/json"}
+    while time.perf_counter() < deadline:
+        route, path = pick_request(chooser, boat_ids, load_ids)
+        started = time.perf_counter()
+        response = client.get(path, headers=headers)
+        recorder.record(route, time.perf_counter() - started, response.status_code)
+
+
+def run_wsgi(options, recorder, token, boat_ids, load_ids):
+    import main
+    deadline = time.perf_counter() + options.duration
+    threads = [threading.Thread(target=wsgi_connection, args=(main.app, recorder, token, boat_ids, load_ids,
+                                                              deadline, random.Random(index)))
+               for index in range(options.connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the ASGI entry point with thread-per-connection WSGI")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run each server model for")
+    parser.add_argument("--connections", type=int, default=256, help="concurrent client connections")
+    parser.add_argument("--asgi-threads", type=int, default=32, help="size of the ASGI worker pool")
+    parser.add_argument("--boats", type=int, default=50, help="boats seeded for the owner")
+    parser.add_argument("--loads-per-boat", type=int, default=5, help="loads seeded on every boat")
+    parser.add_argument("--rpc-latency-ms", type=float, default=5.0,
+                        help="delay added to every storage call to mimic a network round trip")
+    parser.add_argument("--only", choices=("asgi", "wsgi"), help="run just one of the server models")
+    return parser.parse_args(argv)
+
+
+def run(options):
+    os.environ["STORAGE_BACKEND"] = "memory"
+    os.environ["ASGI_THREADS"] = str(options.asgi_threads)
+    from benchmarks.load_test import ADMISSION_SETTINGS
+    for name in ADMISSION_SETTINGS:
+        os.environ.setdefault(name, "0")
+    sys.path.insert(0, ROOT)
+    import entity_cache
+    import metrics
+    import storage
+    raw_backend = storage.BACKENDS["memory"]()
+    from benchmarks.load_test import LatencyBackend, Recorder, seed, git_revision
+    storage.backend = entity_cache.from_environment(
+        metrics.MetricsBackend(LatencyBackend(raw_backend, options.rpc_latency_ms / 1000.0)))
+    import main
+    from benchmarks.local_auth import LocalIssuer
+
+    issuer = LocalIssuer(main.DOMAIN, main.CLIENT_ID)
+    issuer.install(main)
+    owner = "auth0|bench-owner"
+    boats_by_owner, load_ids = seed(raw_backend, [owner], options.boats, options.loads_per_boat, 0)
+    token = issuer.token(owner)
+
+    models = {"asgi": run_asgi, "wsgi": run_wsgi}
+    results = {}
+    for name in sorted(models):
+        if options.only and options.only != name:
+            continue
+        recorder = Recorder()
+        started = time.perf_counter()
+        with ThreadCounter() as threads:
+            models[name](options, recorder, token, boats_by_owner[owner], load_ids)
+        routes, total = recorder.summary(time.perf_counter() - started)
+        total["peak_threads"] = threads.peak
+        results[name] = {"total": total, "routes": routes}
+    return {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "config": vars(options),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    print(json.dumps(run(main_args(argv)), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
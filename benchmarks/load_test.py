@@ -0,0 +1,359 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file is an offline
+# load test for every route. It replays a weighted mix of the scenarios in singmanb_project.postman_collection.json
+# (boat CRUD, load CRUD, load assignment, paginated listing and cascade deletes) against the app in-process,
+# with a local Auth0 stand-in and a local storage backend, and reports p50/p95/p99 latency and requests per
+# second for each route as JSON that can be diffed between commits.
+#
+# Usage, from the repository root:
+#   python -m benchmarks.load_test --duration 10 --concurrency 8 --boats 200 --loads-per-boat 5
+#   python -m benchmarks.load_test --output after.json --baseline before.json
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ADMISSION_SETTINGS = ("ADMISSION_READ_LIMIT", "ADMISSION_LIST_LIMIT", "ADMISSION_WRITE_LIMIT", "ADMISSION_OWNER_RATE")
+
+DEFAULT_WEIGHTS = {
+    "get_boat": 30,
+    "get_load": 30,
+    "list_boats": 20,
+    "list_loads": 10,
+    "boat_crud": 3,
+    "load_crud": 3,
+    "assign_load": 3,
+    "cascade_delete": 1,
+}
+
+
+# Adds a fixed delay to every storage call, to stand in for the Datastore round trip
+class LatencyBackend(object):
+    CALLS = ("get", "get_multi", "put", "put_multi", "delete", "delete_multi", "query")
+
+    def __init__(self, backend, latency):
+        self.backend = backend
+        self.latency = latency
+
+    def __getattr__(self, name):
+        attribute = getattr(self.backend, name)
+        if name not in self.CALLS or self.latency <= 0:
+            return attribute
+
+        def delayed(*args, **kwargs):
+            time.sleep(self.latency)
+            return attribute(*args, **kwargs)
+        return delayed
+
+    def iterate(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return self.backend.iterate(*args, **kwargs)
+
+    def run_in_transaction(self, work, retries=3):
+        def delayed():
+            result = work()
+            time.sleep(self.latency)
+            return result
+        return self.backend.run_in_transaction(delayed, retries)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, route, seconds, status):
+        with self.lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if status >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, elapsed):
+        routes = {}
+        every_sample = []
+        for route, samples in sorted(self.samples.items()):
+            every_sample.extend(samples)
+            routes[route] = summarize(samples, elapsed, self.errors.get(route, 0))
+        return routes, summarize(every_sample, elapsed, sum(self.errors.values()))
+
+
+def summarize(samples, elapsed, errors):
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "errors": errors,
+        "rps": round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 3) if ordered else 0.0,
+        "p50_ms": round(1000 * percentile(ordered, 0.50), 3),
+        "p95_ms": round(1000 * percentile(ordered, 0.95), 3),
+        "p99_ms": round(1000 * percentile(ordered, 0.99), 3),
+    }
+
+
+# Creates boats and loads straight through the storage layer, then rebuilds the counters and the
+# boat name reservations
+def seed(client, owners, boats_per_owner, loads_per_boat, unassigned_loads):
+    import boat_names
+    import constants
+    import counters
+    boats_by_owner = {}
+    load_ids = []
+    for owner in owners:
+        for _ in range(boats_per_owner):
+            boat = client.entity(client.key(constants.boats))
+            boat.update({"name": "seed-" + uuid.uuid4().hex, "type": "Yacht", "length": 99, "loads": [],
+                         "owner": owner})
+            client.put(boat)
+            new_loads = []
+            for _ in range(loads_per_boat):
+                load = client.entity(client.key(constants.loads))
+                load.update({"volume": 5, "item": "LEGO Blocks", "creation_date": "1/1/2022",
+                             "carrier": {"id": boat.key.id, "name": boat["name"]}})
+                new_loads.append(load)
+            client.put_multi(new_loads)
+            boat["loads"] = [{"id": load.key.id} for load in new_loads]
+            client.put(boat)
+            boats_by_owner.setdefault(owner, []).append(boat.key.id)
+            load_ids.extend(load.key.id for load in new_loads)
+    for _ in range(unassigned_loads):
+        load = client.entity(client.key(constants.loads))
+        load.update({"volume": 5, "item": "LEGO Blocks", "creation_date": "1/1/2022", "carrier": None})
+        client.put(load)
+        load_ids.append(load.key.id)
+    counters.rebuild(client)
+    boat_names.rebuild(client)
+    return boats_by_owner, load_ids
+
+
+class Worker(object):
+    def __init__(self, app, recorder, token, boat_ids, load_ids, options):
+        self.client = app.test_client()
+        self.recorder = recorder
+        self.headers = {"Authorization": "Bearer " + token, "Accept": "application/json"}
+        self.boat_ids = boat_ids
+        self.load_ids = load_ids
+        self.options = options
+        self.random = random.Random()
+
+    def call(self, route, method, url, body=None):
+        started = time.perf_counter()
+        response = self.client.open(url, method=method, json=body, headers=self.headers)
+        self.recorder.record(route, time.perf_counter() - started, response.status_code)
+        return response
+
+    def new_boat(self):
+        body = {"name": "bench-" + uuid.uuid4().hex, "type": "Yacht", "length": 99}
+        return self.call("POST /boats", "POST", "/boats", body).get_json()["id"]
+
+    def new_load(self):
+        body = {"volume": 5, "item": "LEGO Blocks", "creation_date": "1/1/2022"}
+        return self.call("POST /loads", "POST", "/loads", body).get_json()["id"]
+
+    def get_boat(self):
+        if self.boat_ids:
+            self.call("GET /boats/<id>", "GET", "/boats/" + str(self.random.choice(self.boat_ids)))
+
+    def get_load(self):
+        if self.load_ids:
+            self.call("GET /loads/<id>", "GET", "/loads/" + str(self.random.choice(self.load_ids)))
+
+    def list_pages(self, route, url):
+        for _ in range(self.options.pages):
+            response = self.call(route, "GET", url)
+            body = json.loads(response.data or b"{}")
+            if not body.get("next"):
+                return
+            url = body["next"]
+
+    def list_boats(self):
+        self.list_pages("GET /boats", "/boats")
+
+    def list_loads(self):
+        self.list_pages("GET /loads", "/loads")
+
+    def boat_crud(self):
+        boat_id = str(self.new_boat())
+        self.call("GET /boats/<id>", "GET", "/boats/" + boat_id)
+        self.call("PATCH /boats/<id>", "PATCH", "/boats/" + boat_id, {"name": "bench-" + uuid.uuid4().hex})
+        self.call("PUT /boats/<id>", "PUT", "/boats/" + boat_id,
+                  {"name": "bench-" + uuid.uuid4().hex, "type": "Sailboat", "length": 42})
+        self.call("DELETE /boats/<id>", "DELETE", "/boats/" + boat_id)
+
+    def load_crud(self):
+        load_id = str(self.new_load())
+        self.call("GET /loads/<id>", "GET", "/loads/" + load_id)
+        self.call("PATCH /loads/<id>", "PATCH", "/loads/" + load_id, {"item": "Lincoln Logs"})
+        self.call("PUT /loads/<id>", "PUT", "/loads/" + load_id,
+                  {"volume": 10, "item": "Lincoln Logs", "creation_date": "2/2/2022"})
+        self.call("DELETE /loads/<id>", "DELETE", "/loads/" + load_id)
+
+    def assign_load(self):
+        if not self.boat_ids:
+            return
+        boat_id = str(self.random.choice(self.boat_ids))
+        load_id = str(self.new_load())
+        self.call("PUT /boats/<id>/loads/<id>", "PUT", "/boats/" + boat_id + "/loads/" + load_id)
+        self.call("DELETE /boats/<id>/loads/<id>", "DELETE", "/boats/" + boat_id + "/loads/" + load_id)
+        self.call("DELETE /loads/<id>", "DELETE", "/loads/" + load_id)
+
+    def cascade_delete(self):
+        boat_id = str(self.new_boat())
+        for _ in range(self.options.loads_per_boat):
+            load_id = str(self.new_load())
+            self.call("PUT /boats/<id>/loads/<id>", "PUT", "/boats/" + boat_id + "/loads/" + load_id)
+        self.call("DELETE /boats/<id> (cascade)", "DELETE", "/boats/" + boat_id)
+
+    def run(self, scenarios, weights, deadline):
+        while time.perf_counter() < deadline:
+            getattr(self, self.random.choices(scenarios, weights)[0])()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def parse_weights(text):
+    weights = dict(DEFAULT_WEIGHTS)
+    if text:
+        for part in text.split(","):
+            name, _, value = part.partition("=")
+            if name not in DEFAULT_WEIGHTS:
+                raise SystemExit("Unknown scenario " + repr(name))
+            weights[name] = int(value)
+    return weights
+
+
+def compare(results, baseline):
+    print("%-34s %12s %12s %12s %12s" % ("route", "p50 ms", "p95 ms", "p99 ms", "rps"))
+    for route, stats in sorted(results["routes"].items()):
+        old = baseline.get("routes", {}).get(route)
+        cells = []
+        for name in ("p50_ms", "p95_ms", "p99_ms", "rps"):
+            if old and old[name]:
+                cells.append("%+11.1f%%" % (100.0 * (stats[name] - old[name]) / old[name]))
+            else:
+                cells.append("%12s" % "n/a")
+        print("%-34s %s" % (route, " ".join(cells)))
+
+
+def main_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the boats and loads API")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run the mix for")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of client threads")
+    parser.add_argument("--owners", type=int, default=4, help="number of distinct JWT subjects")
+    parser.add_argument("--boats", type=int, default=50, help="boats seeded per owner")
+    parser.add_argument("--loads-per-boat", type=int, default=5, help="loads seeded on every boat")
+    parser.add_argument("--unassigned-loads", type=int, default=100, help="extra loads not on any boat")
+    parser.add_argument("--pages", type=int, default=3, help="pages followed by the listing scenarios")
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--sqlite-path", default=":memory:")
+    parser.add_argument("--rpc-latency-ms", type=float, default=0.0,
+                        help="delay added to every storage call to mimic a network round trip")
+    parser.add_argument("--no-token-cache", action="store_true",
+                        help="verify the RS256 signature on every request")
+    parser.add_argument("--weights", help="scenario weights, e.g. get_boat=10,cascade_delete=0")
+    parser.add_argument("--seed", type=int, help="random seed for the workload mix")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--baseline", help="compare against an earlier JSON results file")
+    return parser.parse_args(argv)
+
+
+def run(options):
+    os.environ["STORAGE_BACKEND"] = options.backend
+    os.environ["SQLITE_PATH"] = options.sqlite_path
+    # Admission control stays off unless it is configured, so the results measure the handlers themselves
+    for name in ADMISSION_SETTINGS:
+        os.environ.setdefault(name, "0")
+    sys.path.insert(0, ROOT)
+    import entity_cache
+    import metrics
+    import storage
+    # The delay goes underneath the entity cache, where the network round trip would be
+    raw_backend = storage.BACKENDS[options.backend]()
+    storage.backend = entity_cache.from_environment(
+        metrics.MetricsBackend(LatencyBackend(raw_backend, options.rpc_latency_ms / 1000.0)))
+    import main
+    from benchmarks.local_auth import LocalIssuer
+
+    if options.seed is not None:
+        random.seed(options.seed)
+    issuer = LocalIssuer(main.DOMAIN, main.CLIENT_ID)
+    issuer.install(main)
+    if options.no_token_cache:
+        main.payload_cache.max_size = 0
+    owners = ["auth0|bench-owner-%d" % index for index in range(options.owners)]
+    boats_by_owner, load_ids = seed(raw_backend, owners, options.boats,
+                                    options.loads_per_boat, options.unassigned_loads)
+
+    weights = parse_weights(options.weights)
+    scenarios = sorted(weights)
+    recorder = Recorder()
+    workers = []
+    for index in range(options.concurrency):
+        owner = owners[index % len(owners)]
+        worker = Worker(main.app, recorder, issuer.token(owner), boats_by_owner.get(owner, []), load_ids, options)
+        if options.seed is not None:
+            worker.random.seed(options.seed + index)
+        workers.append(worker)
+
+    started = time.perf_counter()
+    deadline = started + options.duration
+    threads = [threading.Thread(target=worker.run, args=(scenarios, [weights[name] for name in scenarios],
+                                                         deadline)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    routes, total = recorder.summary(elapsed)
+    config = {name: value for name, value in vars(options).items() if name not in ("output", "baseline")}
+    config["weights"] = weights
+    return {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "config": config,
+        "elapsed_s": round(elapsed, 3),
+        "jwks_fetches": issuer.fetches,
+        "total": total,
+        "routes": routes,
+    }
+
+
+def main(argv=None):
+    options = main_args(argv)
+    results = run(options)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file is a local
+# stand-in for Auth0 used by the benchmarks. It signs RS256 tokens with a throwaway key and serves the
+# matching JWKS document to main.verify_jwt, so token verification runs for real without network access.
+
+import time
+import uuid
+
+from jose import jwk, jwt
+
+KEY_ID = "local-benchmark-key"
+
+
+def generate_private_key():
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                 serialization.NoEncryption()).decode("ascii")
+    except ImportError:
+        import rsa
+        _, private_key = rsa.newkeys(2048)
+        return private_key.save_pkcs1().decode("ascii")
+
+
+class LocalIssuer(object):
+    def __init__(self, domain, audience, key_id=KEY_ID):
+        self.domain = domain
+        self.audience = audience
+        self.key_id = key_id
+        self.private_key = generate_private_key()
+        public_key = jwk.construct(self.private_key, "RS256").public_key().to_dict()
+        public_key.update({"kid": key_id, "use": "sig", "alg": "RS256"})
+        self.jwks = {"keys": [public_key]}
+        self.fetches = 0
+
+    # Has the same signature as jwks.fetch_jwks
+    def fetch_jwks(self, url):
+        self.fetches += 1
+        return self.jwks, "public, max-age=600"
+
+    def token(self, subject=None, lifetime=3600):
+        now = int(time.time())
+        claims = {
+            "sub": subject or "auth0|" + uuid.uuid4().hex,
+            "aud": self.audience,
+            "iss": "https://" + self.domain + "/",
+            "iat": now,
+            "exp": now + lifetime,
+        }
+        return jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": self.key_id})
+
+    # Points the app's key store at this issuer
+    def install(self, main):
+        main.jwks_store.fetch = self.fetch_jwks
@@ -0,0 +1,135 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file is a
+# microbenchmark for the response layer. It times building the body of a boats and a loads list page and an
+# error response the way the handlers used to (json.loads on the error string, id/self written into the
+# entities, json.dumps from the standard library) against responses.py, and reports the CPU time per
+# request for both as JSON.
+#
+# Usage, from the repository root:
+#   python -m benchmarks.serialization --page-size 50 --loads-per-boat 5 --repeat 2000
+
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_page(storage, page_size, loads_per_boat):
+    boats = []
+    loads = []
+    for index in range(page_size):
+        boat = storage.Entity(storage.Key("boats", index + 1))
+        boat.update({"name": "boat-%d" % index, "type": "Yacht", "length": 99, "owner": "auth0|bench",
+                     "loads": [{"id": index * loads_per_boat + n + 1} for n in range(loads_per_boat)]})
+        boats.append(boat)
+        load = storage.Entity(storage.Key("loads", index + 1))
+        load.update({"volume": 5, "item": "LEGO Blocks", "creation_date": "1/1/2022",
+                     "carrier": {"id": index + 1, "name": boat["name"]}})
+        loads.append(load)
+    return boats, loads
+
+
+# The list handlers as they were before responses.py. They write into the entities, so each run is handed
+# its own copy of the page, made before the timing starts.
+def legacy_boats_page(request, results):
+    for e in results:
+        e["id"] = e.key.id
+        e["self"] = request.base_url + "/" + str(e["id"])
+        for each_load in e["loads"]:
+            each_load["self"] = request.root_url + "/loads/" + str(each_load["id"])
+    return json.dumps({"boats": results, "total_items": len(results)})
+
+
+def legacy_loads_page(request, results):
+    for e in results:
+        e["id"] = e.key.id
+        e["self"] = request.base_url + "/" + str(e["id"])
+        check_for_carrier = e["carrier"]
+        if check_for_carrier is not None:
+            check_for_carrier["self"] = request.base_url[0:-5] + str(check_for_carrier["id"])
+    return json.dumps({"loads": results, "total_items": len(results)})
+
+
+def legacy_error(flask):
+    error_message_for_missing_id = '{"Error": "No boat with this boat_id exists"}'
+    return flask.jsonify(json.loads(error_message_for_missing_id))
+
+
+def copies(storage, page, count):
+    copied = []
+    for _ in range(count):
+        page_copy = []
+        for entity in page:
+            entity_copy = storage.Entity(entity.key)
+            entity_copy.update(storage.clone(dict(entity)))
+            page_copy.append(entity_copy)
+        copied.append(page_copy)
+    return iter(copied)
+
+
+def time_per_call(work, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        work()
+    return (time.process_time() - started) / repeat
+
+
+def main_args(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmark for list page and error serialization")
+    parser.add_argument("--page-size", type=int, default=50, help="entities on each list page")
+    parser.add_argument("--loads-per-boat", type=int, default=5, help="loads listed on every boat")
+    parser.add_argument("--repeat", type=int, default=2000, help="requests timed for each case")
+    return parser.parse_args(argv)
+
+
+def run(options):
+    os.environ.setdefault("STORAGE_BACKEND", "memory")
+    sys.path.insert(0, ROOT)
+    import flask
+    import storage
+    import main
+    import boats
+    import bodies
+    import responses
+
+    boats_page, loads_page = make_page(storage, options.page_size, options.loads_per_boat)
+    cases = {}
+    boats_copies = copies(storage, boats_page, options.repeat)
+    loads_copies = copies(storage, loads_page, options.repeat)
+    with main.app.test_request_context("/boats"):
+        cases["list_boats"] = (
+            lambda: legacy_boats_page(flask.request, next(boats_copies)),
+            lambda: responses.json_response({"boats": [bodies.boat_body(boat) for boat in boats_page],
+                                             "total_items": len(boats_page)}))
+        cases["list_loads"] = (
+            lambda: legacy_loads_page(flask.request, next(loads_copies)),
+            lambda: responses.json_response({"loads": [bodies.load_body(load) for load in loads_page],
+                                             "total_items": len(loads_page)}))
+        cases["error"] = (lambda: legacy_error(flask), boats.missing_boat_id)
+        results = {}
+        for name, (legacy, current) in sorted(cases.items()):
+            legacy_s = time_per_call(legacy, options.repeat)
+            current_s = time_per_call(current, options.repeat)
+            results[name] = {
+                "legacy_us": round(legacy_s * 1e6, 2),
+                "current_us": round(current_s * 1e6, 2),
+                "saved_us": round((legacy_s - current_s) * 1e6, 2),
+                "speedup": round(legacy_s / current_s, 2) if current_s else None,
+            }
+    return {
+        "python": sys.version.split()[0],
+        "json_backend": "orjson" if responses.orjson is not None else "json",
+        "config": vars(options),
+        "cases": results,
+    }
+
+
+def main(argv=None):
+    print(json.dumps(run(main_args(argv)), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
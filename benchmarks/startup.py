@@ -0,0 +1,98 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file measures how long
+# a new instance takes to get going. Each run starts a fresh interpreter that imports main and serves one
+# GET /loads, and records the import time, the time to the first response and the time for the whole
+# process. With --baseline the same runs are made against an earlier revision, checked out into a temporary
+# git worktree, so the two can be compared. Results are printed as JSON with the median of every run.
+#
+# Usage, from the repository root:
+#   python -m benchmarks.startup --runs 10
+#   python -m benchmarks.startup --runs 10 --baseline HEAD~1
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+response = main.app.test_client().get("/loads", headers={"Accept": "application/json"})
+answered = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "first_request_ms": (answered - imported) * 1000,
+                  "status": response.status_code}))
+"""
+
+
+def probe(tree, backend):
+    environ = dict(os.environ, STORAGE_BACKEND=backend, PYTHONDONTWRITEBYTECODE="1")
+    started = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", PROBE], cwd=tree, env=environ)
+    sample = json.loads(output.decode().strip().splitlines()[-1])
+    sample["process_ms"] = (time.perf_counter() - started) * 1000
+    return sample
+
+
+def measure(tree, options):
+    # The first run fills the bytecode and filesystem caches, so it is not counted
+    probe(tree, options.backend)
+    samples = [probe(tree, options.backend) for _ in range(options.runs)]
+    result = {"statuses": sorted(set(sample["status"] for sample in samples))}
+    for name in ("import_ms", "first_request_ms", "process_ms"):
+        result[name] = round(statistics.median(sample[name] for sample in samples), 2)
+    return result
+
+
+def checkout(revision):
+    tree = tempfile.mkdtemp(prefix="startup-")
+    subprocess.check_call(["git", "worktree", "add", "--detach", tree, revision], cwd=ROOT,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return tree
+
+
+def remove(tree):
+    subprocess.call(["git", "worktree", "remove", "--force", tree], cwd=ROOT,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    shutil.rmtree(tree, ignore_errors=True)
+
+
+def main_args(argv=None):
+    parser = argparse.ArgumentParser(description="Import time and time to first request of a new instance")
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters started for each tree")
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--baseline", help="git revision to compare against, e.g. HEAD~1")
+    return parser.parse_args(argv)
+
+
+def run(options):
+    results = {"current": measure(ROOT, options)}
+    if options.baseline:
+        tree = checkout(options.baseline)
+        try:
+            results["baseline"] = measure(tree, options)
+        finally:
+            remove(tree)
+        results["saved_ms"] = {name: round(results["baseline"][name] - results["current"][name], 2)
+                               for name in ("import_ms", "first_request_ms", "process_ms")}
+    return {
+        "python": sys.version.split()[0],
+        "config": vars(options),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    print(json.dumps(run(main_args(argv)), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
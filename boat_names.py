@@ -0,0 +1,92 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file keeps the
+# reservations that make boat names unique. Every boat name has an entity in the boat_names kind, keyed by
+# the normalized name and holding the id of the boat that owns it. Reservations are claimed and released
+# inside the transaction that writes the boat, so checking a name is a single key lookup and two writers
+# can never both end up with the same name.
+
+import hashlib
+
+import constants
+
+# Datastore key names are limited to 1500 bytes; longer names are reserved under their hash instead
+MAX_KEY_NAME_LENGTH = 500
+REBUILD_BATCH_SIZE = 500
+
+
+# Names differing only in case or spacing count as the same name
+def normalize(name):
+    return " ".join(str(name).split()).casefold()
+
+
+def reservation_key(client, name):
+    key_name = "name:" + normalize(name)
+    if len(key_name.encode("utf-8")) > MAX_KEY_NAME_LENGTH:
+        key_name = "sha256:" + hashlib.sha256(key_name.encode("utf-8")).hexdigest()
+    return client.key(constants.boat_names, key_name)
+
+
+def reservation(client, name, boat_key):
+    entity = client.entity(reservation_key(client, name))
+    entity.update({"boat_id": boat_key.id, "name": name})
+    return entity
+
+
+def held_by_other(entity, boat_key):
+    return entity is not None and entity["boat_id"] != boat_key.id
+
+
+# The functions below must be called inside the transaction that writes the boat.
+# Returns False, and writes nothing, if another boat holds the name.
+def claim(client, name, boat_key):
+    if held_by_other(client.get(key=reservation_key(client, name)), boat_key):
+        return False
+    client.put(reservation(client, name, boat_key))
+    return True
+
+
+# Moves the boat's reservation from old_name to new_name, reading both with one get_multi
+def rename(client, old_name, new_name, boat_key):
+    new_key = reservation_key(client, new_name)
+    old_key = reservation_key(client, old_name)
+    if new_key == old_key:
+        return claim(client, new_name, boat_key)
+    found = {entity.key: entity for entity in client.get_multi([new_key, old_key])}
+    if held_by_other(found.get(new_key), boat_key):
+        return False
+    client.put(reservation(client, new_name, boat_key))
+    old = found.get(old_key)
+    if old is not None and old["boat_id"] == boat_key.id:
+        client.delete(old_key)
+    return True
+
+
+# Frees the names of boats that are being deleted. A reservation held by some other boat is left alone.
+def release(client, boats):
+    keys = {reservation_key(client, boat["name"]): boat.key.id for boat in boats}
+    if len(keys) == 0:
+        return
+    owned = [entity.key for entity in client.get_multi(list(keys)) if entity["boat_id"] == keys[entity.key]]
+    if len(owned) != 0:
+        client.delete_multi(owned)
+
+
+# Rewrites the reservations from the boats themselves, for data written before reservations existed.
+# When several boats already share a name the oldest one keeps it and the others are reported.
+def rebuild(client):
+    reservations = {}
+    duplicates = []
+    for boat in client.iterate(constants.boats, projection=["name"]):
+        key = reservation_key(client, boat["name"])
+        if key in reservations:
+            duplicates.append(boat.key.id)
+            continue
+        reservations[key] = reservation(client, boat["name"], boat.key)
+    stale = [entity.key for entity in client.iterate(constants.boat_names, keys_only=True)
+             if entity.key not in reservations]
+    entities = list(reservations.values())
+    for start in range(0, len(entities), REBUILD_BATCH_SIZE):
+        client.put_multi(entities[start:start + REBUILD_BATCH_SIZE])
+    for start in range(0, len(stale), REBUILD_BATCH_SIZE):
+        client.delete_multi(stale[start:start + REBUILD_BATCH_SIZE])
+    return {"reserved": len(entities), "released": len(stale), "duplicates": duplicates}
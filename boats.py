@@ -4,18 +4,33 @@
 # API calls to /boats.
 
 from flask import Blueprint, request, make_response
-from google.cloud import datastore
-import json
 import constants
-import main
+import auth
+import pagination
+import counters
+import storage
+import responses
+import boat_names
+import versions
+import loads
+import bodies
+import export
+import fieldsets
+import fanout
+import jobs
+import list_cache
 
-client = datastore.Client()
+client = storage.get_backend()
 
 bp = Blueprint('boats', __name__, url_prefix='/boats')
 
+BOAT_ATTRIBUTES = ("name", "type", "length")
+# Everything ?fields= can ask for, in the order they appear in a response
+BOAT_FIELDS = ("name", "type", "length", "loads", "owner", "id", "self")
+
 @bp.route('/decode', methods=['GET'])
 def decode_jwt():
-    payload = main.verify_jwt(request)
+    payload = auth.verify_jwt(request)
     return payload
 
 @bp.route('', methods=['POST','GET'])
@@ -23,125 +38,205 @@ def boats_get_post():
     if request.method == 'POST':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
+        payload = auth.verify_jwt(request)
+        owner = payload["sub"]
         content = request.get_json()
-        if len(content) != 3:
-            return (missing_attribute_error(), 400)
-        new_boat = datastore.entity.Entity(key=client.key(constants.boats))
+        error = new_boat_error(content)
+        if error is not None:
+            return (error, 400)
+        # The id is allocated first so the name can be reserved for this boat in the same transaction
+        new_boat = client.entity(client.allocate_keys(constants.boats, 1)[0])
         new_boat.update({"name": content["name"], "type": content["type"],
           "length": content["length"], "loads": [], "owner": owner})
-        client.put(new_boat)
-        response = new_boat
-        response["id"] = new_boat.key.id
-        response["self"] = request.base_url + "/" + str(response["id"])
-        return (response, 201)
+
+        def create_boat():
+            if not boat_names.claim(client, new_boat["name"], new_boat.key):
+                return False
+            versions.created(new_boat)
+            client.put(new_boat)
+            counters.increment(client, counters.BOATS)
+            counters.increment(client, counters.owner_boats(owner))
+            return True
+        if not client.run_in_transaction(create_boat):
+            return (boat_name_already_exists(), 403)
+        list_cache.written([owner])
+        return versions.tag_response(responses.json_response(bodies.boat_body(new_boat), 201),
+                                     versions.version_of(new_boat))
     elif request.method == 'GET':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
-        query = client.query(kind=constants.boats)
-        query.add_filter("owner", "=", owner)
-        boats_for_owner = (list(query.fetch()))
-        total_number = len(boats_for_owner)
-        if total_number == 0:
-            return ({},200)
-        else:
-            q_limit = int(request.args.get('limit', '5'))
-            q_offset = int(request.args.get('offset', '0'))
-            l_iterator = query.fetch(limit=q_limit, offset=q_offset)
-            pages = l_iterator.pages
-            results = list(next(pages))
-            if l_iterator.next_page_token:
-                next_offset = q_offset + q_limit
-                next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-            else:
-                next_url = None
-            for e in results:
-                e["id"] = e.key.id
-                e["self"] = request.base_url + "/" + str(e["id"])
-                if e["loads"] != []:
-                    for each_load in e["loads"]:
-                        each_load["self"] = request.root_url + "/loads/" + str(each_load["id"])
-            output = {"boats": results}
-            output["total_items"] = total_number
-            if next_url:
-                output["next"] = next_url
-            return json.dumps(output)
+        payload = auth.verify_jwt(request)
+        owner = payload["sub"]
+        try:
+            q_limit, q_offset, q_cursor = pagination.page_args(request.args)
+        except pagination.InvalidPageRequest:
+            return (invalid_page_request(), 400)
+        try:
+            expand = responses.expansions(request.args, ("loads",))
+        except responses.InvalidExpand:
+            return (invalid_expand(), 400)
+        try:
+            fields = fieldsets.requested(request.args, BOAT_FIELDS)
+        except fieldsets.InvalidFields:
+            return (invalid_fields(), 400)
+        # Expanded pages inline the loads, so they also change when a load does
+        return list_cache.page(constants.boats, owner, "loads" in expand,
+                               lambda: boats_page(owner, fields, expand, q_limit, q_offset, q_cursor))
     else:
         return (not_supported_route(), 405)
 
+# One page of the boats the owner has, for GET /boats
+def boats_page(owner, fields, expand, q_limit, q_offset, q_cursor):
+    keys_only, projection = fieldsets.query_plan(fields, BOAT_ATTRIBUTES, known=("owner",))
+    # The boats are counted on the fan-out pool while the page is fetched
+    total_future = None
+    if pagination.wants_total(request.args):
+        total_future = fanout.submit(counters.total, client, counters.owner_boats(owner))
+    try:
+        results, next_cursor = pagination.fetch_page(client, constants.boats, [("owner", "=", owner)],
+                                                     q_limit, q_offset, q_cursor, keys_only, projection)
+    except pagination.InvalidPageRequest:
+        return (invalid_page_request(), 400)
+    total_number = total_future.result() if total_future is not None else None
+    # Whether the list is empty is decided by the query; the counters only fill in total_items
+    if len(results) == 0 and q_cursor is None and q_offset == 0:
+        return responses.json_response({})
+    if next_cursor:
+        next_url = pagination.next_link(request.base_url, q_limit, next_cursor,
+                                        pagination.carried_args(request.args, ("expand", "fields")))
+    else:
+        next_url = None
+    prefix = responses.url_prefix()
+    if keys_only or projection:
+        output = {"boats": [fieldsets.partial_body(e, fields, prefix, {"owner": owner}) for e in results]}
+    else:
+        loads_by_id = get_loads_of(results) if "loads" in expand else None
+        output = {"boats": [fieldsets.trim(bodies.boat_body(e, prefix, loads_by_id), fields) for e in results]}
+    if total_number is not None:
+        output["total_items"] = max(total_number, 0)
+    if next_url:
+        output["next"] = next_url
+    return responses.json_response(output)
+
+# Streams every boat the caller owns as newline-delimited JSON. See export.py for the format.
+@bp.route('/export', methods=['GET'])
+def boats_export():
+    if export.NDJSON_MIMETYPE not in request.accept_mimetypes and 'application/json' not in request.accept_mimetypes:
+        return (json_not_accepted_in_request(), 406)
+    payload = auth.verify_jwt(request)
+    owner = payload["sub"]
+    try:
+        return export.export_response(client, constants.boats, [("owner", "=", owner)], bodies.boat_body,
+                                      responses.url_prefix(), request.args.get('cursor') or None,
+                                      export.wants_gzip(request))
+    except export.InvalidExportCursor:
+        return (invalid_page_request(), 400)
+
 @bp.route('/<id>', methods=['DELETE','GET','PUT','PATCH'])
 def boats_get_delete_put_patch(id):
     if request.method == 'DELETE':
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
+        payload = auth.verify_jwt(request)
+        owner = payload["sub"]
         boat_key = client.key(constants.boats, int(id))
-        boat = client.get(key=boat_key)
-        if boat is None:
-            return (missing_boat_id(), 404)
-        elif boat["owner"] != owner:
-            return (wrong_owner(), 403)
-        if len(boat["loads"]) != 0:
-            load_part = boat["loads"]
-            for each in load_part:
-                load_id = each["id"]
-                load_key = client.key(constants.loads, int(load_id))
-                load = client.get(key=load_key)
-                load.update({"carrier": None})
-                client.put(load)
-        client.delete(boat_key)
-        return ('',204)
+        # With ?async=true, or when the boat carries more loads than fit in one commit, the loads are
+        # unassigned afterwards by a background job
+        wants_job = request.args.get('async') == 'true'
+        job_keys = []
+
+        # The boat is deleted and its loads are unassigned in one transaction with a single
+        # get_multi/put_multi
+        def delete_boat():
+            del job_keys[:]
+            boat = client.get(key=boat_key)
+            if boat is None:
+                return (missing_boat_id(), 404)
+            elif boat["owner"] != owner:
+                return (wrong_owner(), 403)
+            load_keys = [client.key(constants.loads, int(each["id"])) for each in boat["loads"]]
+            if wants_job or len(load_keys) > jobs.INLINE_UNASSIGN_LIMIT:
+                job_keys.append(client.allocate_keys(constants.jobs, 1)[0])
+                jobs.new_unassign_job(job_keys[0], boat, owner)
+            elif len(load_keys) != 0:
+                loads_on_boat = [load for load in client.get_multi(load_keys)
+                                 if load["carrier"] is not None and load["carrier"]["id"] == boat_key.id]
+                for load in loads_on_boat:
+                    load.update({"carrier": None})
+                    versions.bump(load)
+                if len(loads_on_boat) != 0:
+                    client.put_multi(loads_on_boat)
+            boat_names.release(client, [boat])
+            client.delete(boat_key)
+            versions.deleted(boat_key)
+            counters.decrement(client, counters.BOATS)
+            counters.decrement(client, counters.owner_boats(owner))
+            return ('',204)
+        result = client.run_in_transaction(delete_boat)
+        if result[1] == 204:
+            list_cache.written([owner], loads=True)
+        if len(job_keys) == 0 or result[1] != 204:
+            return result
+        job_key = job_keys[0]
+        jobs.enqueue(job_key.id)
+        job_link = responses.link(constants.jobs, job_key.id)
+        response = responses.json_response({"job": {"id": job_key.id, "status": jobs.QUEUED, "self": job_link}},
+                                           202)
+        response.headers.set('Location', job_link)
+        return response
     elif request.method == 'GET':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
+        try:
+            expand = responses.expansions(request.args, ("loads",))
+            fields = fieldsets.requested(request.args, BOAT_FIELDS)
+        except responses.InvalidExpand:
+            return (invalid_expand(), 400)
+        except fieldsets.InvalidFields:
+            return (invalid_fields(), 400)
         boat_key = client.key(constants.boats, int(id))
+        # The token is checked on the fan-out pool while the boat is read
+        auth.prefetch_jwt(request)
+        # An expanded boat changes with its loads, which the boat's version does not follow, so only
+        # the plain form is cached by clients
+        if expand:
+            return get_expanded_boat(boat_key, fields)
+        # A recently seen version that the client already has is answered without reading the boat
+        if request.if_none_match:
+            cached = versions.cache.get(boat_key)
+            if cached is not None and versions.not_modified(request, cached[0]):
+                payload = auth.verify_jwt(request)
+                if cached[1] == payload["sub"]:
+                    return versions.not_modified_response(cached[0])
         boat = client.get(key=boat_key)
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
+        payload = auth.verify_jwt(request)
+        owner = payload["sub"]
         if boat is None:
             return (missing_boat_id(), 404)
         elif boat["owner"] != owner:
             return (wrong_owner_for_get(), 403)
-        boat["id"] = boat.key.id
-        boat["self"] = request.base_url
-        if boat["loads"] != []:
-            for each_load in boat["loads"]:
-                each_load["self"] = request.root_url + "loads/" + str(each_load["id"])
-        return (json.dumps(boat), 200)
+        version = versions.version_of(boat)
+        versions.cache.remember(boat_key, version, boat["owner"])
+        if versions.not_modified(request, version):
+            return versions.not_modified_response(version)
+        return versions.tag_response(responses.json_response(fieldsets.trim(bodies.boat_body(boat), fields)),
+                                     version)
     elif request.method == 'PUT':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
         content = request.get_json()
-        if len(content) < 3:
-            return (missing_attribute_error(), 400)
-        if len(content) > 3:
+        # A PUT replaces the whole boat, so it is held to the same rules as a new one
+        if isinstance(content, dict) and len(content) > 3:
             return (too_many_attributes(), 400)
+        error = new_boat_error(content)
+        if error is not None:
+            return (error, 400)
         boat_key = client.key(constants.boats, int(id))
-        boat = client.get(key=boat_key)
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
-        if boat is None:
-            return (missing_boat_id(), 404)
-        elif boat["owner"] != owner:
-            return (wrong_owner_for_relationship(), 403)
-        if content["name"] != boat["name"]:
-            query = client.query(kind=constants.boats)
-            query.add_filter("name", "=", content["name"])
-            check_for_existing_name = (list(query.fetch()))
-            if len(check_for_existing_name) != 0:
-                return (boat_name_already_exists(), 403)
-        boat.update({"name": content["name"], "type": content["type"],
-                         "length": content["length"]})
-        client.put(boat)
-        url_of_boat = request.root_url + "/boats/" + str(boat_key.id)
-        res = make_response("")
+        auth.prefetch_jwt(request)
+        error, version = client.run_in_transaction(lambda: update_boat(boat_key, content))
+        if error is not None:
+            return error
+        list_cache.written([auth.verify_jwt(request)["sub"]])
+        url_of_boat = responses.link(constants.boats, boat_key.id)
+        res = versions.tag_response(make_response(""), version)
         res.mimetype = 'application/json'
         res.headers.set('Content-Location', url_of_boat)
         res.status_code = 303
@@ -150,36 +245,17 @@ def boats_get_delete_put_patch(id):
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
         content = request.get_json()
-        if len(content) == 0:
-            return (missing_attribute_error(), 400)
-        if len(content) > 3:
-            return (too_many_attributes(), 400)
-        if "name" not in content and "type" not in content and "length" not in content:
-            return(missing_attribute_error(), 400)
+        error = boat_patch_error(content)
+        if error is not None:
+            return (error, 400)
         boat_key = client.key(constants.boats, int(id))
-        boat = client.get(key=boat_key)
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
-        if boat is None:
-            return (missing_boat_id(), 404)
-        elif boat["owner"] != owner:
-            return (wrong_owner_for_relationship(), 403)
-        if "name" in content:
-            if content["name"] != boat["name"]:
-                query = client.query(kind=constants.boats)
-                query.add_filter("name", "=", content["name"])
-                check_for_existing_name = (list(query.fetch()))
-                if len(check_for_existing_name) != 0:
-                    return (boat_name_already_exists(), 403)
-            boat.update({"name": content["name"]})
-        if "type" in content:
-            boat.update({"type": content["type"]})
-        if "length" in content:
-            boat.update({"length": content["length"]})
-        client.put(boat)
-        url_of_boat = request.root_url + "/boats/" + str(boat_key.id)
-        res = make_response("")
+        auth.prefetch_jwt(request)
+        error, version = client.run_in_transaction(lambda: update_boat(boat_key, content))
+        if error is not None:
+            return error
+        list_cache.written([auth.verify_jwt(request)["sub"]])
+        url_of_boat = responses.link(constants.boats, boat_key.id)
+        res = versions.tag_response(make_response(""), version)
         res.mimetype = 'application/json'
         res.headers.set('Content-Location', url_of_boat)
         res.status_code = 204
@@ -187,110 +263,208 @@ def boats_get_delete_put_patch(id):
     else:
         return (not_supported_route(), 405)
 
-@bp.route('/<boat_id>/loads/<load_id>', methods=['PUT','DELETE'])
+# The loads on a boat, read with a query on carrier.id instead of one lookup per entry in boat["loads"]
+@bp.route('/<boat_id>/loads', methods=['GET'])
+def boats_list_loads(boat_id):
+    if 'application/json' not in request.accept_mimetypes:
+        return (json_not_accepted_in_request(), 406)
+    try:
+        q_limit, q_offset, q_cursor = pagination.page_args(request.args)
+        expand = responses.expansions(request.args, ("carrier",))
+        fields = fieldsets.requested(request.args, loads.LOAD_FIELDS)
+    except pagination.InvalidPageRequest:
+        return (invalid_page_request(), 400)
+    except responses.InvalidExpand:
+        return (invalid_expand(), 400)
+    except fieldsets.InvalidFields:
+        return (invalid_fields(), 400)
+    # The token is checked before the boat is read, so a caller without one cannot tell which boats exist
+    owner = auth.verify_jwt(request)["sub"]
+    boat_key = client.key(constants.boats, int(boat_id))
+    boat = client.get(key=boat_key)
+    if boat is None:
+        return (missing_boat_id(), 404)
+    if boat["owner"] != owner:
+        return (wrong_owner_for_get(), 403)
+    total = None
+    if pagination.wants_total(request.args):
+        total = lambda: len(boat["loads"])
+    return loads.loads_page([("carrier.id", "=", boat_key.id)], {}, fields, expand, q_limit, q_offset, q_cursor,
+                            total)
+
+@bp.route('/<boat_id>/loads/<load_id>', methods=['GET','PUT','DELETE'])
 def boats_manage_loads(boat_id, load_id):
-    if request.method == 'PUT':
+    if request.method == 'GET':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
+        # As for the list, the token is checked before anything is read
+        owner = auth.verify_jwt(request)["sub"]
         boat_key = client.key(constants.boats, int(boat_id))
-        boat = client.get(key=boat_key)
         load_key = client.key(constants.loads, int(load_id))
-        load = client.get(key=load_key)
-        if boat is None:
-            return (load_or_boat_does_not_exist(), 404)
-        if load is None:
+        boat, load = get_boat_and_load(boat_key, load_key)
+        if boat is None or load is None:
             return (load_or_boat_does_not_exist(), 404)
-        if load["carrier"] is not None:
-            return (existing_boat_error(), 403)
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
+        if load["carrier"] is None or load["carrier"]["id"] != boat.key.id:
+            return (invalid_load(), 404)
         if boat["owner"] != owner:
-            return (wrong_owner_for_relationship(), 403)
-        load.update({"carrier": {"id" : boat.key.id, "name": boat["name"]}})
-        client.put(load)
-        new_list_of_loads = boat["loads"]
-        new_list_of_loads.append({"id": load.key.id})
-        boat.update({"loads": new_list_of_loads})
-        client.put(boat)
-        return ('', 204)
+            return (wrong_owner_for_get(), 403)
+        return versions.tag_response(responses.json_response(bodies.load_body(load)), versions.version_of(load))
+    elif request.method == 'PUT':
+        if 'application/json' not in request.accept_mimetypes:
+            return (json_not_accepted_in_request(), 406)
+        boat_key = client.key(constants.boats, int(boat_id))
+        load_key = client.key(constants.loads, int(load_id))
+        auth.prefetch_jwt(request)
+
+        def assign_load():
+            boat, load = get_boat_and_load(boat_key, load_key)
+            if boat is None:
+                return (load_or_boat_does_not_exist(), 404)
+            if load is None:
+                return (load_or_boat_does_not_exist(), 404)
+            if load["carrier"] is not None and load["carrier"]["id"] in existing_carriers([load]):
+                return (existing_boat_error(), 403)
+            payload = auth.verify_jwt(request)
+            owner = payload["sub"]
+            if boat["owner"] != owner:
+                return (wrong_owner_for_relationship(), 403)
+            load.update({"carrier": {"id" : boat.key.id, "name": boat["name"]}})
+            new_list_of_loads = boat["loads"]
+            new_list_of_loads.append({"id": load.key.id})
+            boat.update({"loads": new_list_of_loads})
+            versions.bump(load)
+            versions.bump(boat)
+            client.put_multi([load, boat])
+            return ('', 204)
+        result = client.run_in_transaction(assign_load)
+        if result[1] == 204:
+            list_cache.written([auth.verify_jwt(request)["sub"]], loads=True)
+        return result
     elif request.method == 'DELETE':
         boat_key = client.key(constants.boats, int(boat_id))
-        boat = client.get(key=boat_key)
         load_key = client.key(constants.loads, int(load_id))
-        load = client.get(key=load_key)
-        if boat is None or load is None:
-            return (invalid_load(), 404)
-        if load["carrier"] is None:
-            return (invalid_load(), 404)
-        payload = main.verify_jwt(request)
-        readable_payload = decode_jwt()
-        owner = readable_payload["sub"]
-        if boat["owner"] != owner:
-            return (wrong_owner_for_relationship(), 403)
-        load.update({"carrier": None})
-        client.put(load)
-        new_list_of_loads = []
-        for item in boat["loads"]:
-            if load.key.id != item["id"]:
-                new_list_of_loads.append(item)
-        boat["loads"] = new_list_of_loads
-        client.put(boat)
-        return ('', 204)
+        auth.prefetch_jwt(request)
+
+        def remove_load():
+            boat, load = get_boat_and_load(boat_key, load_key)
+            if boat is None or load is None:
+                return (invalid_load(), 404)
+            if load["carrier"] is None or load["carrier"]["id"] != boat.key.id:
+                return (invalid_load(), 404)
+            payload = auth.verify_jwt(request)
+            owner = payload["sub"]
+            if boat["owner"] != owner:
+                return (wrong_owner_for_relationship(), 403)
+            load.update({"carrier": None})
+            new_list_of_loads = []
+            for item in boat["loads"]:
+                if load.key.id != item["id"]:
+                    new_list_of_loads.append(item)
+            boat["loads"] = new_list_of_loads
+            versions.bump(load)
+            versions.bump(boat)
+            client.put_multi([load, boat])
+            return ('', 204)
+        result = client.run_in_transaction(remove_load)
+        if result[1] == 204:
+            list_cache.written([auth.verify_jwt(request)["sub"]], loads=True)
+        return result
     else:
         return (not_supported_route(), 405)
 
+# The validation rules for boats, shared by the single-item and the batch endpoints. Each returns the
+# error body to send back, or None if the content is valid.
+def new_boat_error(content):
+    if not isinstance(content, dict) or len(content) != 3:
+        return missing_attribute_error()
+    for attribute in BOAT_ATTRIBUTES:
+        if attribute not in content:
+            return missing_attribute_error()
+    return None
 
-def missing_attribute_error():
-    error_message_for_missing_attributes = '{"Error" : "The request object is missing at least ' \
-                                           'one of the required attributes"}'
-    return (json.loads(error_message_for_missing_attributes))
-
-def missing_boat_id():
-    error_message_for_missing_id = '{"Error": "No boat with this boat_id exists"}'
-    return (json.loads(error_message_for_missing_id))
-
-def load_or_boat_does_not_exist():
-    error_message_for_missing_id = '{"Error": "The specified boat and/or load does not exist"}'
-    return (json.loads(error_message_for_missing_id))
-
-def existing_boat_error():
-    error_message_for_existing_boat = '{"Error": "The load is already loaded on another boat"}'
-    return (json.loads(error_message_for_existing_boat))
+def boat_patch_error(content):
+    if not isinstance(content, dict) or len(content) == 0:
+        return missing_attribute_error()
+    if len(content) > 3:
+        return too_many_attributes()
+    if "name" not in content and "type" not in content and "length" not in content:
+        return missing_attribute_error()
+    return None
 
-def invalid_load():
-    error_message_for_existing_boat = '{"Error": "No boat with this boat_id is loaded with the load with this load_id"}'
-    return (json.loads(error_message_for_existing_boat))
+def apply_boat_patch(boat, content):
+    for attribute in BOAT_ATTRIBUTES:
+        if attribute in content:
+            boat.update({attribute: content[attribute]})
 
-def wrong_owner():
-    error_message_for_wrong_owner = '{"Error": "You do not have permission to delete this boat as you are not the' \
-                                   ' owner of this boat."}'
-    return (json.loads(error_message_for_wrong_owner))
+# Shared by PUT and PATCH, run inside a transaction. A rename moves the boat's name reservation in the
+# same transaction as the boat write. Returns (error response, None), or (None, new version) once the
+# boat is written.
+def update_boat(boat_key, content):
+    boat = client.get(key=boat_key)
+    payload = auth.verify_jwt(request)
+    owner = payload["sub"]
+    if boat is None:
+        return (missing_boat_id(), 404), None
+    elif boat["owner"] != owner:
+        return (wrong_owner_for_relationship(), 403), None
+    if not versions.if_match_allows(request, versions.version_of(boat)):
+        return (version_mismatch(), 412), None
+    if "name" in content and content["name"] != boat["name"]:
+        if not boat_names.rename(client, boat["name"], content["name"], boat_key):
+            return (boat_name_already_exists(), 403), None
+    apply_boat_patch(boat, content)
+    versions.bump(boat)
+    client.put(boat)
+    return None, versions.version_of(boat)
 
-def wrong_owner_for_relationship():
-    error_message_for_wrong_owner_for_rel = '{"Error": "You do not have permission to change this boat as you are not the' \
-                                   ' owner of this boat."}'
-    return (json.loads(error_message_for_wrong_owner_for_rel))
+def get_expanded_boat(boat_key, fields=None):
+    boat = client.get(key=boat_key)
+    payload = auth.verify_jwt(request)
+    if boat is None:
+        return (missing_boat_id(), 404)
+    elif boat["owner"] != payload["sub"]:
+        return (wrong_owner_for_get(), 403)
+    return responses.json_response(fieldsets.trim(bodies.boat_body(boat, loads_by_id=get_loads_of([boat])), fields))
 
-def wrong_owner_for_get():
-    error_message_for_wrong_owner_for_get = '{"Error": "You do not have permission to view this boat as you are not the owner' \
-                                            ' of this boat."}'
-    return (json.loads(error_message_for_wrong_owner_for_get))
+# Reads every load on the given boats with a single get_multi, for ?expand=loads
+def get_loads_of(boats):
+    load_keys = set(client.key(constants.loads, int(each["id"])) for boat in boats for each in boat["loads"])
+    return {load.key.id: load for load in client.get_multi(list(load_keys))}
 
-def not_supported_route():
-    error_message_not_supported_route = '{"Error": "This method is not supported on this URL"}'
-    return (json.loads(error_message_not_supported_route))
+# The ids of the boats that still exist among the carriers of the given loads, read with one get_multi. A
+# deleted boat's loads keep it as their carrier until its job reaches them; until then they count as
+# unassigned, so they can be put on another boat straight away and the job leaves them alone.
+def existing_carriers(loads_to_check):
+    carrier_keys = set(client.key(constants.boats, load["carrier"]["id"]) for load in loads_to_check
+                       if load["carrier"] is not None)
+    if len(carrier_keys) == 0:
+        return set()
+    return set(boat.key.id for boat in client.get_multi(list(carrier_keys)))
 
-def json_not_accepted_in_request():
-    error_message_json_not_accepted_in_request= '{"Error" : "This MIME type is not supported by this endpoint."}'
-    return (json.loads(error_message_json_not_accepted_in_request))
+# Reads a boat and a load with one get_multi. get_multi does not keep the order of the keys.
+def get_boat_and_load(boat_key, load_key):
+    found = {entity.key: entity for entity in client.get_multi([boat_key, load_key])}
+    return found.get(boat_key), found.get(load_key)
 
-def boat_name_already_exists():
-    error_message_boat_name_already_exists= '{"Error" : "A boat with this name already exists. Please use' \
-                                            ' another name if possible."}'
-    return (json.loads(error_message_boat_name_already_exists))
 
-def too_many_attributes():
-    error_message_too_many_attributes = '{"Error" : "The request object has too ' \
-                                           'many attributes"}'
-    return (json.loads(error_message_too_many_attributes))
+# The error responses. Their bodies are encoded once, when the module is loaded.
+missing_attribute_error = responses.missing_attribute_error
+missing_boat_id = responses.Error("No boat with this boat_id exists")
+load_or_boat_does_not_exist = responses.Error("The specified boat and/or load does not exist")
+existing_boat_error = responses.Error("The load is already loaded on another boat")
+invalid_load = responses.Error("No boat with this boat_id is loaded with the load with this load_id")
+wrong_owner = responses.Error("You do not have permission to delete this boat as you are not the owner "
+                              "of this boat.")
+wrong_owner_for_relationship = responses.Error("You do not have permission to change this boat as you "
+                                               "are not the owner of this boat.")
+wrong_owner_for_get = responses.Error("You do not have permission to view this boat as you are not the "
+                                      "owner of this boat.")
+not_supported_route = responses.not_supported_route
+json_not_accepted_in_request = responses.json_not_accepted_in_request
+boat_name_already_exists = responses.Error("A boat with this name already exists. Please use another "
+                                           "name if possible.")
+too_many_attributes = responses.too_many_attributes
+invalid_page_request = responses.invalid_page_request
+version_mismatch = responses.version_mismatch
+invalid_expand = responses.invalid_expand
+invalid_fields = responses.invalid_fields
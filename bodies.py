@@ -0,0 +1,44 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file builds the
+# JSON form of a boat and of a load. A boat can inline its loads and a load its carrier, so the two are kept
+# together here, where the boats and loads blueprints (and batch, export and the jobs) can both use them
+# without importing each other.
+
+import constants
+import responses
+
+
+# The JSON form of a boat, with links to the boat and its loads. The entity itself is not changed. When
+# loads_by_id is given, the loads are inlined in full instead of as links; one that no longer exists
+# stays a link.
+def boat_body(boat, prefix=None, loads_by_id=None):
+    if prefix is None:
+        prefix = responses.url_prefix()
+    body = dict(boat)
+    body.pop("version", None)
+    body["loads"] = []
+    for each_load in boat["loads"]:
+        if loads_by_id is not None and each_load["id"] in loads_by_id:
+            body["loads"].append(load_body(loads_by_id[each_load["id"]], prefix))
+        else:
+            body["loads"].append(dict(each_load, self=responses.link(constants.loads, each_load["id"], prefix)))
+    body["id"] = boat.key.id
+    body["self"] = responses.link(constants.boats, boat.key.id, prefix)
+    return body
+
+# The JSON form of a load, with links to the load and its carrier. The entity itself is not changed. When
+# carriers_by_id is given and holds the carrier, the boat is inlined in full instead of as a link.
+def load_body(load, prefix=None, carriers_by_id=None):
+    if prefix is None:
+        prefix = responses.url_prefix()
+    body = dict(load)
+    body.pop("version", None)
+    carrier = load["carrier"]
+    if carrier is not None:
+        if carriers_by_id is not None and carrier["id"] in carriers_by_id:
+            body["carrier"] = boat_body(carriers_by_id[carrier["id"]], prefix)
+        else:
+            body["carrier"] = dict(carrier, self=responses.link(constants.boats, carrier["id"], prefix))
+    body["id"] = load.key.id
+    body["self"] = responses.link(constants.loads, load.key.id, prefix)
+    return body
@@ -1,3 +1,7 @@
 boats = "boats"
 loads = "loads"
 users = "users"
+counters = "counters"
+boat_names = "boat_names"
+jobs = "jobs"
+sessions = "sessions"
@@ -0,0 +1,99 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file keeps the
+# sharded counters that back total_items in the list endpoints, so listing does not have to scan the whole
+# kind. Writers update a random shard inside their own transaction and readers add up all the shards with
+# a single get_multi.
+
+import random
+
+import constants
+import storage
+
+BOATS = constants.boats
+LOADS = constants.loads
+NUM_SHARDS = 20
+NUM_OWNER_SHARDS = 4
+# Times a rebuild counts again because the counter moved while it was counting
+REBUILD_ATTEMPTS = 5
+
+
+def owner_boats(owner):
+    return constants.boats + ":owner:" + owner
+
+
+def shards_for(name):
+    if name in (BOATS, LOADS):
+        return NUM_SHARDS
+    return NUM_OWNER_SHARDS
+
+
+def shard_keys(client, name):
+    return [client.key(constants.counters, name + "#" + str(i)) for i in range(shards_for(name))]
+
+
+# Must be called inside the transaction that writes the counted entity
+def increment(client, name, delta=1):
+    shard_key = random.choice(shard_keys(client, name))
+    shard = client.get(key=shard_key)
+    if shard is None:
+        shard = client.entity(shard_key)
+        shard.update({"name": name, "count": 0})
+    shard["count"] = shard["count"] + delta
+    client.put(shard)
+
+
+def decrement(client, name):
+    increment(client, name, -1)
+
+
+def total(client, name):
+    return sum(shard["count"] for shard in client.get_multi(shard_keys(client, name)))
+
+
+# The kind and filters of the entities a counter counts
+def counted_by(name):
+    if name in (BOATS, LOADS):
+        return name, []
+    return constants.boats, [("owner", "=", name[len(owner_boats("")):])]
+
+
+# Recounts every counter from scratch. Counters that no longer match any entity (an owner whose last
+# boat was deleted) are reset to zero.
+def rebuild(client):
+    names = set([BOATS, LOADS])
+    names.update(owner_boats(boat["owner"]) for boat in client.iterate(constants.boats, projection=["owner"]))
+    names.update(shard["name"] for shard in client.iterate(constants.counters, projection=["name"]))
+    return {name: rebuild_counter(client, name) for name in sorted(names)}
+
+
+# {shard key: count} of the shards that exist. Read inside a transaction so it is never a cached copy.
+def shard_counts(client, keys):
+    return {shard.key: shard["count"] for shard in client.get_multi(keys)}
+
+
+# The entities are counted page by page outside of any transaction, since a large kind would go past a
+# transaction's time and entity limits. Every counted write also updates a shard, so the shards are read
+# before the count and the new ones are only written, in a short transaction, if they have not changed
+# since; otherwise a write landed during the count and it is counted again.
+def rebuild_counter(client, name):
+    keys = shard_keys(client, name)
+    kind, filters = counted_by(name)
+    for _ in range(REBUILD_ATTEMPTS):
+        before = client.run_in_transaction(lambda: shard_counts(client, keys))
+        count = sum(1 for _ in client.iterate(kind, filters, keys_only=True))
+        if client.run_in_transaction(lambda: write_shards(client, name, keys, before, count)):
+            return count
+    raise storage.Conflict("The " + name + " counter kept changing while it was rebuilt")
+
+
+# Puts the count in the first shard and zero in the others, unless the shards have moved since before
+def write_shards(client, name, keys, before, count):
+    if shard_counts(client, keys) != before:
+        return False
+    shards = []
+    for index, key in enumerate(keys):
+        shard = client.entity(key)
+        shard.update({"name": name, "count": count if index == 0 else 0})
+        shards.append(shard)
+    client.put_multi(shards)
+    return True
@@ -0,0 +1,303 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file is a
+# read-through cache for key lookups (get/get_multi) that sits in front of the storage backend. Every
+# put/delete that goes through the storage layer invalidates the keys it touches, including the
+# cross-kind writes where deleting a load rewrites its boat, so handlers never see their own stale writes.
+# Only this instance's writes invalidate its LRU, so on App Engine a key read can be up to ENTITY_CACHE_TTL
+# seconds behind a write made on another instance. An optional shared cache lets several instances use one
+# cache that every instance's writes invalidate; with it, the local LRU only holds entries for
+# SHARED_LOCAL_TTL seconds, so writes made elsewhere show up almost at once. Settings:
+#   ENTITY_CACHE_SIZE    - entries in the in-process LRU (0 turns the cache off)
+#   ENTITY_CACHE_TTL     - seconds an entry may be served
+#   ENTITY_CACHE_SHARED  - "dict" for the in-process stand-in server, or a redis:// URL
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from os import environ as env
+
+import storage
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL = 5
+SHARED_LOCAL_TTL = 1
+
+
+class LRUCache(object):
+    def __init__(self, max_size=DEFAULT_SIZE, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if self.clock() >= expires_at:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+# A local stand-in for a shared cache server such as memcached or Redis. Several CachedBackends (one per
+# simulated instance) can be handed the same DictServer in tests. Values are stored as strings, the same
+# way a real server would hold them.
+class DictServer(object):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_multi(self, names):
+        now = self.clock()
+        found = {}
+        with self.lock:
+            for name in names:
+                entry = self.values.get(name)
+                if entry is not None and now < entry[0]:
+                    found[name] = entry[1]
+        return found
+
+    def set_multi(self, mapping, ttl):
+        expires_at = self.clock() + ttl
+        with self.lock:
+            for name, value in mapping.items():
+                self.values[name] = (expires_at, value)
+
+    def delete_multi(self, names):
+        with self.lock:
+            for name in names:
+                self.values.pop(name, None)
+
+
+# Same interface as DictServer, backed by Redis. Only used when ENTITY_CACHE_SHARED is a redis:// URL,
+# and the redis package is only needed in that case.
+class RedisServer(object):
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get_multi(self, names):
+        values = self.client.mget(names)
+        return {name: value.decode("utf-8") for name, value in zip(names, values) if value is not None}
+
+    def set_multi(self, mapping, ttl):
+        pipeline = self.client.pipeline()
+        for name, value in mapping.items():
+            pipeline.set(name, value, ex=max(1, int(ttl)))
+        pipeline.execute()
+
+    def delete_multi(self, names):
+        if names:
+            self.client.delete(*names)
+
+
+def cache_name(key):
+    return "entity:" + key.kind + ":" + str(key.id_or_name)
+
+
+class CachedTransaction(object):
+    def __init__(self, cache):
+        self.cache = cache
+        self.inner = None
+
+    def __enter__(self):
+        state = self.cache.state
+        self.inner = self.cache.backend.transaction()
+        self.inner.__enter__()
+        if getattr(state, "depth", 0) == 0:
+            state.pending = set()
+        state.depth = getattr(state, "depth", 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        state = self.cache.state
+        try:
+            return self.inner.__exit__(exc_type, exc_value, traceback)
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                pending = state.pending
+                state.pending = None
+                # Invalidated again after the commit, in case a reader refilled a key in the meantime
+                self.cache.invalidate(pending)
+
+
+class CachedBackend(storage.BackendWrapper):
+    def __init__(self, backend, local=None, shared=None, ttl=DEFAULT_TTL):
+        super(CachedBackend, self).__init__(backend)
+        if local is None:
+            local = LRUCache(ttl=min(ttl, SHARED_LOCAL_TTL) if shared is not None else ttl)
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self.state = threading.local()
+        self.generations = {}
+        self.generation_lock = threading.Lock()
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def in_transaction(self):
+        return getattr(self.state, "depth", 0) > 0
+
+    def transaction(self):
+        return CachedTransaction(self)
+
+    def make_entity(self, key, data):
+        entity = self.backend.entity(key)
+        entity.update(storage.clone(data))
+        return entity
+
+    def get(self, key):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    # Reads inside a transaction always go to the backend so the transaction sees current data
+    def get_multi(self, keys):
+        if self.in_transaction() or len(keys) == 0:
+            return self.backend.get_multi(keys)
+        found = []
+        missing = []
+        for key in keys:
+            data = self.local.get(key)
+            if data is None:
+                missing.append(key)
+            else:
+                found.append(self.make_entity(key, data))
+        if missing and self.shared is not None:
+            missing = self.get_shared(missing, found)
+        if missing:
+            with self.generation_lock:
+                started = {key: self.generations.get(key, 0) for key in missing}
+            fetched = self.backend.get_multi(missing)
+            self.fill(fetched, started)
+            found.extend(fetched)
+        return found
+
+    def get_shared(self, keys, found):
+        names = {cache_name(key): key for key in keys}
+        values = self.shared.get_multi(list(names))
+        self.shared_hits += len(values)
+        self.shared_misses += len(names) - len(values)
+        for name, value in values.items():
+            key = names[name]
+            data = json.loads(value)
+            self.local.set(key, data)
+            found.append(self.make_entity(key, data))
+        return [key for name, key in names.items() if name not in values]
+
+    # A key that was written while we were reading it is left out, so a slow reader cannot put back the
+    # value that a concurrent write has just replaced
+    def fill(self, entities, started):
+        shared_values = {}
+        with self.generation_lock:
+            for entity in entities:
+                if self.generations.get(entity.key, 0) != started.get(entity.key):
+                    continue
+                data = storage.clone(dict(entity))
+                self.local.set(entity.key, data)
+                if self.shared is not None:
+                    shared_values[cache_name(entity.key)] = json.dumps(data)
+        if shared_values:
+            self.shared.set_multi(shared_values, self.ttl)
+
+    def invalidate(self, keys):
+        keys = [key for key in keys if key is not None and not key.is_partial]
+        if not keys:
+            return
+        with self.generation_lock:
+            for key in keys:
+                self.generations[key] = self.generations.get(key, 0) + 1
+                self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete_multi([cache_name(key) for key in keys])
+        if len(self.generations) > 4 * self.local.max_size:
+            with self.generation_lock:
+                self.generations.clear()
+
+    def written(self, keys):
+        if self.in_transaction():
+            self.state.pending.update(key for key in keys if not key.is_partial)
+        self.invalidate(keys)
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        try:
+            self.backend.put_multi(entities)
+        finally:
+            self.written([entity.key for entity in entities])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        try:
+            self.backend.delete_multi(keys)
+        finally:
+            self.written(keys)
+
+    def stats(self):
+        stats = self.local.stats()
+        stats["ttl"] = self.ttl
+        stats["local_ttl"] = self.local.ttl
+        if self.shared is not None:
+            stats["shared_hits"] = self.shared_hits
+            stats["shared_misses"] = self.shared_misses
+        return stats
+
+
+shared_dict_server = None
+
+
+# Wraps the backend in a cache configured from the environment, or returns it as is when the cache is off
+def from_environment(backend):
+    global shared_dict_server
+    size = int(env.get("ENTITY_CACHE_SIZE", str(DEFAULT_SIZE)))
+    if size <= 0:
+        return backend
+    ttl = float(env.get("ENTITY_CACHE_TTL", str(DEFAULT_TTL)))
+    shared_setting = env.get("ENTITY_CACHE_SHARED", "")
+    shared = None
+    if shared_setting == "dict":
+        if shared_dict_server is None:
+            shared_dict_server = DictServer()
+        shared = shared_dict_server
+    elif shared_setting.startswith("redis://") or shared_setting.startswith("rediss://"):
+        shared = RedisServer(shared_setting)
+    local_ttl = min(ttl, SHARED_LOCAL_TTL) if shared is not None else ttl
+    return CachedBackend(backend, LRUCache(size, local_ttl), shared, ttl)
@@ -0,0 +1,64 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file streams a
+# whole kind as newline-delimited JSON for /boats/export and /loads/export. The query is followed with
+# cursors EXPORT_BATCH_SIZE entities at a time and each batch is written out before the next one is read,
+# so memory use does not grow with the size of the data.
+#
+# After every batch a line {"cursor": "..."} is written. An export that was cut off can be resumed by
+# passing the last of these as ?cursor=. The stream always ends with {"cursor": null}, so a client can
+# tell a complete export from a truncated one.
+
+import zlib
+
+from flask import Response
+
+import responses
+import storage
+
+EXPORT_BATCH_SIZE = 500
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+class InvalidExportCursor(Exception):
+    pass
+
+
+def wants_gzip(request):
+    return "gzip" in request.accept_encodings
+
+
+# body_of(entity, prefix) gives the JSON form of each entity. The first batch is read before the response
+# starts, so that a bad cursor can still be answered with a 400.
+def export_response(client, kind, filters, body_of, prefix, cursor=None, gzip=False,
+                    batch_size=EXPORT_BATCH_SIZE):
+    try:
+        first_batch = client.query(kind, filters, limit=batch_size, cursor=cursor)
+    except storage.InvalidCursor:
+        raise InvalidExportCursor()
+    chunks = export_chunks(client, kind, filters, body_of, prefix, first_batch, batch_size)
+    if gzip:
+        response = Response(gzipped(chunks), mimetype=NDJSON_MIMETYPE)
+        response.headers.set('Content-Encoding', 'gzip')
+        response.headers.set('Vary', 'Accept-Encoding')
+    else:
+        response = Response(chunks, mimetype=NDJSON_MIMETYPE)
+    return response
+
+
+def export_chunks(client, kind, filters, body_of, prefix, first_batch, batch_size):
+    results, next_cursor = first_batch
+    while True:
+        lines = [responses.encode(body_of(entity, prefix)) for entity in results]
+        lines.append(responses.encode({"cursor": next_cursor}))
+        yield b"\n".join(lines) + b"\n"
+        if next_cursor is None:
+            return
+        results, next_cursor = client.query(kind, filters, limit=batch_size, cursor=next_cursor)
+
+
+# Compresses each chunk as it goes, flushing after every one so the client receives whole batches
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
@@ -0,0 +1,19 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file holds the
+# small thread pool that handlers use to overlap independent blocking calls within one request, such as
+# verifying the JWT while the boat is read, or counting the items of a list while its page is fetched.
+# Work handed to the pool must not depend on the request context or on an open transaction, since both
+# belong to the thread that is serving the request.
+#   FANOUT_THREADS  - size of the pool
+
+from concurrent.futures import ThreadPoolExecutor
+from os import environ as env
+
+DEFAULT_THREADS = 16
+
+executor = ThreadPoolExecutor(max_workers=int(env.get("FANOUT_THREADS", str(DEFAULT_THREADS))),
+                              thread_name_prefix="fanout")
+
+
+def submit(work, *args, **kwargs):
+    return executor.submit(work, *args, **kwargs)
@@ -0,0 +1,65 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file handles the
+# ?fields= parameter that lets a client ask for only some attributes of each boat or load. On the list
+# endpoints the request is turned into the smallest query that can answer it: keys-only when only id
+# and self are wanted, a projection query when every wanted attribute is a plain indexed value, and a
+# normal query otherwise, with the extra attributes trimmed off before the response is encoded.
+#
+# A projection query needs a composite index on the filter and the projected properties, so projections
+# are limited to the combinations declared in index.yaml: one attribute on its own, or all of the
+# projectable attributes of the kind together.
+
+import responses
+
+
+class InvalidFields(Exception):
+    pass
+
+
+# Returns the requested field names in the order of allowed, or None when the parameter is absent
+def requested(args, allowed):
+    value = args.get("fields")
+    if value is None:
+        return None
+    names = set(name.strip() for name in value.split(",") if name.strip())
+    if len(names) == 0 or not names <= set(allowed):
+        raise InvalidFields()
+    return [name for name in allowed if name in names]
+
+
+# Returns (keys_only, projection) for a query that can fill in the fields. known holds attributes that are
+# already known without reading them, such as the owner that the query filters on (Datastore cannot
+# project a property that has an equality filter on it).
+def query_plan(fields, projectable, known=()):
+    if fields is None:
+        return False, None
+    stored = [name for name in fields if name not in ("id", "self") and name not in known]
+    if len(stored) == 0:
+        return True, None
+    if not set(stored) <= set(projectable):
+        return False, None
+    if len(stored) == 1:
+        return False, stored
+    return False, list(projectable)
+
+
+# Builds the body of an entity read with a keys-only or projection query
+def partial_body(entity, fields, prefix, known=None):
+    body = {}
+    for name in fields:
+        if name == "id":
+            body["id"] = entity.key.id
+        elif name == "self":
+            body["self"] = responses.link(entity.key.kind, entity.key.id, prefix)
+        elif known is not None and name in known:
+            body[name] = known[name]
+        else:
+            body[name] = entity[name]
+    return body
+
+
+# Removes everything but the requested fields from a full body
+def trim(body, fields):
+    if fields is None:
+        return body
+    return {name: body[name] for name in fields if name in body}
@@ -0,0 +1,159 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file runs the
+# background jobs that finish a boat delete. DELETE /boats/<id>?async=true deletes the boat and records a
+# job in the same transaction, then answers 202 with a link to /jobs/<id>. A worker thread then unassigns
+# the boat's loads JOB_BATCH_SIZE at a time. Each batch is written together with the job's progress in one
+# transaction, so a job that was cut off (the instance stopped, or a batch failed) picks up after the last
+# batch that was written. Until the job is done, loads that are still to be processed keep the deleted boat
+# as their carrier; the assignment endpoints treat such a load as unassigned, and the job skips a load that
+# has been put on another boat in the meantime.
+#
+# The queue is an in-process one, which is also what runs locally. A job that fails is logged and queued
+# again after a delay that doubles each time, up to JOB_RETRY_MAX_DELAY seconds, and is left for a resume
+# after JOB_MAX_ATTEMPTS tries. Jobs are stored, so on App Engine an instance that starts up (see
+# /_ah/warmup) or an operator calling /admin/jobs/resume queues the unfinished jobs again.
+
+import logging
+import queue
+import threading
+import time
+
+from flask import Blueprint, request
+
+import auth
+import constants
+import list_cache
+import responses
+import storage
+import versions
+
+client = storage.get_backend()
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+JOB_BATCH_SIZE = 100
+# A Datastore commit takes at most 500 mutations, so a boat with more loads than this is deleted straight
+# away and its loads are unassigned by a job, even when the client did not ask for ?async=true
+INLINE_UNASSIGN_LIMIT = 200
+JOB_RETRY_DELAY = 1
+JOB_RETRY_MAX_DELAY = 60
+JOB_MAX_ATTEMPTS = 8
+UNASSIGN_LOADS = "unassign_loads"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+
+pending = queue.Queue()
+worker = None
+worker_lock = threading.Lock()
+
+
+# Must be called inside the transaction that deletes the boat, with a key from allocate_keys
+def new_unassign_job(job_key, boat, owner):
+    job = client.entity(job_key)
+    job.update({"type": UNASSIGN_LOADS, "owner": owner, "boat_id": boat.key.id,
+                "load_ids": [each["id"] for each in boat["loads"]], "done": 0, "status": QUEUED,
+                "finished": False, "created": time.time(), "updated": time.time()})
+    client.put(job)
+    return job
+
+
+# attempt counts the tries the job has already had on this instance
+def enqueue(job_id, attempt=0):
+    start_worker()
+    pending.put((job_id, attempt))
+
+
+def retry_delay(attempt):
+    return min(JOB_RETRY_MAX_DELAY, JOB_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def start_worker():
+    global worker
+    if worker is None:
+        with worker_lock:
+            if worker is None:
+                worker = threading.Thread(target=work_forever, name="jobs", daemon=True)
+                worker.start()
+
+
+def work_forever():
+    while True:
+        job_id, attempt = pending.get()
+        try:
+            run_job(job_id)
+        except Exception:
+            # The progress already written is kept, so the next try carries on from there
+            attempt += 1
+            if attempt >= JOB_MAX_ATTEMPTS:
+                logger.exception("Job %s failed %d times; leaving it for /admin/jobs/resume", job_id, attempt)
+            else:
+                delay = retry_delay(attempt)
+                logger.exception("Job %s failed, trying again in %s seconds", job_id, delay)
+                timer = threading.Timer(delay, enqueue, (job_id, attempt))
+                timer.daemon = True
+                timer.start()
+        finally:
+            pending.task_done()
+
+
+def run_job(job_id, batch_size=JOB_BATCH_SIZE):
+    job_key = client.key(constants.jobs, job_id)
+    while True:
+        more = client.run_in_transaction(lambda: run_batch(job_key, batch_size))
+        list_cache.written(loads=True)
+        if not more:
+            return
+
+
+# Unassigns the next batch of loads and records the progress. Returns True while there is more to do.
+def run_batch(job_key, batch_size):
+    job = client.get(key=job_key)
+    if job is None or job["finished"]:
+        return False
+    load_ids = job["load_ids"][job["done"]:job["done"] + batch_size]
+    if len(load_ids) != 0:
+        loads_in_batch = [load for load in client.get_multi([client.key(constants.loads, int(load_id))
+                                                             for load_id in load_ids])
+                          if load["carrier"] is not None and load["carrier"]["id"] == job["boat_id"]]
+        for load in loads_in_batch:
+            load.update({"carrier": None})
+            versions.bump(load)
+        if len(loads_in_batch) != 0:
+            client.put_multi(loads_in_batch)
+    job["done"] = job["done"] + len(load_ids)
+    job["finished"] = job["done"] >= len(job["load_ids"])
+    job["status"] = DONE if job["finished"] else RUNNING
+    job["updated"] = time.time()
+    client.put(job)
+    return not job["finished"]
+
+
+# Queues every job that has not finished. Returns how many were queued.
+def resume():
+    job_ids = [job.key.id for job in client.iterate(constants.jobs, [("finished", "=", False)], keys_only=True)]
+    for job_id in job_ids:
+        enqueue(job_id)
+    return len(job_ids)
+
+
+def job_body(job):
+    return {"id": job.key.id, "type": job["type"], "status": job["status"], "boat_id": job["boat_id"],
+            "loads_total": len(job["load_ids"]), "loads_done": job["done"], "created": job["created"],
+            "updated": job["updated"], "self": responses.link(constants.jobs, job.key.id)}
+
+
+@bp.route('/<id>', methods=['GET'])
+def jobs_get(id):
+    if 'application/json' not in request.accept_mimetypes:
+        return (json_not_accepted_in_request(), 406)
+    payload = auth.verify_jwt(request)
+    job = client.get(key=client.key(constants.jobs, int(id)))
+    if job is None or job["owner"] != payload["sub"]:
+        return (missing_job_id(), 404)
+    return responses.json_response(job_body(job))
+
+
+json_not_accepted_in_request = responses.json_not_accepted_in_request
+missing_job_id = responses.Error("No job with this job_id exists")
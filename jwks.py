@@ -0,0 +1,164 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file keeps a cached
+# copy of the Auth0 JWKS document so that verifying a JWT does not need a round trip to Auth0 on every request.
+
+import json
+import threading
+import time
+
+from jose import jwk
+from six.moves.urllib.request import urlopen
+
+# Used when the JWKS response has no usable Cache-Control max-age
+DEFAULT_TTL = 600
+# Bounds applied to the max-age sent by Auth0
+MIN_TTL = 10
+MAX_TTL = 86400
+# How long a stale copy may be served after refreshes start failing (unless stale-if-error says otherwise)
+DEFAULT_STALE_IF_ERROR = 86400
+# Minimum number of seconds between refreshes triggered by an unknown kid
+UNKNOWN_KID_REFRESH_INTERVAL = 30
+# Minimum number of seconds between attempts after a failed refresh
+FAILED_REFRESH_RETRY_INTERVAL = 5
+FETCH_TIMEOUT = 5
+
+
+class JWKSUnavailable(Exception):
+    pass
+
+
+# Reads the max-age and stale-if-error directives from a Cache-Control header
+def parse_cache_control(header):
+    max_age = None
+    stale_if_error = None
+    no_cache = False
+    if not header:
+        return max_age, stale_if_error, no_cache
+    for directive in header.split(","):
+        name, _, value = directive.strip().partition("=")
+        name = name.lower()
+        if name in ("no-cache", "no-store"):
+            no_cache = True
+        elif name in ("max-age", "stale-if-error"):
+            try:
+                seconds = int(value.strip().strip('"'))
+            except ValueError:
+                continue
+            if name == "max-age":
+                max_age = seconds
+            else:
+                stale_if_error = seconds
+    return max_age, stale_if_error, no_cache
+
+
+# Downloads the JWKS document and returns it along with its Cache-Control header
+def fetch_jwks(url):
+    response = urlopen(url, timeout=FETCH_TIMEOUT)
+    try:
+        document = json.loads(response.read())
+        cache_control = response.headers.get("Cache-Control")
+    finally:
+        response.close()
+    return document, cache_control
+
+
+# Builds the verification keys once per JWKS document instead of once per request
+def parse_keys(document):
+    keys = {}
+    for key in document.get("keys", []):
+        if key.get("kty") != "RSA" or key.get("use", "sig") != "sig" or "kid" not in key:
+            continue
+        rsa_key = {
+            "kty": key["kty"],
+            "kid": key["kid"],
+            "use": key.get("use", "sig"),
+            "n": key["n"],
+            "e": key["e"]
+        }
+        try:
+            keys[key["kid"]] = jwk.construct(rsa_key, "RS256")
+        except Exception:
+            continue
+    return keys
+
+
+class KeyStore(object):
+    def __init__(self, url, fetch=fetch_jwks, clock=time.monotonic):
+        self.url = url
+        self.fetch = fetch
+        self.clock = clock
+        self.keys = {}
+        self.fetched_at = None
+        self.expires_at = 0
+        self.stale_until = 0
+        self.next_attempt_at = 0
+        self.last_unknown_kid_refresh = None
+        self.refresh_count = 0
+        self.refresh_failures = 0
+        self.lock = threading.Lock()
+
+    # Returns the parsed key for kid, or None if the JWKS document does not contain it
+    def get_key(self, kid):
+        now = self.clock()
+        if self.fetched_at is None or now >= self.expires_at:
+            self.refresh(now)
+        key = self.keys.get(kid)
+        if key is None and self.may_refresh_for_unknown_kid(now):
+            self.refresh(now, force=True)
+            key = self.keys.get(kid)
+        return key
+
+    # Fetches the document ahead of the first request, if it is not already fresh
+    def preload(self):
+        now = self.clock()
+        if self.fetched_at is None or now >= self.expires_at:
+            self.refresh(now)
+
+    def may_refresh_for_unknown_kid(self, now):
+        last = self.last_unknown_kid_refresh
+        return last is None or now - last >= UNKNOWN_KID_REFRESH_INTERVAL
+
+    # Only one thread fetches at a time; the others wait and then reuse its result
+    def refresh(self, now, force=False):
+        generation = self.fetched_at
+        with self.lock:
+            if self.fetched_at != generation:
+                return
+            if force:
+                if not self.may_refresh_for_unknown_kid(now):
+                    return
+                self.last_unknown_kid_refresh = now
+            elif self.fetched_at is not None and now < self.expires_at:
+                return
+            if now < self.next_attempt_at:
+                self.raise_if_unusable(now)
+                return
+            try:
+                document, cache_control = self.fetch(self.url)
+                keys = parse_keys(document)
+            except Exception as error:
+                self.refresh_failures += 1
+                self.next_attempt_at = now + FAILED_REFRESH_RETRY_INTERVAL
+                self.raise_if_unusable(now, error)
+                return
+            max_age, stale_if_error, no_cache = parse_cache_control(cache_control)
+            if max_age is None:
+                ttl = MIN_TTL if no_cache else DEFAULT_TTL
+            else:
+                ttl = min(max(max_age, MIN_TTL), MAX_TTL)
+            if stale_if_error is None:
+                stale_if_error = DEFAULT_STALE_IF_ERROR
+            self.keys = keys
+            self.expires_at = now + ttl
+            self.stale_until = self.expires_at + stale_if_error
+            self.next_attempt_at = 0
+            self.refresh_count += 1
+            self.fetched_at = now
+
+    # A failed refresh is fine as long as the copy we already have is within its stale-if-error window
+    def raise_if_unusable(self, now, error=None):
+        if self.fetched_at is None or now >= self.stale_until:
+            raise JWKSUnavailable(str(error) if error else "JWKS document is unavailable")
+
+    def stats(self):
+        return {"keys": len(self.keys), "refreshes": self.refresh_count, "refresh_failures": self.refresh_failures}
@@ -0,0 +1,121 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file caches the
+# rendered pages of GET /boats and GET /loads, so an owner who keeps asking for the same page does not pay
+# for the count and the page query every time. A page is stored under the owner, the URL it was asked for
+# (which holds the limit, offset or cursor, fields, expand and filters) and the generation numbers of the
+# data it was built from: the owner's generation for their boats, and one shared generation for loads,
+# which have no owner. Every write to boats or loads moves the generations it affects on once it has
+# committed, so invalidating is O(1) and the pages built from the old data are never looked up again; they
+# fall out of the LRU. The generations are read before a page is fetched, so a page built while a write was
+# in flight is stored under the old generation and cannot outlive the write.
+#
+# Each instance has its own cache and only sees its own writes, so a page may be up to LIST_CACHE_TTL
+# seconds behind a write made on another instance, as with the entity cache. Hits and misses by kind are
+# reported at /metrics and /admin/stats. Settings:
+#   LIST_CACHE_SIZE  - pages kept in the LRU (0 turns the cache off)
+#   LIST_CACHE_TTL   - seconds a page may be served
+
+import itertools
+import threading
+from os import environ as env
+
+from flask import Response, current_app, request
+
+import entity_cache
+import metrics
+
+DEFAULT_SIZE = 1000
+DEFAULT_TTL = 10
+
+
+class ListCache(object):
+    def __init__(self, max_size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.pages = entity_cache.LRUCache(max_size, ttl)
+        self.lock = threading.Lock()
+        # Generations are handed out from one counter and never reused. An owner who has no entry gets the
+        # floor, which is moved past every generation handed out so far whenever the entries are dropped.
+        self.counter = itertools.count(1)
+        self.floor = 0
+        self.owners = {}
+        self.loads = 0
+        self.hits = {}
+        self.misses = {}
+
+    def generation(self, owner, with_loads):
+        with self.lock:
+            return (self.owners.get(owner, self.floor) if owner is not None else None,
+                    self.loads if with_loads else None)
+
+    # Called after the transaction that changed the owners' boats, or any load, has committed
+    def written(self, owners=(), loads=False):
+        with self.lock:
+            for owner in owners:
+                self.owners[owner] = next(self.counter)
+            if loads:
+                self.loads = next(self.counter)
+            if len(self.owners) > 4 * self.pages.max_size:
+                self.owners.clear()
+                self.floor = next(self.counter)
+
+    def clear(self):
+        with self.lock:
+            self.owners.clear()
+            self.floor = self.loads = next(self.counter)
+        self.pages.clear()
+
+    # Serves the page from the cache, or calls render() and keeps what it returns if that is a 200. owner is
+    # the owner whose boats the page shows, and with_loads says whether it shows anything of loads.
+    def page(self, kind, owner, with_loads, render):
+        if self.pages.max_size <= 0:
+            return render()
+        key = (kind, owner, request.base_url, tuple(sorted(request.args.items(multi=True))),
+               self.generation(owner, with_loads))
+        cached = self.pages.get(key)
+        if cached is not None:
+            self.count(self.hits, kind)
+            return Response(cached[0], mimetype=cached[1])
+        self.count(self.misses, kind)
+        response = current_app.make_response(render())
+        if response.status_code == 200:
+            self.pages.set(key, (response.get_data(), response.mimetype))
+        return response
+
+    def count(self, counts, kind):
+        with self.lock:
+            counts[kind] = counts.get(kind, 0) + 1
+
+    # {(kind, "hit" or "miss"): count}
+    def requests(self):
+        with self.lock:
+            return dict([((kind, "hit"), count) for kind, count in self.hits.items()] +
+                        [((kind, "miss"), count) for kind, count in self.misses.items()])
+
+    def stats(self):
+        stats = self.pages.stats()
+        with self.lock:
+            stats["owners"] = len(self.owners)
+            stats["kinds"] = {}
+            for kind in sorted(set(self.hits) | set(self.misses)):
+                hits = self.hits.get(kind, 0)
+                misses = self.misses.get(kind, 0)
+                stats["kinds"][kind] = {"hits": hits, "misses": misses, "hit_rate": hits / float(hits + misses)}
+        return stats
+
+
+cache = ListCache(int(env.get("LIST_CACHE_SIZE", str(DEFAULT_SIZE))),
+                  float(env.get("LIST_CACHE_TTL", str(DEFAULT_TTL))))
+
+
+def page(kind, owner, with_loads, render):
+    return cache.page(kind, owner, with_loads, render)
+
+
+def written(owners=(), loads=False):
+    cache.written(owners, loads)
+
+
+metrics.registry.add(metrics.Gauge(
+    "list_cache_requests_total", "List pages served from the cache or rendered, by kind.", ("kind", "result"),
+    cache.requests, kind="counter"))
+metrics.registry.add(metrics.Gauge(
+    "list_cache_pages", "List pages held in the cache.", (), lambda: {(): len(cache.pages.entries)}))
@@ -3,115 +3,234 @@
 # API calls to /loads.
 
 from flask import Blueprint, request, make_response
-from google.cloud import datastore
-import json
 from json2html import *
 import constants
+import pagination
+import counters
+import storage
+import responses
+import versions
+import bodies
+import auth
+import export
+import fieldsets
+import fanout
+import list_cache
 
-client = datastore.Client()
+client = storage.get_backend()
 
 bp = Blueprint('loads', __name__, url_prefix='/loads')
 
+LOAD_ATTRIBUTES = ("volume", "item", "creation_date")
+# Everything ?fields= can ask for, in the order they appear in a response
+LOAD_FIELDS = ("volume", "item", "creation_date", "carrier", "id", "self")
+# Query parameters that are repeated on the link to the next page of a list
+CARRIED_ARGS = ("expand", "fields", "carrier", "unassigned")
+
+
+class InvalidCarrierFilter(Exception):
+    pass
+
+
 @bp.route('', methods=['POST','GET'])
 def loads_get_post():
     if request.method == 'POST':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
         content = request.get_json()
-        if len(content) < 3:
-            return (missing_attribute_error(), 400)
-        new_load = datastore.entity.Entity(key=client.key(constants.loads))
+        error = new_load_error(content)
+        if error is not None:
+            return (error, 400)
+        new_load = client.entity(client.key(constants.loads))
         new_load.update({"volume": content["volume"], "item": content["item"], "creation_date": content["creation_date"],
                          "carrier": None})
-        client.put(new_load)
-        response = new_load
-        response["id"] = new_load.key.id
-        response["self"] = request.base_url + "/" + str(response["id"])
-        return (response, 201)
+
+        def create_load():
+            versions.created(new_load)
+            client.put(new_load)
+            counters.increment(client, counters.LOADS)
+        client.run_in_transaction(create_load)
+        list_cache.written(loads=True)
+        return versions.tag_response(responses.json_response(bodies.load_body(new_load), 201),
+                                     versions.version_of(new_load))
     elif request.method == 'GET':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
-        query = client.query(kind=constants.loads)
-        loads_for_owner = (list(query.fetch()))
-        total_number = len(loads_for_owner)
-        if total_number == 0:
-            return ({},200)
-        else:
-            q_limit = int(request.args.get('limit', '5'))
-            q_offset = int(request.args.get('offset', '0'))
-            g_iterator = query.fetch(limit=q_limit, offset=q_offset)
-            pages = g_iterator.pages
-            results = list(next(pages))
-            if g_iterator.next_page_token:
-                next_offset = q_offset + q_limit
-                next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-            else:
-                next_url = None
-            for e in results:
-                e["id"] = e.key.id
-                e["self"] = request.base_url + "/" + str(e["id"])
-                check_for_carrier = e["carrier"]
-                if check_for_carrier is not None:
-                    check_for_carrier["self"] = request.base_url[0:-5] + str(check_for_carrier["id"])
-            output = {"loads": results}
-            output["total_items"] = total_number
-            if next_url:
-                output["next"] = next_url
-            return json.dumps(output)
+        try:
+            q_limit, q_offset, q_cursor = pagination.page_args(request.args)
+        except pagination.InvalidPageRequest:
+            return (invalid_page_request(), 400)
+        try:
+            expand = responses.expansions(request.args, ("carrier",))
+        except responses.InvalidExpand:
+            return (invalid_expand(), 400)
+        try:
+            fields = fieldsets.requested(request.args, LOAD_FIELDS)
+        except fieldsets.InvalidFields:
+            return (invalid_fields(), 400)
+        try:
+            filters, known = carrier_filters(request.args)
+        except InvalidCarrierFilter:
+            return (invalid_carrier_filter(), 400)
+        # Loads have no owner, so a page is the same for everyone unless it inlines the caller's boats
+        owner = None
+        if "carrier" in expand and fieldsets.query_plan(fields, LOAD_ATTRIBUTES, tuple(known)) == (False, None):
+            owner = auth.verify_jwt(request)["sub"]
+        return list_cache.page(constants.loads, owner, True,
+                               lambda: loads_page(filters, known, fields, expand, q_limit, q_offset, q_cursor,
+                                                  total_of_loads(filters)))
     else:
         return (not_supported_route(), 405)
 
+# The loads are counted on the fan-out pool while the page is fetched. The counters only cover every load,
+# so a filtered list has no total_items.
+def total_of_loads(filters):
+    if pagination.wants_total(request.args) and len(filters) == 0:
+        return fanout.submit(counters.total, client, counters.LOADS).result
+    return None
+
+# ?carrier=<boat_id> lists the loads on a boat and ?unassigned=true the loads on no boat. Both are equality
+# filters on the load's carrier, served by the indexes in index.yaml. Returns (filters, known), where known
+# holds the attributes the filter already gives away.
+def carrier_filters(args):
+    carrier = args.get("carrier")
+    unassigned = args.get("unassigned")
+    if carrier is not None and unassigned is not None:
+        raise InvalidCarrierFilter()
+    if carrier is not None:
+        try:
+            return [("carrier.id", "=", int(carrier))], {}
+        except ValueError:
+            raise InvalidCarrierFilter()
+    if unassigned is not None:
+        if unassigned.lower() not in ('true', '1', 'yes'):
+            raise InvalidCarrierFilter()
+        return [("carrier", "=", None)], {"carrier": None}
+    return [], {}
+
+# One page of loads that match filters, for GET /loads and GET /boats/<id>/loads. total is None, or a
+# function that returns total_items and is called once the page has been read.
+def loads_page(filters, known, fields, expand, q_limit, q_offset, q_cursor, total=None):
+    keys_only, projection = fieldsets.query_plan(fields, LOAD_ATTRIBUTES, known=tuple(known))
+    try:
+        results, next_cursor = pagination.fetch_page(client, constants.loads, filters, q_limit, q_offset, q_cursor,
+                                                     keys_only, projection)
+    except pagination.InvalidPageRequest:
+        return (invalid_page_request(), 400)
+    total_number = total() if total is not None else None
+    # Whether the list is empty is decided by the query; the counters only fill in total_items
+    if len(results) == 0 and q_cursor is None and q_offset == 0:
+        return responses.json_response({})
+    if next_cursor:
+        next_url = pagination.next_link(request.base_url, q_limit, next_cursor,
+                                        pagination.carried_args(request.args, CARRIED_ARGS))
+    else:
+        next_url = None
+    prefix = responses.url_prefix()
+    if keys_only or projection:
+        output = {"loads": [fieldsets.partial_body(e, fields, prefix, known) for e in results]}
+    else:
+        carriers_by_id = get_carriers_of(results) if "carrier" in expand else None
+        output = {"loads": [fieldsets.trim(bodies.load_body(e, prefix, carriers_by_id), fields) for e in results]}
+    if total_number is not None:
+        output["total_items"] = max(total_number, 0)
+    if next_url:
+        output["next"] = next_url
+    return responses.json_response(output)
+
+# Streams every load as newline-delimited JSON. See export.py for the format.
+@bp.route('/export', methods=['GET'])
+def loads_export():
+    if export.NDJSON_MIMETYPE not in request.accept_mimetypes and 'application/json' not in request.accept_mimetypes:
+        return (json_not_accepted_in_request(), 406)
+    try:
+        return export.export_response(client, constants.loads, [], bodies.load_body, responses.url_prefix(),
+                                      request.args.get('cursor') or None, export.wants_gzip(request))
+    except export.InvalidExportCursor:
+        return (invalid_page_request(), 400)
+
 @bp.route('/<id>', methods=['DELETE','GET','PUT','PATCH'])
 def loads_get_delete_put_patch(id):
     if request.method == 'DELETE':
         load_key = client.key(constants.loads, int(id))
-        load = client.get(key=load_key)
-        if load is None:
-            return (missing_load_id(), 404)
-        if load["carrier"] is not None:
-            boat_part = load["carrier"]
-            boat_id = boat_part["id"]
-            boat_key = client.key(constants.boats, int(boat_id))
-            boat = client.get(key=boat_key)
-            new_list_of_loads = []
-            for item in boat["loads"]:
-                if load.key.id != item["id"]:
-                    new_list_of_loads.append(item)
-            boat.update({"loads": new_list_of_loads})
-            client.put(boat)
-        client.delete(load_key)
-        return ('',204)
+        carrier_owners = []
+
+        # Removing the load from its boat and deleting it happen in the same transaction
+        def delete_load():
+            load = client.get(key=load_key)
+            if load is None:
+                return (missing_load_id(), 404)
+            if load["carrier"] is not None:
+                boat_part = load["carrier"]
+                boat_id = boat_part["id"]
+                boat_key = client.key(constants.boats, int(boat_id))
+                boat = client.get(key=boat_key)
+                if boat is not None:
+                    new_list_of_loads = []
+                    for item in boat["loads"]:
+                        if load.key.id != item["id"]:
+                            new_list_of_loads.append(item)
+                    boat.update({"loads": new_list_of_loads})
+                    versions.bump(boat)
+                    client.put(boat)
+                    carrier_owners.append(boat["owner"])
+            client.delete(load_key)
+            versions.deleted(load_key)
+            counters.decrement(client, counters.LOADS)
+            return ('',204)
+        result = client.run_in_transaction(delete_load)
+        if result[1] == 204:
+            list_cache.written(carrier_owners, loads=True)
+        return result
     elif request.method == 'GET':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
+        try:
+            expand = responses.expansions(request.args, ("carrier",))
+            fields = fieldsets.requested(request.args, LOAD_FIELDS)
+        except responses.InvalidExpand:
+            return (invalid_expand(), 400)
+        except fieldsets.InvalidFields:
+            return (invalid_fields(), 400)
         load_key = client.key(constants.loads, int(id))
+        # An expanded load changes with its boat, so only the plain form gets an ETag
+        if expand:
+            load = client.get(key=load_key)
+            if load is None:
+                return (missing_load_id(), 404)
+            body = bodies.load_body(load, carriers_by_id=get_carriers_of([load]))
+            return responses.json_response(fieldsets.trim(body, fields))
+        # A recently seen version that the client already has is answered without reading the load
+        if request.if_none_match:
+            cached = versions.cache.get(load_key)
+            if cached is not None and versions.not_modified(request, cached[0]):
+                return versions.not_modified_response(cached[0])
         load = client.get(key=load_key)
         if load is None:
             return (missing_load_id(), 404)
-        load["id"] = load.key.id
-        load["self"] = request.base_url
-        length_of_load_id = len(id)
-        check_for_carrier = load["carrier"]
-        if check_for_carrier is not None:
-            check_for_carrier["self"] = request.base_url[0:-(length_of_load_id + 6)] + "boats/" +  str(check_for_carrier["id"])
-        return (json.dumps(load), 200)
+        version = versions.version_of(load)
+        versions.cache.remember(load_key, version)
+        if versions.not_modified(request, version):
+            return versions.not_modified_response(version)
+        return versions.tag_response(responses.json_response(fieldsets.trim(bodies.load_body(load), fields)),
+                                     version)
     elif request.method == 'PUT':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
         content = request.get_json()
-        if len(content) < 3:
-            return (missing_attribute_error(), 400)
-        if len(content) > 3:
+        # A PUT replaces the whole load, so it is held to the same rules as a new one
+        if isinstance(content, dict) and len(content) > 3:
             return (too_many_attributes(), 400)
+        error = new_load_error(content)
+        if error is not None:
+            return (error, 400)
         load_key = client.key(constants.loads, int(id))
-        load = client.get(key=load_key)
-        if load is None:
-            return (missing_load_id(), 404)
-        load.update({"volume": content["volume"], "item": content["item"],
-                         "creation_date": content["creation_date"]})
-        client.put(load)
-        url_of_load = request.root_url + "/loads/" + str(load_key.id)
-        res = make_response("")
+        error, version = client.run_in_transaction(lambda: update_load(load_key, content))
+        if error is not None:
+            return error
+        list_cache.written(loads=True)
+        url_of_load = responses.link(constants.loads, load_key.id)
+        res = versions.tag_response(make_response(""), version)
         res.mimetype = 'application/json'
         res.headers.set('Content-Location', url_of_load)
         res.status_code = 303
@@ -120,25 +239,16 @@ def loads_get_delete_put_patch(id):
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
         content = request.get_json()
-        if len(content) == 0:
-            return (missing_attribute_error(), 400)
-        if len(content) > 3:
-            return (too_many_attributes(), 400)
-        if "volume" not in content and "item" not in content and "creation_date" not in content:
-            return(missing_attribute_error(), 400)
+        error = load_patch_error(content)
+        if error is not None:
+            return (error, 400)
         load_key = client.key(constants.loads, int(id))
-        load = client.get(key=load_key)
-        if load is None:
-            return (missing_load_id(), 404)
-        if "volume" in content:
-            load.update({"volume": content["volume"]})
-        if "item" in content:
-            load.update({"item": content["item"]})
-        if "creation_date" in content:
-            load.update({"creation_date": content["creation_date"]})
-        client.put(load)
-        url_of_load = request.root_url + "/load/" + str(load_key.id)
-        res = make_response("")
+        error, version = client.run_in_transaction(lambda: update_load(load_key, content))
+        if error is not None:
+            return error
+        list_cache.written(loads=True)
+        url_of_load = responses.link(constants.loads, load_key.id)
+        res = versions.tag_response(make_response(""), version)
         res.mimetype = 'application/json'
         res.headers.set('Content-Location', url_of_load)
         res.status_code = 204
@@ -146,28 +256,60 @@ def loads_get_delete_put_patch(id):
     else:
         return (not_supported_route(), 405)
 
-def missing_attribute_error():
-    error_message_for_missing_attributes = '{"Error" : "The request object is missing at ' \
-                                           'least one of the required attributes"}'
-    return (json.loads(error_message_for_missing_attributes))
+# The validation rules for loads, shared by the single-item and the batch endpoints. Each returns the
+# error body to send back, or None if the content is valid.
+def new_load_error(content):
+    if not isinstance(content, dict) or len(content) < 3:
+        return missing_attribute_error()
+    for attribute in LOAD_ATTRIBUTES:
+        if attribute not in content:
+            return missing_attribute_error()
+    return None
 
-def missing_load_number():
-    error_message_for_missing_attributes = '{"Error" : "No load with this load_id exists"}'
-    return (json.loads(error_message_for_missing_attributes))
+def load_patch_error(content):
+    if not isinstance(content, dict) or len(content) == 0:
+        return missing_attribute_error()
+    if len(content) > 3:
+        return too_many_attributes()
+    if "volume" not in content and "item" not in content and "creation_date" not in content:
+        return missing_attribute_error()
+    return None
 
-def missing_load_id():
-    error_message_for_missing_id = '{"Error": "No load with this load_id exists"}'
-    return (json.loads(error_message_for_missing_id))
+def apply_load_patch(load, content):
+    for attribute in LOAD_ATTRIBUTES:
+        if attribute in content:
+            load.update({attribute: content[attribute]})
 
-def not_supported_route():
-    error_message_not_supported_route = '{"Error": "This method is not supported on this URL"}'
-    return (json.loads(error_message_not_supported_route))
+# Shared by PUT and PATCH, run inside a transaction so that the If-Match check and the write see the same
+# version. Returns (error response, None), or (None, new version) once the load is written.
+def update_load(load_key, content):
+    load = client.get(key=load_key)
+    if load is None:
+        return (missing_load_id(), 404), None
+    if not versions.if_match_allows(request, versions.version_of(load)):
+        return (version_mismatch(), 412), None
+    apply_load_patch(load, content)
+    versions.bump(load)
+    client.put(load)
+    return None, versions.version_of(load)
 
-def json_not_accepted_in_request():
-    error_message_json_not_accepted_in_request= '{"Error" : "This MIME type is not supported by this endpoint."}'
-    return (json.loads(error_message_json_not_accepted_in_request))
+# Reads the boats carrying the given loads with a single get_multi, for ?expand=carrier. A boat can only
+# be seen by its owner, so this needs a JWT and boats that belong to someone else are left out.
+def get_carriers_of(loads_on_page):
+    owner = auth.verify_jwt(request)["sub"]
+    boat_keys = set(client.key(constants.boats, int(load["carrier"]["id"]))
+                    for load in loads_on_page if load["carrier"] is not None)
+    return {boat.key.id: boat for boat in client.get_multi(list(boat_keys)) if boat["owner"] == owner}
 
-def too_many_attributes():
-    error_message_too_many_attributes = '{"Error" : "The request object has too ' \
-                                           'many attributes"}'
-    return (json.loads(error_message_too_many_attributes))
+# The error responses. Their bodies are encoded once, when the module is loaded.
+missing_attribute_error = responses.missing_attribute_error
+missing_load_number = responses.Error("No load with this load_id exists")
+missing_load_id = responses.Error("No load with this load_id exists")
+not_supported_route = responses.not_supported_route
+json_not_accepted_in_request = responses.json_not_accepted_in_request
+too_many_attributes = responses.too_many_attributes
+invalid_page_request = responses.invalid_page_request
+version_mismatch = responses.version_mismatch
+invalid_expand = responses.invalid_expand
+invalid_carrier_filter = responses.Error("Use either carrier=<boat_id> or unassigned=true")
+invalid_fields = responses.invalid_fields
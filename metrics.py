@@ -0,0 +1,300 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file collects
+# request and storage metrics and serves them at /metrics in the Prometheus text format. It records:
+#   http_request_duration_seconds        - latency of every request by blueprint, route, method and status
+#   storage_rpc_duration_seconds         - latency of every storage call that reaches the backend, by operation
+#   http_request_storage_rpcs_total      - storage calls made while serving each route, by operation
+#   http_request_storage_seconds_total   - time each route spent waiting on those calls
+#   jwt_verification_duration_seconds    - time to verify a token, by outcome (cached, verified or failed)
+#   http_request_jwt_seconds_total       - time each route spent waiting on token verification
+#
+# The storage calls are counted underneath the entity cache, so only calls that would reach Datastore are
+# included. Calls made on the fan-out pool count towards the totals but not towards the route that made them.
+# Recording a sample is a bisect and a dict update under a lock, so the cost to each request is a few
+# microseconds. When METRICS_TOKEN is set, /metrics needs "Authorization: Bearer <METRICS_TOKEN>".
+
+import bisect
+import hmac
+import threading
+import time
+from os import environ as env
+
+from flask import Blueprint, Response, request
+
+import storage
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+bp = Blueprint('metrics', __name__)
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def label_text(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, label_value(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        return ["%s%s %s" % (self.name, label_text(self.label_names, labels), repr(value))
+                for labels, value in series]
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, description, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self.lock:
+            series = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.series.items())
+        lines = []
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (self.name, label_text(self.label_names, labels, 'le="%s"' % le),
+                                                 cumulative))
+            lines.append("%s_sum%s %s" % (self.name, label_text(self.label_names, labels), repr(total)))
+            lines.append("%s_count%s %d" % (self.name, label_text(self.label_names, labels), cumulative))
+        return lines
+
+
+# Reads its values when /metrics is scraped. collect() returns {labels: value}. kind may be "counter" for
+# totals that are kept elsewhere.
+class Gauge(object):
+    def __init__(self, name, description, label_names, collect, kind="gauge"):
+        self.kind = kind
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.collect = collect
+
+    def samples(self):
+        return ["%s%s %s" % (self.name, label_text(self.label_names, labels), repr(value))
+                for labels, value in sorted(self.collect().items())]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.description))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+request_duration = registry.add(Histogram(
+    "http_request_duration_seconds", "Time taken to serve a request.", ("blueprint", "route", "method", "status")))
+rpc_duration = registry.add(Histogram(
+    "storage_rpc_duration_seconds", "Time taken by storage calls that reach the backend.", ("operation",)))
+request_rpcs = registry.add(Counter(
+    "http_request_storage_rpcs_total", "Storage calls made while serving a route.", ("route", "method", "operation")))
+request_rpc_seconds = registry.add(Counter(
+    "http_request_storage_seconds_total", "Time a route spent waiting on storage calls.",
+    ("route", "method", "operation")))
+jwt_duration = registry.add(Histogram(
+    "jwt_verification_duration_seconds", "Time taken to verify a bearer token.", ("outcome",)))
+request_jwt_seconds = registry.add(Counter(
+    "http_request_jwt_seconds_total", "Time a route spent waiting on token verification.", ("route", "method")))
+
+# What the request being served on this thread has spent so far
+current = threading.local()
+
+# Functions called as observer(operation, seconds, target) after every storage call, where target is the key,
+# keys, entity, entities or kind the call was made with. Used by the profiler.
+rpc_observers = []
+
+
+def record_rpc(operation, seconds, target=None):
+    rpc_duration.observe((operation,), seconds)
+    for observer in rpc_observers:
+        observer(operation, seconds, target)
+    tally = getattr(current, "tally", None)
+    if tally is not None:
+        entry = tally.get(operation)
+        if entry is None:
+            tally[operation] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def record_jwt(outcome, started):
+    jwt_duration.observe((outcome,), time.perf_counter() - started)
+
+
+# Time the request thread spent in verify_jwt, including any wait for a token checked on the fan-out pool
+def record_jwt_wait(seconds):
+    if getattr(current, "tally", None) is not None:
+        current.jwt_seconds += seconds
+
+
+def start_request():
+    current.tally = {}
+    current.jwt_seconds = 0.0
+    current.started = time.perf_counter()
+
+
+def finish_request(response):
+    tally = getattr(current, "tally", None)
+    if tally is None:
+        return response
+    elapsed = time.perf_counter() - current.started
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    method = request.method
+    request_duration.observe((request.blueprint or "", route, method, str(response.status_code)), elapsed)
+    for operation, (count, seconds) in tally.items():
+        request_rpcs.inc((route, method, operation), count)
+        request_rpc_seconds.inc((route, method, operation), seconds)
+    if current.jwt_seconds:
+        request_jwt_seconds.inc((route, method), current.jwt_seconds)
+    current.tally = None
+    return response
+
+
+def clear_request(exc=None):
+    current.tally = None
+
+
+def install(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(clear_request)
+    app.register_blueprint(bp)
+
+
+def is_authorized(request):
+    metrics_token = env.get("METRICS_TOKEN")
+    if not metrics_token:
+        return True
+    return hmac.compare_digest(request.headers.get('Authorization', ''), "Bearer " + metrics_token)
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_page():
+    if not is_authorized(request):
+        return Response(status=403)
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+# Times every call that goes past it. It sits between the entity cache and the real backend.
+class MetricsBackend(storage.BackendWrapper):
+    def timed(self, operation, target, call, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            record_rpc(operation, time.perf_counter() - started, target)
+
+    def get(self, key):
+        return self.timed("get", key, self.backend.get, key)
+
+    def get_multi(self, keys):
+        return self.timed("get", keys, self.backend.get_multi, keys)
+
+    def put(self, entity):
+        self.timed("put", entity, self.backend.put, entity)
+
+    def put_multi(self, entities):
+        self.timed("put", entities, self.backend.put_multi, entities)
+
+    def delete(self, key):
+        self.timed("delete", key, self.backend.delete, key)
+
+    def delete_multi(self, keys):
+        self.timed("delete", keys, self.backend.delete_multi, keys)
+
+    def allocate_keys(self, kind, count):
+        return self.timed("allocate", kind, self.backend.allocate_keys, kind, count)
+
+    def query(self, kind, filters=(), limit=None, offset=0, cursor=None, keys_only=False, projection=None):
+        return self.timed("query", kind, self.backend.query, kind, filters, limit=limit, offset=offset,
+                          cursor=cursor, keys_only=keys_only, projection=projection)
+
+    # A scan is counted as one query, timed across every batch it reads
+    def iterate(self, kind, filters=(), keys_only=False, projection=None, batch_size=storage.SCAN_BATCH_SIZE):
+        entities = self.backend.iterate(kind, filters, keys_only=keys_only, projection=projection,
+                                        batch_size=batch_size)
+        seconds = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    entity = next(entities)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started
+                yield entity
+        finally:
+            record_rpc("query", seconds, kind)
+
+    def transaction(self):
+        return TimedTransaction(self.backend.transaction())
+
+
+# Times beginning and committing a transaction, but not the work done inside it
+class TimedTransaction(object):
+    def __init__(self, transaction):
+        self.transaction = transaction
+
+    def __enter__(self):
+        started = time.perf_counter()
+        try:
+            return self.transaction.__enter__()
+        finally:
+            record_rpc("begin", time.perf_counter() - started)
+
+    def __exit__(self, *exc_info):
+        started = time.perf_counter()
+        try:
+            return self.transaction.__exit__(*exc_info)
+        finally:
+            record_rpc("commit" if exc_info[0] is None else "rollback", time.perf_counter() - started)
@@ -0,0 +1,60 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file holds the
+# pagination helpers shared by the list endpoints. Pages are addressed with opaque query cursors so that
+# fetching page N costs the same as fetching page 1. limit/offset is still accepted for the first
+# page so existing clients keep working.
+
+from urllib.parse import quote
+
+import storage
+
+DEFAULT_LIMIT = 5
+MAX_LIMIT = 500
+
+
+class InvalidPageRequest(Exception):
+    pass
+
+
+# Reads limit, offset and cursor from the query string
+def page_args(args):
+    try:
+        limit = int(args.get('limit', str(DEFAULT_LIMIT)))
+        offset = int(args.get('offset', '0'))
+    except ValueError:
+        raise InvalidPageRequest()
+    if limit < 1 or offset < 0:
+        raise InvalidPageRequest()
+    limit = min(limit, MAX_LIMIT)
+    cursor = args.get('cursor') or None
+    return limit, offset, cursor
+
+
+# total_items is only computed when the client has not opted out with include_total=false
+def wants_total(args):
+    return args.get('include_total', 'true').lower() not in ('false', '0', 'no')
+
+
+# Returns one page of results and the cursor for the page after it (None on the last page).
+# A cursor takes precedence over an offset.
+def fetch_page(client, kind, filters, limit, offset=0, cursor=None, keys_only=False, projection=None):
+    try:
+        if cursor:
+            return client.query(kind, filters, limit=limit, cursor=cursor, keys_only=keys_only,
+                                projection=projection)
+        return client.query(kind, filters, limit=limit, offset=offset, keys_only=keys_only,
+                            projection=projection)
+    except storage.InvalidCursor:
+        raise InvalidPageRequest()
+
+
+# Query parameters in carried (expand and the like) are repeated on the next page's link
+def next_link(base_url, limit, cursor, carried=()):
+    link = base_url + "?limit=" + str(limit) + "&cursor=" + quote(cursor, safe='')
+    for name, value in carried:
+        link += "&" + name + "=" + quote(value, safe=',')
+    return link
+
+
+def carried_args(args, names):
+    return [(name, args[name]) for name in names if args.get(name)]
@@ -0,0 +1,170 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file profiles single
+# requests on demand. A request is profiled when it carries "X-Profile-Token: <PROFILE_TOKEN>", or at random
+# for a PROFILE_SAMPLE_RATE fraction of requests. While it runs, a sampler thread records the request
+# thread's stack every PROFILE_INTERVAL_MS milliseconds. Afterwards two files are written to PROFILE_DIR,
+# named after the X-Profile-Id header sent with the response:
+#   <id>.collapsed   - the samples as collapsed stacks, ready for flamegraph.pl or speedscope
+#   <id>.trace.json  - every storage call the request made, with its offset, duration, kind and keys
+#
+# Every request, profiled or not, is also checked for the N+1 pattern: N_PLUS_ONE_THRESHOLD or more
+# single-key gets of the same kind, as a loop over related entities would make. These are logged,
+# counted in n_plus_one_requests_total at /metrics and listed in the trace of a profiled request. Only
+# calls that get past the entity cache are seen.
+
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from os import environ as env
+
+from flask import current_app, g, request
+
+import metrics
+
+DEFAULT_INTERVAL_MS = 5
+DEFAULT_THRESHOLD = 5
+
+profile_token = env.get("PROFILE_TOKEN", "")
+sample_rate = float(env.get("PROFILE_SAMPLE_RATE", "0"))
+interval = float(env.get("PROFILE_INTERVAL_MS", str(DEFAULT_INTERVAL_MS))) / 1000.0
+profile_dir = env.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "profiles"))
+n_plus_one_threshold = int(env.get("N_PLUS_ONE_THRESHOLD", str(DEFAULT_THRESHOLD)))
+
+n_plus_one_requests = metrics.registry.add(metrics.Counter(
+    "n_plus_one_requests_total", "Requests that read one entity of a kind at a time.", ("route", "method", "kind")))
+
+# The storage calls of the request being served on this thread
+current = threading.local()
+
+
+class Sampler(object):
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+def wants_profile(request):
+    supplied = request.headers.get('X-Profile-Token')
+    if supplied is not None and profile_token:
+        return hmac.compare_digest(supplied, profile_token)
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def keys_of(target):
+    if isinstance(target, (list, tuple)):
+        return [key for item in target for key in keys_of(item)]
+    key = getattr(target, "key", target)
+    return [key] if hasattr(key, "kind") else []
+
+
+# Records the calls made by a request on its own thread
+def observe(operation, seconds, target):
+    gets = getattr(current, "gets", None)
+    if gets is None:
+        return
+    keys = keys_of(target)
+    if operation == "get" and len(keys) == 1:
+        gets[keys[0].kind] = gets.get(keys[0].kind, 0) + 1
+    trace = current.trace
+    if trace is not None:
+        kind = target if isinstance(target, str) else (keys[0].kind if keys else None)
+        trace.append({
+            "operation": operation,
+            "kind": kind,
+            "keys": [key.id_or_name for key in keys],
+            "start_ms": round((time.perf_counter() - seconds - current.started) * 1000, 3),
+            "duration_ms": round(seconds * 1000, 3),
+        })
+
+
+def start_request():
+    current.gets = {}
+    current.trace = None
+    current.started = time.perf_counter()
+    if wants_profile(request):
+        current.trace = []
+        g.profile_sampler = Sampler(threading.get_ident(), interval)
+        g.profile_sampler.start()
+
+
+def finish_request(response):
+    gets = getattr(current, "gets", None)
+    if gets is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    repeated = {kind: count for kind, count in gets.items() if count >= n_plus_one_threshold}
+    for kind, count in sorted(repeated.items()):
+        n_plus_one_requests.inc((route, request.method, kind))
+        current_app.logger.warning("N+1 reads: %s %s made %d single gets of %s", request.method, route, count, kind)
+    sampler = g.pop("profile_sampler", None)
+    if sampler is not None:
+        sampler.stop()
+        profile_id = uuid.uuid4().hex
+        write_profile(profile_id, sampler, {
+            "method": request.method,
+            "path": request.path,
+            "query": request.query_string.decode("latin-1"),
+            "route": route,
+            "status": response.status_code,
+            "duration_ms": round((time.perf_counter() - current.started) * 1000, 3),
+            "n_plus_one": [{"kind": kind, "gets": count} for kind, count in sorted(repeated.items())],
+            "calls": current.trace,
+        })
+        response.headers.set('X-Profile-Id', profile_id)
+    clear_request()
+    return response
+
+
+def clear_request(exc=None):
+    current.gets = None
+    current.trace = None
+    sampler = g.pop("profile_sampler", None)
+    if sampler is not None:
+        sampler.stop()
+
+
+def write_profile(profile_id, sampler, trace):
+    os.makedirs(profile_dir, exist_ok=True)
+    with open(os.path.join(profile_dir, profile_id + ".collapsed"), "w") as collapsed_file:
+        collapsed_file.write(sampler.collapsed())
+    with open(os.path.join(profile_dir, profile_id + ".trace.json"), "w") as trace_file:
+        json.dump(trace, trace_file, indent=2)
+
+
+def install(app):
+    metrics.rpc_observers.append(observe)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(clear_request)
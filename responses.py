@@ -0,0 +1,85 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file builds the
+# JSON responses shared by the endpoints. Error bodies are encoded once when the module is loaded, entities
+# go through a single encoder (orjson when it is installed, the standard library otherwise), and self
+# links are built from the request's root URL in one place instead of by slicing request.base_url.
+
+import json
+from urllib.parse import quote
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+
+
+# Returns the JSON encoding of value as bytes. orjson is tried first; anything it refuses (integers wider
+# than 64 bits, non-string keys) is handed to the standard library encoder.
+def encode(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(value, status=200):
+    return Response(encode(value), status=status, mimetype=JSON_MIMETYPE)
+
+
+# An error message whose body is encoded once. Calling it gives a fresh response for the handler to return.
+class Error(object):
+    def __init__(self, message):
+        self.payload = {"Error": message}
+        self.body = encode(self.payload)
+
+    def __call__(self):
+        return ErrorResponse(self)
+
+
+class ErrorResponse(Response):
+    def __init__(self, error):
+        super(ErrorResponse, self).__init__(error.body, mimetype=JSON_MIMETYPE)
+        self.payload = error.payload
+
+
+class InvalidExpand(Exception):
+    pass
+
+
+# Reads the comma separated ?expand= list. Names outside allowed are rejected rather than ignored, so a
+# typo does not silently return the unexpanded form.
+def expansions(args, allowed):
+    names = set(name.strip() for name in args.get("expand", "").split(",") if name.strip())
+    if not names <= set(allowed):
+        raise InvalidExpand()
+    return names
+
+
+# Errors returned by more than one part of the API
+missing_attribute_error = Error("The request object is missing at least one of the required attributes")
+too_many_attributes = Error("The request object has too many attributes")
+not_supported_route = Error("This method is not supported on this URL")
+json_not_accepted_in_request = Error("This MIME type is not supported by this endpoint.")
+invalid_page_request = Error("The limit, offset or cursor in the request is not valid")
+invalid_expand = Error("The expand parameter names something that cannot be expanded here")
+invalid_fields = Error("The fields parameter names an attribute that does not exist")
+version_mismatch = Error("The resource has changed since the version named in If-Match")
+
+
+# Every link in a response starts with the request's root URL, which werkzeug works out once per request
+def url_prefix():
+    return request.root_url
+
+
+def link(kind, id_or_name, prefix=None):
+    if prefix is None:
+        prefix = url_prefix()
+    if isinstance(id_or_name, int):
+        return prefix + kind + "/" + str(id_or_name)
+    return prefix + kind + "/" + quote(id_or_name, safe='')
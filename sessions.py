@@ -0,0 +1,252 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file keeps the
+# browser sessions of the login pages on the server. The session cookie holds nothing but a random session
+# id, and the data behind it (the Auth0 token saved by /callback) is kept in the store picked with
+# SESSION_STORE:
+#   memory    - a bounded LRU in this process, lost when the instance stops
+#   sqlite    - a table in the SQLite file at SQLITE_PATH
+#   datastore - entities of kind "sessions" in Cloud Datastore
+#   cookie    - Flask's signed cookie that holds the whole session, as before
+# It defaults to the STORAGE_BACKEND in use. A session is kept for the app's permanent_session_lifetime after
+# it was last written. Expired sessions are deleted SESSION_EVICT_BATCH at a time, at most once every
+# SESSION_EVICT_INTERVAL seconds, on the fan-out pool after a response that saved a session, or by
+# /admin/sessions/evict. SESSION_CACHE_SIZE sets how many sessions the memory store holds. A session gets a
+# new id when a user logs in, and the entry under the old id is deleted, so an id handed out before the login
+# cannot be used to take over the logged-in session.
+
+import json
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from os import environ as env
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import constants
+import fanout
+import storage
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_EVICT_BATCH = 100
+DEFAULT_EVICT_INTERVAL = 60
+SESSION_ID_BYTES = 32
+# The key /callback keeps the Auth0 token under
+LOGIN_KEY = "user"
+
+session_id_pattern = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, data=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super(ServerSession, self).__init__(data, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.logged_in = False
+
+    def __setitem__(self, key, value):
+        if key == LOGIN_KEY:
+            self.logged_in = True
+        super(ServerSession, self).__setitem__(key, value)
+
+
+class MemoryStore(object):
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            if self.clock() >= expires_at:
+                del self.entries[sid]
+                return None
+            self.entries.move_to_end(sid)
+            return json.loads(data)
+
+    def save(self, sid, data, expires_at):
+        with self.lock:
+            self.entries[sid] = (expires_at, json.dumps(data))
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    # Deletes up to limit sessions that have expired and returns how many went
+    def evict(self, now, limit):
+        with self.lock:
+            expired = []
+            for sid, (expires_at, data) in self.entries.items():
+                if expires_at <= now:
+                    expired.append(sid)
+                    if len(expired) >= limit:
+                        break
+            for sid in expired:
+                del self.entries[sid]
+        return len(expired)
+
+
+# Sessions get their own table, indexed on the expiry time so each batch of evictions is a range scan
+class SQLiteStore(object):
+    def __init__(self, path=storage.DEFAULT_SQLITE_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            if path != ":memory:":
+                self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                                    "expires REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def execute(self, statement, parameters=()):
+        with self.lock:
+            return self.connection.execute(statement, parameters)
+
+    def load(self, sid):
+        row = self.execute("SELECT data FROM sessions WHERE id = ? AND expires > ?", (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save(self, sid, data, expires_at):
+        self.execute("INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+                     (sid, json.dumps(data), expires_at))
+
+    def delete(self, sid):
+        self.execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def evict(self, now, limit):
+        return self.execute("DELETE FROM sessions WHERE id IN (SELECT id FROM sessions WHERE expires <= ? LIMIT ?)",
+                            (now, limit)).rowcount
+
+
+# Talks to Datastore directly rather than through the storage layer, which only has equality filters and
+# would put every session into the entity cache. It uses the storage backend's client when that is Datastore
+# too, so the instance keeps one connection pool. The data is one unindexed JSON string; the
+# single-property index on expires that Datastore builds on its own is enough for the eviction query.
+class DatastoreStore(object):
+    def __init__(self, client=None):
+        from google.cloud import datastore
+        self.datastore = datastore
+        if client is None:
+            client = storage.datastore_client()
+        self.client = client if client is not None else datastore.Client()
+
+    def load(self, sid):
+        entity = self.client.get(self.client.key(constants.sessions, sid))
+        if entity is None or entity["expires"] <= time.time():
+            return None
+        return json.loads(entity["data"])
+
+    def save(self, sid, data, expires_at):
+        entity = self.datastore.Entity(key=self.client.key(constants.sessions, sid), exclude_from_indexes=("data",))
+        entity.update({"data": json.dumps(data), "expires": expires_at})
+        self.client.put(entity)
+
+    def delete(self, sid):
+        self.client.delete(self.client.key(constants.sessions, sid))
+
+    def evict(self, now, limit):
+        query = self.client.query(kind=constants.sessions)
+        query.add_filter("expires", "<=", now)
+        query.keys_only()
+        keys = [entity.key for entity in query.fetch(limit=limit)]
+        if len(keys) != 0:
+            self.client.delete_multi(keys)
+        return len(keys)
+
+
+STORES = {
+    "memory": lambda: MemoryStore(int(env.get("SESSION_CACHE_SIZE", str(DEFAULT_CACHE_SIZE)))),
+    "sqlite": lambda: SQLiteStore(env.get("SQLITE_PATH", storage.DEFAULT_SQLITE_PATH)),
+    "datastore": DatastoreStore,
+}
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store_factory, evict_batch=DEFAULT_EVICT_BATCH, evict_interval=DEFAULT_EVICT_INTERVAL,
+                 clock=time.time):
+        self.store_factory = store_factory
+        self.store_instance = None
+        self.store_lock = threading.Lock()
+        self.evict_batch = evict_batch
+        self.evict_interval = evict_interval
+        self.clock = clock
+        self.next_eviction = 0
+        self.eviction_lock = threading.Lock()
+
+    # Built on first use, so an instance that serves only the API never opens the store
+    @property
+    def store(self):
+        if self.store_instance is None:
+            with self.store_lock:
+                if self.store_instance is None:
+                    self.store_instance = self.store_factory()
+        return self.store_instance
+
+    # Requests without a session cookie, as API clients send them, never touch the store
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid is None or not session_id_pattern.match(sid):
+            return ServerSession()
+        data = self.store.load(sid)
+        if data is None:
+            return ServerSession()
+        return ServerSession(data, sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app))
+            return
+        if not session.modified:
+            return
+        if session.sid is None or session.logged_in:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(SESSION_ID_BYTES)
+            session.logged_in = False
+        now = self.clock()
+        self.store.save(session.sid, dict(session), now + app.permanent_session_lifetime.total_seconds())
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+        response.vary.add("Cookie")
+        if now >= self.next_eviction:
+            with self.eviction_lock:
+                if now >= self.next_eviction:
+                    self.next_eviction = now + self.evict_interval
+                    fanout.submit(self.evict, now)
+
+    # Deletes one batch of expired sessions. Returns how many were deleted.
+    def evict(self, now=None):
+        return self.store.evict(self.clock() if now is None else now, self.evict_batch)
+
+
+# Replaces the app's cookie sessions with the store named by SESSION_STORE, unless that is "cookie"
+def install(app):
+    name = env.get("SESSION_STORE", env.get("STORAGE_BACKEND", storage.DEFAULT_BACKEND)).lower()
+    if name == "cookie":
+        return
+    if name not in STORES:
+        raise ValueError("Unknown SESSION_STORE " + repr(name))
+    app.session_interface = ServerSessionInterface(
+        STORES[name], int(env.get("SESSION_EVICT_BATCH", str(DEFAULT_EVICT_BATCH))),
+        float(env.get("SESSION_EVICT_INTERVAL", str(DEFAULT_EVICT_INTERVAL))))
@@ -0,0 +1,659 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file is the storage
+# layer used by every blueprint. It offers get/get_multi/put/put_multi/delete/delete_multi, queries with
+# equality filters, limits and cursors, and transactions. There are three backends:
+#   datastore - Google Cloud Datastore (the default, used on App Engine)
+#   memory    - a thread-safe in-process store for local load tests
+#   sqlite    - a single file database for small single-node deployments
+# The backend is picked with the STORAGE_BACKEND environment variable. SQLITE_PATH sets the database file.
+
+import base64
+import binascii
+import bisect
+import itertools
+import json
+import sqlite3
+import threading
+from os import environ as env
+
+DEFAULT_BACKEND = "datastore"
+DEFAULT_SQLITE_PATH = "marina.db"
+DEFAULT_RETRIES = 3
+SCAN_BATCH_SIZE = 500
+# Properties that get an index in the SQLite backend
+SQLITE_INDEXED_PROPERTIES = ("owner", "name", "carrier", "carrier.id")
+
+
+# The after_commit callbacks of the transaction being run on this thread
+commit_state = threading.local()
+
+
+# Runs callback once the transaction that run_in_transaction is running on this thread has committed, or
+# straight away outside of one. Nothing is run for an attempt that fails or is retried.
+def after_commit(callback):
+    callbacks = getattr(commit_state, "callbacks", None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Conflict(Exception):
+    pass
+
+
+class Key(object):
+    __slots__ = ("kind", "id", "name")
+
+    def __init__(self, kind, id_or_name=None):
+        self.kind = kind
+        self.id = id_or_name if isinstance(id_or_name, int) else None
+        self.name = id_or_name if isinstance(id_or_name, str) else None
+
+    @property
+    def id_or_name(self):
+        return self.id if self.id is not None else self.name
+
+    @property
+    def is_partial(self):
+        return self.id is None and self.name is None
+
+    def completed_key(self, id):
+        return Key(self.kind, id)
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and (self.kind, self.id, self.name) == (other.kind, other.id, other.name)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.kind, self.id, self.name))
+
+    def __repr__(self):
+        return "Key(%r, %r)" % (self.kind, self.id_or_name)
+
+
+class Entity(dict):
+    def __init__(self, key=None):
+        super(Entity, self).__init__()
+        self.key = key
+
+
+# Entity values are plain JSON types, so a recursive copy is all the isolation we need
+def clone(value):
+    if isinstance(value, dict):
+        return {name: clone(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [clone(item) for item in value]
+    return value
+
+
+# Keys sort the way Datastore orders them: numeric ids first, then names
+def sort_key(key):
+    if key.id is not None:
+        return "i%020d" % key.id
+    return "n" + key.name
+
+
+def key_from_sort_key(kind, encoded):
+    if encoded[0] == "i":
+        return Key(kind, int(encoded[1:]))
+    return Key(kind, encoded[1:])
+
+
+def encode_cursor(encoded_key):
+    return base64.urlsafe_b64encode(encoded_key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        encoded_key = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not encoded_key or encoded_key[0] not in ("i", "n"):
+        raise InvalidCursor(cursor)
+    return encoded_key
+
+
+def property_value(data, name):
+    value = data
+    for part in name.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def matches(data, filters):
+    for name, op, value in filters:
+        if op != "=":
+            raise ValueError("Only equality filters are supported")
+        if property_value(data, name) != value:
+            return False
+    return True
+
+
+def project(entity, keys_only, projection):
+    if keys_only:
+        entity.clear()
+    elif projection:
+        for name in list(entity):
+            if name not in projection:
+                del entity[name]
+    return entity
+
+
+class Backend(object):
+    name = None
+    conflict_errors = (Conflict,)
+
+    def key(self, kind, id_or_name=None):
+        return Key(kind, id_or_name)
+
+    def entity(self, key):
+        return Entity(key=key)
+
+    def get(self, key):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    # Hands out complete keys before anything is stored, for writes that need a new entity's id up front
+    def allocate_keys(self, kind, count):
+        return [self.key(kind, self.allocate_id(kind)) for _ in range(count)]
+
+    # Returns (entities, next_cursor). next_cursor is None once there is nothing after this page.
+    # filters is a list of (property, "=", value); dotted names reach into embedded entities.
+    def query(self, kind, filters=(), limit=None, offset=0, cursor=None, keys_only=False, projection=None):
+        raise NotImplementedError
+
+    # Walks every entity that matches, SCAN_BATCH_SIZE at a time
+    def iterate(self, kind, filters=(), keys_only=False, projection=None, batch_size=SCAN_BATCH_SIZE):
+        cursor = None
+        while True:
+            results, cursor = self.query(kind, filters, limit=batch_size, cursor=cursor,
+                                         keys_only=keys_only, projection=projection)
+            for entity in results:
+                yield entity
+            if cursor is None:
+                return
+
+    # work() is called with no arguments; every get/put/delete it makes joins the transaction.
+    # The work is retried when the backend reports that it lost a race with another writer. Callbacks
+    # registered with after_commit during the attempt that commits are run once it has committed.
+    def run_in_transaction(self, work, retries=DEFAULT_RETRIES):
+        if getattr(commit_state, "callbacks", None) is not None:
+            with self.transaction():
+                return work()
+        attempt = 0
+        while True:
+            commit_state.callbacks = []
+            try:
+                with self.transaction():
+                    result = work()
+                callbacks = commit_state.callbacks
+            except self.conflict_errors:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                continue
+            finally:
+                commit_state.callbacks = None
+            for callback in callbacks:
+                callback()
+            return result
+
+
+# Base class for layers that sit in front of another backend, such as the entity cache. Everything is
+# passed through unless the subclass overrides it.
+class BackendWrapper(Backend):
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.conflict_errors = backend.conflict_errors
+
+    def key(self, kind, id_or_name=None):
+        return self.backend.key(kind, id_or_name)
+
+    def entity(self, key):
+        return self.backend.entity(key)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def get_multi(self, keys):
+        return self.backend.get_multi(keys)
+
+    def put(self, entity):
+        self.backend.put(entity)
+
+    def put_multi(self, entities):
+        self.backend.put_multi(entities)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def delete_multi(self, keys):
+        self.backend.delete_multi(keys)
+
+    def allocate_keys(self, kind, count):
+        return self.backend.allocate_keys(kind, count)
+
+    def query(self, kind, filters=(), limit=None, offset=0, cursor=None, keys_only=False, projection=None):
+        return self.backend.query(kind, filters, limit=limit, offset=offset, cursor=cursor, keys_only=keys_only,
+                                  projection=projection)
+
+    def iterate(self, kind, filters=(), keys_only=False, projection=None, batch_size=SCAN_BATCH_SIZE):
+        return self.backend.iterate(kind, filters, keys_only=keys_only, projection=projection,
+                                    batch_size=batch_size)
+
+    def transaction(self):
+        return self.backend.transaction()
+
+
+class DatastoreBackend(Backend):
+    name = "datastore"
+
+    def __init__(self, client=None):
+        from google.api_core import exceptions
+        from google.cloud import datastore
+        self.datastore = datastore
+        self.client = client if client is not None else datastore.Client()
+        self.conflict_errors = (exceptions.Conflict, exceptions.Aborted)
+        self.cursor_errors = (ValueError, TypeError, exceptions.InvalidArgument, exceptions.BadRequest)
+
+    def key(self, kind, id_or_name=None):
+        if id_or_name is None:
+            return self.client.key(kind)
+        return self.client.key(kind, id_or_name)
+
+    def entity(self, key):
+        return self.datastore.entity.Entity(key=key)
+
+    def get(self, key):
+        return self.client.get(key=key)
+
+    def get_multi(self, keys):
+        if len(keys) == 0:
+            return []
+        return self.client.get_multi(keys)
+
+    def put(self, entity):
+        self.client.put(entity)
+
+    def put_multi(self, entities):
+        if len(entities) != 0:
+            self.client.put_multi(entities)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_multi(self, keys):
+        if len(keys) != 0:
+            self.client.delete_multi(keys)
+
+    def allocate_keys(self, kind, count):
+        if count == 0:
+            return []
+        return self.client.allocate_ids(self.client.key(kind), count)
+
+    def build_query(self, kind, filters, keys_only, projection):
+        query = self.client.query(kind=kind)
+        for name, op, value in filters:
+            query.add_filter(name, op, value)
+        if keys_only:
+            query.keys_only()
+        elif projection:
+            query.projection = list(projection)
+        return query
+
+    def query(self, kind, filters=(), limit=None, offset=0, cursor=None, keys_only=False, projection=None):
+        query = self.build_query(kind, filters, keys_only, projection)
+        if cursor:
+            iterator = query.fetch(limit=limit, start_cursor=cursor)
+        else:
+            iterator = query.fetch(limit=limit, offset=offset)
+        try:
+            if limit is None:
+                return list(iterator), None
+            results = list(next(iterator.pages, []))
+        except self.cursor_errors:
+            if cursor:
+                raise InvalidCursor(cursor)
+            raise
+        # Datastore may send back a short batch when it stops at a scan limit, so the end of the results is
+        # taken only from the iterator, which drops its page token once there are no more
+        next_cursor = iterator.next_page_token
+        if isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode("ascii")
+        return results, next_cursor
+
+    # The Datastore iterator already pages through the results on its own
+    def iterate(self, kind, filters=(), keys_only=False, projection=None, batch_size=SCAN_BATCH_SIZE):
+        return iter(self.build_query(kind, filters, keys_only, projection).fetch())
+
+    def transaction(self):
+        return self.client.transaction()
+
+
+class MemoryTransaction(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        backend = self.backend
+        backend.lock.acquire()
+        if backend.depth == 0:
+            backend.undo = []
+        backend.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        backend = self.backend
+        try:
+            backend.depth -= 1
+            if backend.depth == 0:
+                if exc_type is not None:
+                    for kind, encoded, previous in reversed(backend.undo):
+                        backend.store(kind, encoded, previous)
+                backend.undo = None
+        finally:
+            backend.lock.release()
+        return False
+
+
+# Everything lives in dicts guarded by one re-entrant lock. A transaction holds the lock until it finishes,
+# so transactions are serialized and a failed one is rolled back from its undo log.
+class MemoryBackend(Backend):
+    name = "memory"
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.kinds = {}
+        self.sorted_keys = {}
+        self.next_ids = {}
+        self.undo = None
+        self.depth = 0
+
+    def transaction(self):
+        return MemoryTransaction(self)
+
+    def allocate_id(self, kind):
+        counter = self.next_ids.get(kind)
+        if counter is None:
+            counter = self.next_ids[kind] = itertools.count(1)
+        return next(counter)
+
+    # Writes one value (None removes it) and keeps the sorted key list in step
+    def store(self, kind, encoded, data):
+        entities = self.kinds.setdefault(kind, {})
+        keys = self.sorted_keys.setdefault(kind, [])
+        if data is None:
+            if entities.pop(encoded, None) is not None:
+                del keys[bisect.bisect_left(keys, encoded)]
+            return
+        if encoded not in entities:
+            bisect.insort(keys, encoded)
+        entities[encoded] = data
+
+    def write(self, kind, encoded, data):
+        if self.undo is not None:
+            self.undo.append((kind, encoded, self.kinds.get(kind, {}).get(encoded)))
+        self.store(kind, encoded, data)
+
+    def load(self, key, data):
+        entity = Entity(key=key)
+        entity.update(clone(data))
+        return entity
+
+    def get_multi(self, keys):
+        with self.lock:
+            found = []
+            for key in keys:
+                data = self.kinds.get(key.kind, {}).get(sort_key(key))
+                if data is not None:
+                    found.append(self.load(key, data))
+            return found
+
+    def put_multi(self, entities):
+        with self.lock:
+            for entity in entities:
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(self.allocate_id(entity.key.kind))
+                self.write(entity.key.kind, sort_key(entity.key), clone(dict(entity)))
+
+    def delete_multi(self, keys):
+        with self.lock:
+            for key in keys:
+                self.write(key.kind, sort_key(key), None)
+
+    def query(self, kind, filters=(), limit=None, offset=0, cursor=None, keys_only=False, projection=None):
+        with self.lock:
+            entities = self.kinds.get(kind, {})
+            keys = self.sorted_keys.get(kind, [])
+            start = bisect.bisect_right(keys, decode_cursor(cursor)) if cursor else 0
+            results = []
+            skipped = 0
+            last = None
+            more = False
+            for position in range(start, len(keys)):
+                encoded = keys[position]
+                data = entities[encoded]
+                if not matches(data, filters):
+                    continue
+                if skipped < offset:
+                    skipped += 1
+                    last = encoded
+                    continue
+                if limit is not None and len(results) == limit:
+                    more = True
+                    break
+                results.append(project(self.load(key_from_sort_key(kind, encoded), data), keys_only, projection))
+                last = encoded
+            next_cursor = encode_cursor(last) if more else None
+            return results, next_cursor
+
+
+# One connection shared by all threads and guarded by a re-entrant lock. Entities are stored as JSON with
+# expression indexes on the properties the blueprints filter on.
+class SQLiteBackend(Backend):
+    name = "sqlite"
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            if path != ":memory:":
+                self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entities (kind TEXT NOT NULL, key TEXT NOT NULL, "
+                                    "data TEXT NOT NULL, PRIMARY KEY (kind, key)) WITHOUT ROWID")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS ids (kind TEXT PRIMARY KEY, "
+                                    "next_id INTEGER NOT NULL)")
+            for name in SQLITE_INDEXED_PROPERTIES:
+                self.connection.execute("CREATE INDEX IF NOT EXISTS entities_%s ON entities (kind, %s, key)"
+                                        % (name.replace(".", "_"), self.column(name)))
+
+    @staticmethod
+    def column(name):
+        return "json_extract(data, '$.%s')" % name
+
+    def transaction(self):
+        return SQLiteTransaction(self)
+
+    # Runs a statement on its own unless a transaction is already open on this thread
+    def execute(self, statement, parameters=()):
+        with self.lock:
+            return self.connection.execute(statement, parameters)
+
+    def allocate_id(self, kind):
+        with self.transaction():
+            row = self.execute("SELECT next_id FROM ids WHERE kind = ?", (kind,)).fetchone()
+            next_id = row[0] if row else 1
+            self.execute("INSERT OR REPLACE INTO ids (kind, next_id) VALUES (?, ?)", (kind, next_id + 1))
+            return next_id
+
+    def get_multi(self, keys):
+        found = []
+        with self.lock:
+            for key in keys:
+                row = self.execute("SELECT data FROM entities WHERE kind = ? AND key = ?",
+                                   (key.kind, sort_key(key))).fetchone()
+                if row is not None:
+                    entity = Entity(key=key)
+                    entity.update(json.loads(row[0]))
+                    found.append(entity)
+        return found
+
+    def put_multi(self, entities):
+        with self.transaction():
+            for entity in entities:
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(self.allocate_id(entity.key.kind))
+                self.execute("INSERT OR REPLACE INTO entities (kind, key, data) VALUES (?, ?, ?)",
+                             (entity.key.kind, sort_key(entity.key), json.dumps(dict(entity))))
+
+    def delete_multi(self, keys):
+        with self.transaction():
+            for key in keys:
+                self.execute("DELETE FROM entities WHERE kind = ? AND key = ?", (key.kind, sort_key(key)))
+
+    def query(self, kind, filters=(), limit=None, offset=0, cursor=None, keys_only=False, projection=None):
+        clauses = ["kind = ?"]
+        parameters = [kind]
+        for name, op, value in filters:
+            if op != "=":
+                raise ValueError("Only equality filters are supported")
+            if value is None:
+                clauses.append(self.column(name) + " IS NULL")
+            else:
+                clauses.append(self.column(name) + " = ?")
+                parameters.append(value)
+        if cursor:
+            clauses.append("key > ?")
+            parameters.append(decode_cursor(cursor))
+        statement = "SELECT key, data FROM entities WHERE " + " AND ".join(clauses) + " ORDER BY key"
+        if limit is not None:
+            statement += " LIMIT ? OFFSET ?"
+            parameters.extend([limit + 1, offset])
+        elif offset:
+            statement += " LIMIT -1 OFFSET ?"
+            parameters.append(offset)
+        rows = self.execute(statement, parameters).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][0]) if rows else None
+        results = []
+        for encoded, data in rows:
+            entity = Entity(key=key_from_sort_key(kind, encoded))
+            entity.update(json.loads(data))
+            results.append(project(entity, keys_only, projection))
+        return results, next_cursor
+
+
+# Another process holding the database file is the SQLite version of losing a race with another writer
+def raise_if_locked(error):
+    if "locked" in str(error) or "busy" in str(error):
+        raise Conflict(str(error))
+
+
+class SQLiteTransaction(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        backend = self.backend
+        backend.lock.acquire()
+        if backend.depth == 0:
+            try:
+                backend.connection.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as error:
+                backend.lock.release()
+                raise_if_locked(error)
+                raise
+            except Exception:
+                backend.lock.release()
+                raise
+        backend.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        backend = self.backend
+        try:
+            backend.depth -= 1
+            if backend.depth == 0:
+                if exc_type is None:
+                    try:
+                        backend.connection.execute("COMMIT")
+                    except sqlite3.OperationalError as error:
+                        backend.connection.execute("ROLLBACK")
+                        raise_if_locked(error)
+                        raise
+                else:
+                    backend.connection.execute("ROLLBACK")
+        finally:
+            backend.lock.release()
+        return False
+
+
+BACKENDS = {
+    "datastore": DatastoreBackend,
+    "memory": MemoryBackend,
+    "sqlite": lambda: SQLiteBackend(env.get("SQLITE_PATH", DEFAULT_SQLITE_PATH)),
+}
+
+backend = None
+backend_lock = threading.Lock()
+
+
+# Stands in for the shared backend at import time, so that importing a blueprint does not create a
+# Datastore client. The backend is built on first use, and every attribute read through here is kept on
+# the instance, so later calls go straight to the backend.
+class LazyBackend(object):
+    def __getattr__(self, name):
+        attribute = getattr(load_backend(), name)
+        self.__dict__[name] = attribute
+        return attribute
+
+
+shared = LazyBackend()
+
+
+# Every blueprint shares the one backend picked by STORAGE_BACKEND, built when it is first used
+def get_backend():
+    return shared
+
+
+# The google.cloud.datastore client of the shared backend, or None when it is not the Datastore backend
+def datastore_client():
+    layer = load_backend()
+    while isinstance(layer, BackendWrapper):
+        layer = layer.backend
+    return layer.client if isinstance(layer, DatastoreBackend) else None
+
+
+# Builds the shared backend behind the entity cache. The calls that get past the cache are timed for /metrics.
+def load_backend():
+    global backend
+    if backend is None:
+        with backend_lock:
+            if backend is None:
+                import entity_cache
+                import metrics
+                name = env.get("STORAGE_BACKEND", DEFAULT_BACKEND).lower()
+                if name not in BACKENDS:
+                    raise ValueError("Unknown STORAGE_BACKEND " + repr(name))
+                backend = entity_cache.from_environment(metrics.MetricsBackend(BACKENDS[name]()))
+    return backend
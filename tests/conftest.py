@@ -0,0 +1,69 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file sets up the
+# tests. They run against the in-memory storage backend, and tokens are signed with a key made for the test
+# run and served by a stand-in for the Auth0 JWKS endpoint, so nothing needs network access.
+
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("ENTITY_CACHE_SHARED", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+rsa = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.rsa")
+from cryptography.hazmat.primitives import serialization
+from jose import jwk, jwt
+
+KID = "test-key"
+
+
+@pytest.fixture(scope="session")
+def signing_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption())
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    public.update(kid=KID, use="sig")
+    return pem, public
+
+
+@pytest.fixture(scope="session")
+def app(signing_key):
+    import auth
+    import main
+    auth.jwks_store.fetch = lambda url: ({"keys": [signing_key[1]]}, "max-age=600")
+    return main.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# Returns the headers of a JSON request from the given user
+@pytest.fixture
+def headers_for(app, signing_key):
+    import auth
+
+    def headers_for(sub):
+        now = int(time.time())
+        token = jwt.encode({"sub": sub, "aud": auth.CLIENT_ID, "iss": "https://" + auth.DOMAIN + "/",
+                            "iat": now, "exp": now + 3600}, signing_key[0], algorithm="RS256",
+                           headers={"kid": KID})
+        return {"Authorization": "Bearer " + token, "Accept": "application/json"}
+    return headers_for
+
+
+# A user nobody else in the test run uses, since the app's storage lives for the whole run
+@pytest.fixture
+def owner():
+    return "auth0|" + uuid.uuid4().hex
+
+
+@pytest.fixture
+def headers(headers_for, owner):
+    return headers_for(owner)
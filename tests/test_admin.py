@@ -0,0 +1,31 @@
+import pytest
+
+
+@pytest.fixture
+def admin_env(monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "admin-secret")
+    monkeypatch.delenv("GAE_ENV", raising=False)
+    monkeypatch.delenv("GAE_APPLICATION", raising=False)
+    return monkeypatch
+
+
+def test_admin_token_is_required(client, admin_env):
+    assert client.get("/admin/stats").status_code == 403
+    assert client.get("/admin/stats", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/admin/stats", headers={"X-Admin-Token": "admin-secret"}).status_code == 200
+
+
+def test_cron_header_is_ignored_off_app_engine(client, admin_env):
+    assert client.get("/admin/stats", headers={"X-Appengine-Cron": "true"}).status_code == 403
+
+
+def test_cron_header_is_trusted_on_app_engine(client, admin_env):
+    admin_env.setenv("GAE_ENV", "standard")
+    assert client.get("/admin/stats", headers={"X-Appengine-Cron": "true"}).status_code == 200
+
+
+def test_counter_rebuild_reports_the_totals(client, admin_env):
+    response = client.post("/admin/counters/rebuild", headers={"X-Admin-Token": "admin-secret"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/json"
+    assert set(response.get_json()) == {"boats", "loads"}
@@ -0,0 +1,78 @@
+import pytest
+from flask import request
+from jose import jwt
+
+import admission
+import auth
+
+
+def token_of(headers):
+    return headers["Authorization"].split()[1]
+
+
+@pytest.fixture
+def list_gate(monkeypatch):
+    gate = admission.gates[admission.LIST]
+    monkeypatch.setattr(gate, "limit", 2)
+    monkeypatch.setattr(gate, "queue_size", 0)
+    monkeypatch.setattr(gate, "in_flight", 0)
+    return gate
+
+
+def test_full_class_is_turned_away_with_retry_after(client, headers, list_gate):
+    list_gate.limit = 1
+    assert list_gate.acquire()
+    try:
+        response = client.get("/loads", headers=headers)
+    finally:
+        list_gate.release()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(admission.retry_after)
+    assert client.get("/loads", headers=headers).status_code == 200
+
+
+def test_owner_over_its_rate_is_turned_away_while_the_class_is_busy(client, headers, headers_for, owner,
+                                                                     list_gate, monkeypatch):
+    monkeypatch.setattr(admission.owners, "rate", 0.01)
+    monkeypatch.setattr(admission.owners, "burst", 2)
+    auth.verify_token(token_of(headers))
+    # Half full: owners with an empty bucket are turned away
+    list_gate.in_flight = 1
+    assert [client.get("/loads", headers=headers).status_code for _ in range(2)] == [200, 200]
+    response = client.get("/loads", headers=headers)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    other = headers_for(owner + "-other")
+    auth.verify_token(token_of(other))
+    assert client.get("/loads", headers=other).status_code == 200
+    # A quiet class lets the busy owner through
+    list_gate.in_flight = 0
+    assert client.get("/loads", headers=headers).status_code == 200
+
+
+def test_streamed_export_holds_its_slot_until_closed(client, headers, list_gate):
+    response = client.post("/loads", json={"volume": 5, "item": "Crate", "creation_date": "1/1/2022"},
+                           headers=headers)
+    assert response.status_code == 201
+    response = client.get("/loads/export", headers=headers)
+    assert list_gate.in_flight == 1
+    response.get_data()
+    response.close()
+    assert list_gate.in_flight == 0
+
+
+def test_only_verified_tokens_name_the_owner(app, headers, owner):
+    with app.test_request_context("/loads", headers=headers, environ_base={"REMOTE_ADDR": "1.2.3.4"}):
+        assert admission.owner_of(request) == "address:1.2.3.4"
+    auth.verify_token(token_of(headers))
+    stats = auth.payload_cache.stats()
+    with app.test_request_context("/loads", headers=headers):
+        assert admission.owner_of(request) == owner
+    # A token nobody verified counts against the address, whatever "sub" it claims
+    forged = jwt.encode({"sub": owner}, "not the key", algorithm="HS256")
+    with app.test_request_context("/loads", headers={"Authorization": "Bearer " + forged},
+                                  environ_base={"REMOTE_ADDR": "1.2.3.4"}):
+        assert admission.owner_of(request) == "address:1.2.3.4"
+    # Looking up the owner is not counted as a cache hit or miss
+    after = auth.payload_cache.stats()
+    assert (after["hits"], after["misses"]) == (stats["hits"], stats["misses"])
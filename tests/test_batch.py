@@ -0,0 +1,84 @@
+import pytest
+
+import batch
+
+LOAD = {"volume": 5, "item": "Crate", "creation_date": "1/1/2022"}
+# No entity is ever given this id
+MISSING = 2 ** 62
+
+
+def statuses(response):
+    return [result["status"] for result in response.get_json()["results"]]
+
+
+def create_loads(client, headers, count):
+    response = client.post("/loads:batch", json=[dict(LOAD, volume=index) for index in range(count)],
+                           headers=headers)
+    assert response.status_code == 200
+    return [result["id"] for result in response.get_json()["results"]]
+
+
+def test_load_batch_reports_every_item(client, headers):
+    response = client.post("/loads:batch", json=[LOAD, {"volume": 1}, LOAD], headers=headers)
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [result["status"] for result in results] == [201, 400, 201]
+    assert "Error" in results[1]
+    assert results[0]["self"].endswith("/loads/%d" % results[0]["id"])
+    load_id = results[0]["id"]
+    response = client.patch("/loads:batch", json=[{"id": load_id, "item": "Barrel"}, {"id": load_id, "item": "Box"},
+                                                  {"id": "x"}, {"id": MISSING, "item": "Box"}], headers=headers)
+    assert statuses(response) == [204, 400, 400, 404]
+    assert client.get("/loads/%d" % load_id, headers=headers).get_json()["item"] == "Barrel"
+    response = client.delete("/loads:batch", json=[load_id, load_id], headers=headers)
+    assert statuses(response) == [204, 400]
+    assert client.get("/loads/%d" % load_id, headers=headers).status_code == 404
+
+
+def test_boat_batch_reports_every_item(client, headers, headers_for, owner):
+    response = client.post("/boats:batch", json=[{"name": owner + " a", "type": "Yacht", "length": 20},
+                                                 {"name": owner + " A", "type": "Yacht", "length": 20},
+                                                 {"name": owner + " b"}], headers=headers)
+    assert statuses(response) == [201, 403, 400]
+    boat_id = response.get_json()["results"][0]["id"]
+    other = headers_for(owner + "-other")
+    response = client.patch("/boats:batch", json=[{"id": boat_id, "length": 30}], headers=other)
+    assert statuses(response) == [403]
+    response = client.patch("/boats:batch", json=[{"id": boat_id, "length": 30}], headers=headers)
+    assert statuses(response) == [204]
+    response = client.delete("/boats:batch", json=[boat_id, MISSING], headers=headers)
+    assert statuses(response) == [204, 404]
+
+
+def test_loads_are_assigned_to_a_boat_item_by_item(client, headers, headers_for, owner):
+    boat_id = client.post("/boats", json={"name": owner, "type": "Yacht", "length": 20},
+                          headers=headers).get_json()["id"]
+    load_ids = create_loads(client, headers, 3)
+    response = client.post("/boats/%d/loads" % boat_id, json=load_ids[:2] + [MISSING], headers=headers)
+    assert statuses(response) == [204, 204, 404]
+    # A load already on a boat stays there
+    response = client.post("/boats/%d/loads" % boat_id, json=load_ids[1:], headers=headers)
+    assert statuses(response) == [403, 204]
+    loads = client.get("/boats/%d" % boat_id, headers=headers).get_json()["loads"]
+    assert sorted(load["id"] for load in loads) == sorted(load_ids)
+    response = client.post("/boats/%d/loads" % boat_id, json=load_ids, headers=headers_for(owner + "-other"))
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize("body", [[], {}, [LOAD] * (batch.MAX_BATCH_SIZE + 1)])
+def test_batch_must_be_a_non_empty_array(client, headers, body):
+    assert client.post("/loads:batch", json=body, headers=headers).status_code == 400
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/boats/%d", {"name": "Sea Breeze", "type": "Yacht", "length": 20}),
+    ("/loads/%d", LOAD),
+])
+def test_put_checks_the_body_like_a_create(client, headers, owner, path, body):
+    kind = path.split("/")[1]
+    if kind == "boats":
+        body = dict(body, name=owner)
+    entity_id = client.post("/" + kind, json=body, headers=headers).get_json()["id"]
+    for bad in ({"a": 1, "b": 2, "c": 3}, {"a": 1}, [1, 2, 3]):
+        assert client.put(path % entity_id, json=bad, headers=headers).status_code == 400
+    assert client.get(path % entity_id, headers=headers).headers["ETag"] == '"1"'
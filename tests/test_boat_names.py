@@ -0,0 +1,78 @@
+import pytest
+
+import boat_names
+import constants
+import storage
+
+
+@pytest.fixture
+def backend():
+    return storage.MemoryBackend()
+
+
+def new_boat(backend, name, owner="auth0|a"):
+    boat = backend.entity(backend.key(constants.boats))
+    boat.update({"name": name, "owner": owner, "loads": []})
+    backend.put(boat)
+    return boat
+
+
+def test_names_are_normalized():
+    assert boat_names.normalize("  Sea   BREEZE ") == boat_names.normalize("sea breeze")
+
+
+def test_reservation_keys_of_long_names_fit(backend):
+    key = boat_names.reservation_key(backend, "x" * 5000)
+    assert len(key.name.encode("utf-8")) <= boat_names.MAX_KEY_NAME_LENGTH
+
+
+def test_a_name_is_held_by_one_boat(backend):
+    first = backend.key(constants.boats, 1)
+    second = backend.key(constants.boats, 2)
+    assert backend.run_in_transaction(lambda: boat_names.claim(backend, "Sea Breeze", first))
+    assert not backend.run_in_transaction(lambda: boat_names.claim(backend, "sea  breeze", second))
+    # Claiming its own name again is fine
+    assert backend.run_in_transaction(lambda: boat_names.claim(backend, "Sea Breeze", first))
+
+
+def test_rename_frees_the_old_name(backend):
+    first = backend.key(constants.boats, 1)
+    second = backend.key(constants.boats, 2)
+    backend.run_in_transaction(lambda: boat_names.claim(backend, "Old", first))
+    backend.run_in_transaction(lambda: boat_names.claim(backend, "Taken", second))
+    assert not backend.run_in_transaction(lambda: boat_names.rename(backend, "Old", "Taken", first))
+    assert backend.run_in_transaction(lambda: boat_names.rename(backend, "Old", "New", first))
+    assert backend.run_in_transaction(lambda: boat_names.claim(backend, "Old", second))
+
+
+def test_release_leaves_other_boats_reservations(backend):
+    boat = new_boat(backend, "Shared")
+    other = backend.key(constants.boats, boat.key.id + 1)
+    backend.run_in_transaction(lambda: boat_names.claim(backend, "Shared", other))
+    backend.run_in_transaction(lambda: boat_names.release(backend, [boat]))
+    assert backend.get(boat_names.reservation_key(backend, "Shared"))["boat_id"] == other.id
+
+
+def test_rebuild_keeps_the_oldest_of_duplicate_names(backend):
+    first = new_boat(backend, "Twin")
+    second = new_boat(backend, "twin")
+    stale = backend.key(constants.boats, 999)
+    backend.run_in_transaction(lambda: boat_names.claim(backend, "Gone", stale))
+    report = boat_names.rebuild(backend)
+    assert report == {"reserved": 1, "released": 1, "duplicates": [second.key.id]}
+    assert backend.get(boat_names.reservation_key(backend, "Twin"))["boat_id"] == first.key.id
+
+
+def test_api_holds_a_name_until_the_boat_is_deleted(client, headers, headers_for, owner):
+    response = client.post("/boats", json={"name": "%s 0" % owner, "type": "Yacht", "length": 20}, headers=headers)
+    assert response.status_code == 201
+    boat_id = response.get_json()["id"]
+    # Another user cannot take a name in use, whatever its case or spacing
+    response = client.post("/boats", json={"name": " %s  0 " % owner.upper(), "type": "Yacht", "length": 20},
+                           headers=headers_for(owner + "-other"))
+    assert response.status_code == 403
+    assert client.delete("/boats/%d" % boat_id, headers=headers).status_code == 204
+    # A deleted boat's name is free again
+    response = client.post("/boats", json={"name": "%s 0" % owner, "type": "Yacht", "length": 20},
+                           headers=headers_for(owner + "-other"))
+    assert response.status_code == 201
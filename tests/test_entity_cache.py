@@ -0,0 +1,91 @@
+import pytest
+
+import entity_cache
+import storage
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def backend():
+    return storage.MemoryBackend()
+
+
+def new_boat(backend, name="Sea Breeze"):
+    boat = backend.entity(backend.key("boats"))
+    boat.update({"name": name, "owner": "auth0|a", "loads": []})
+    backend.put(boat)
+    return boat
+
+
+def test_entity_cache_serves_repeat_reads(backend):
+    cached = entity_cache.CachedBackend(backend)
+    boat = new_boat(cached)
+    cached.get(boat.key)
+    hits = cached.local.hits
+    assert cached.get(boat.key)["name"] == "Sea Breeze"
+    assert cached.local.hits == hits + 1
+
+
+def test_entity_cache_is_invalidated_by_writes(backend):
+    cached = entity_cache.CachedBackend(backend)
+    boat = new_boat(cached)
+    cached.get(boat.key)
+    boat["name"] = "Renamed"
+    cached.put(boat)
+    assert cached.get(boat.key)["name"] == "Renamed"
+    cached.delete(boat.key)
+    assert cached.get(boat.key) is None
+
+
+def test_entity_cache_is_invalidated_by_transactions(backend):
+    cached = entity_cache.CachedBackend(backend)
+    boat = new_boat(cached)
+    cached.get(boat.key)
+
+    def rename():
+        found = cached.get(boat.key)
+        found["name"] = "Renamed"
+        cached.put(found)
+    cached.run_in_transaction(rename)
+    assert cached.get(boat.key)["name"] == "Renamed"
+
+
+def test_entity_cache_drops_writes_that_roll_back(backend):
+    cached = entity_cache.CachedBackend(backend)
+    boat = new_boat(cached)
+    cached.get(boat.key)
+
+    def rename():
+        found = cached.get(boat.key)
+        found["name"] = "Renamed"
+        cached.put(found)
+        raise RuntimeError("stop")
+    with pytest.raises(RuntimeError):
+        cached.run_in_transaction(rename)
+    assert cached.get(boat.key)["name"] == "Sea Breeze"
+
+
+def test_shared_cache_sees_other_instances_writes_after_the_local_ttl(backend):
+    clock = Clock()
+    shared = entity_cache.DictServer()
+    local_ttl = entity_cache.SHARED_LOCAL_TTL
+    first = entity_cache.CachedBackend(backend, entity_cache.LRUCache(ttl=local_ttl, clock=clock), shared)
+    second = entity_cache.CachedBackend(backend, entity_cache.LRUCache(ttl=local_ttl, clock=clock), shared)
+    boat = new_boat(first)
+    assert second.get(boat.key)["name"] == "Sea Breeze"
+    boat["name"] = "Renamed"
+    first.put(boat)
+    clock.now += local_ttl
+    assert second.get(boat.key)["name"] == "Renamed"
+
+
+def test_local_layer_ttl_is_short_when_a_shared_cache_is_set(backend):
+    cached = entity_cache.CachedBackend(backend, shared=entity_cache.DictServer(), ttl=60)
+    assert cached.local.ttl == entity_cache.SHARED_LOCAL_TTL
@@ -0,0 +1,59 @@
+import functools
+import gzip
+import json
+
+import pytest
+
+import export
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(export, "export_response", functools.partial(export.export_response, batch_size=2))
+
+
+def create_boats(client, headers, owner, count):
+    for index in range(count):
+        response = client.post("/boats", json={"name": "%s %d" % (owner, index), "type": "Yacht", "length": 20},
+                               headers=headers)
+        assert response.status_code == 201
+
+
+def read_lines(response):
+    assert response.mimetype == export.NDJSON_MIMETYPE
+    return [json.loads(line) for line in response.get_data().splitlines()]
+
+
+def test_export_writes_a_cursor_after_every_batch(client, headers, owner, small_batches):
+    create_boats(client, headers, owner, 5)
+    lines = read_lines(client.get("/boats/export", headers=headers))
+    assert [sorted(line) == ["cursor"] for line in lines] == [False, False, True] * 2 + [False, True]
+    assert lines[-1] == {"cursor": None}
+    names = [line["name"] for line in lines if "cursor" not in line]
+    assert sorted(names) == ["%s %d" % (owner, index) for index in range(5)]
+
+
+def test_export_resumes_from_a_cursor(client, headers, owner, small_batches):
+    create_boats(client, headers, owner, 5)
+    lines = read_lines(client.get("/boats/export", headers=headers))
+    cursor = lines[2]["cursor"]
+    resumed = read_lines(client.get("/boats/export?cursor=" + cursor, headers=headers))
+    assert [line for line in resumed if "cursor" not in line] == [line for line in lines[3:] if "cursor" not in line]
+    assert resumed[-1] == {"cursor": None}
+
+
+def test_export_of_nothing_still_ends_with_a_null_cursor(client, headers):
+    assert read_lines(client.get("/boats/export", headers=headers)) == [{"cursor": None}]
+
+
+def test_export_is_gzipped_when_asked(client, headers, owner):
+    create_boats(client, headers, owner, 3)
+    plain = client.get("/boats/export", headers=headers).get_data()
+    response = client.get("/boats/export", headers=dict(headers, **{"Accept-Encoding": "gzip"}))
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.get_data()) == plain
+
+
+def test_bad_cursor_is_turned_away(client, headers):
+    assert client.get("/loads/export?cursor=not-a-cursor", headers=headers).status_code == 400
@@ -0,0 +1,94 @@
+import logging
+import time
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def quick_retries(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_RETRY_DELAY", 0.01)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def boat_with_loads(client, headers, name, count):
+    boat_id = client.post("/boats", json={"name": name, "type": "Yacht", "length": 20},
+                          headers=headers).get_json()["id"]
+    load_ids = []
+    for _ in range(count):
+        load_id = client.post("/loads", json={"volume": 5, "item": "Crate", "creation_date": "1/1/2022"},
+                              headers=headers).get_json()["id"]
+        assert client.put("/boats/%d/loads/%d" % (boat_id, load_id), headers=headers).status_code == 204
+        load_ids.append(load_id)
+    return boat_id, load_ids
+
+
+def test_retry_delay_doubles_up_to_the_maximum():
+    assert [jobs.retry_delay(attempt) for attempt in range(1, 5)] == [jobs.JOB_RETRY_DELAY * 2 ** n
+                                                                      for n in range(4)]
+    assert jobs.retry_delay(100) == jobs.JOB_RETRY_MAX_DELAY
+
+
+def test_async_delete_unassigns_the_loads(client, headers, owner):
+    boat_id, load_ids = boat_with_loads(client, headers, owner, 3)
+    response = client.delete("/boats/%d?async=true" % boat_id, headers=headers)
+    assert response.status_code == 202
+    job_url = "/jobs/%d" % response.get_json()["job"]["id"]
+    wait_for(lambda: client.get(job_url, headers=headers).get_json()["status"] == jobs.DONE)
+    body = client.get(job_url, headers=headers).get_json()
+    assert (body["loads_total"], body["loads_done"]) == (3, 3)
+    assert all(client.get("/loads/%d" % load_id, headers=headers).get_json()["carrier"] is None
+               for load_id in load_ids)
+
+
+def test_load_of_a_deleted_boat_can_be_reassigned_before_the_job_runs(client, headers, owner, monkeypatch):
+    boat_id, load_ids = boat_with_loads(client, headers, owner, 2)
+    queued = []
+    monkeypatch.setattr(jobs, "enqueue", lambda job_id, attempt=0: queued.append(job_id))
+    client.delete("/boats/%d?async=true" % boat_id, headers=headers)
+    monkeypatch.undo()
+    other = client.post("/boats", json={"name": owner + " other", "type": "Yacht", "length": 20},
+                        headers=headers).get_json()["id"]
+    assert client.put("/boats/%d/loads/%d" % (other, load_ids[0]), headers=headers).status_code == 204
+    jobs.enqueue(queued[0])
+    jobs.pending.join()
+    carriers = [client.get("/loads/%d" % load_id, headers=headers).get_json()["carrier"] for load_id in load_ids]
+    assert [carrier and carrier["id"] for carrier in carriers] == [other, None]
+
+
+def test_failed_job_is_tried_again(client, headers, owner, quick_retries, monkeypatch):
+    failures = []
+    run_batch = jobs.run_batch
+
+    def fail_twice(job_key, batch_size):
+        if len(failures) < 2:
+            failures.append(1)
+            raise RuntimeError("backend down")
+        return run_batch(job_key, batch_size)
+    monkeypatch.setattr(jobs, "run_batch", fail_twice)
+    boat_id, _ = boat_with_loads(client, headers, owner, 1)
+    job_url = "/jobs/%d" % client.delete("/boats/%d?async=true" % boat_id, headers=headers).get_json()["job"]["id"]
+    wait_for(lambda: client.get(job_url, headers=headers).get_json()["status"] == jobs.DONE)
+    assert len(failures) == 2
+
+
+def test_job_is_given_up_after_the_last_attempt(quick_retries, monkeypatch, caplog):
+    attempts = []
+
+    def always_fail(job_key, batch_size):
+        attempts.append(1)
+        raise RuntimeError("backend down")
+    monkeypatch.setattr(jobs, "run_batch", always_fail)
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 3)
+    with caplog.at_level(logging.ERROR, logger=jobs.logger.name):
+        jobs.enqueue(2 ** 62)
+        wait_for(lambda: "failed 3 times" in caplog.text)
+        time.sleep(0.05)
+    assert len(attempts) == 3
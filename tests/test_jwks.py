@@ -0,0 +1,115 @@
+import pytest
+
+import jwks
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeJWKS(object):
+    def __init__(self, keys, cache_control="max-age=60"):
+        self.keys = keys
+        self.cache_control = cache_control
+        self.calls = 0
+        self.error = None
+
+    def __call__(self, url):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return {"keys": self.keys}, self.cache_control
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def fetch(signing_key):
+    return FakeJWKS([signing_key[1]])
+
+
+@pytest.fixture
+def store(fetch, clock):
+    return jwks.KeyStore("https://example.test/.well-known/jwks.json", fetch=fetch, clock=clock)
+
+
+def test_parse_cache_control():
+    assert jwks.parse_cache_control('public, max-age=300, stale-if-error="120"') == (300, 120, False)
+    assert jwks.parse_cache_control("no-cache") == (None, None, True)
+    assert jwks.parse_cache_control(None) == (None, None, False)
+
+
+def test_document_is_fetched_once_until_max_age(store, fetch, clock, signing_key):
+    kid = signing_key[1]["kid"]
+    assert store.get_key(kid) is not None
+    clock.now += 59
+    assert store.get_key(kid) is not None
+    assert fetch.calls == 1
+    clock.now += 1
+    assert store.get_key(kid) is not None
+    assert fetch.calls == 2
+
+
+def test_max_age_is_clamped(store, fetch, clock, signing_key):
+    fetch.cache_control = "max-age=1"
+    store.get_key(signing_key[1]["kid"])
+    assert store.expires_at == clock.now + jwks.MIN_TTL
+
+
+def test_unknown_kid_refreshes_at_most_once_per_interval(store, fetch, clock, signing_key):
+    store.get_key(signing_key[1]["kid"])
+    assert store.get_key("rotated") is None
+    assert fetch.calls == 2
+    clock.now += jwks.UNKNOWN_KID_REFRESH_INTERVAL - 1
+    assert store.get_key("rotated") is None
+    assert store.get_key("another") is None
+    assert fetch.calls == 2
+    clock.now += 1
+    assert store.get_key("rotated") is None
+    assert fetch.calls == 3
+
+
+def test_unknown_kid_is_found_after_rotation(store, fetch, signing_key):
+    store.get_key(signing_key[1]["kid"])
+    fetch.keys = [dict(signing_key[1], kid="rotated")]
+    assert store.get_key("rotated") is not None
+
+
+def test_stale_copy_is_served_while_refreshes_fail(store, fetch, clock, signing_key):
+    kid = signing_key[1]["kid"]
+    fetch.cache_control = "max-age=60, stale-if-error=300"
+    store.get_key(kid)
+    fetch.error = IOError("Auth0 is down")
+    clock.now += 61
+    assert store.get_key(kid) is not None
+    assert store.refresh_failures == 1
+    # A failed refresh is not tried again straight away
+    clock.now += jwks.FAILED_REFRESH_RETRY_INTERVAL - 1
+    assert store.get_key(kid) is not None
+    assert fetch.calls == 2
+    clock.now += 1
+    store.get_key(kid)
+    assert fetch.calls == 3
+
+
+def test_stale_copy_runs_out(store, fetch, clock, signing_key):
+    kid = signing_key[1]["kid"]
+    fetch.cache_control = "max-age=60, stale-if-error=300"
+    store.get_key(kid)
+    fetch.error = IOError("Auth0 is down")
+    clock.now += 60 + 300
+    with pytest.raises(jwks.JWKSUnavailable):
+        store.get_key(kid)
+
+
+def test_first_fetch_failing_raises(store, fetch):
+    fetch.error = IOError("Auth0 is down")
+    with pytest.raises(jwks.JWKSUnavailable):
+        store.get_key("any")
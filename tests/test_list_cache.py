@@ -0,0 +1,51 @@
+import list_cache
+
+
+def boat_names(response):
+    return sorted(boat["name"] for boat in response.get_json().get("boats", []))
+
+
+def create_boat(client, headers, name):
+    response = client.post("/boats", json={"name": name, "type": "Yacht", "length": 20}, headers=headers)
+    assert response.status_code == 201
+    return response.get_json()["id"]
+
+
+def test_list_cache_serves_repeat_pages(client, headers, owner):
+    create_boat(client, headers, owner + " one")
+    client.get("/boats", headers=headers)
+    hits = list_cache.cache.hits.get("boats", 0)
+    assert boat_names(client.get("/boats", headers=headers)) == [owner + " one"]
+    assert list_cache.cache.hits.get("boats", 0) == hits + 1
+
+
+def test_list_cache_is_invalidated_by_boat_writes(client, headers, owner):
+    boat_id = create_boat(client, headers, owner + " one")
+    assert boat_names(client.get("/boats", headers=headers)) == [owner + " one"]
+    create_boat(client, headers, owner + " two")
+    assert boat_names(client.get("/boats", headers=headers)) == [owner + " one", owner + " two"]
+    response = client.patch("/boats/%d" % boat_id, json={"name": owner + " three"}, headers=headers)
+    assert response.status_code == 204
+    assert boat_names(client.get("/boats", headers=headers)) == [owner + " three", owner + " two"]
+    assert client.delete("/boats/%d" % boat_id, headers=headers).status_code == 204
+    response = client.get("/boats", headers=headers)
+    assert boat_names(response) == [owner + " two"]
+    assert response.get_json()["total_items"] == 1
+
+
+def test_list_cache_is_invalidated_when_a_load_is_assigned(client, headers, owner):
+    boat_id = create_boat(client, headers, owner)
+    load_id = client.post("/loads", json={"volume": 5, "item": "Crate", "creation_date": "1/1/2022"},
+                          headers=headers).get_json()["id"]
+    assert client.get("/boats/%d/loads" % boat_id, headers=headers).get_json() == {}
+    assert client.put("/boats/%d/loads/%d" % (boat_id, load_id), headers=headers).status_code == 204
+    loads = client.get("/boats/%d/loads" % boat_id, headers=headers).get_json()["loads"]
+    assert [load["id"] for load in loads] == [load_id]
+    loads = client.get("/loads?carrier=%d" % boat_id, headers=headers).get_json()["loads"]
+    assert [load["id"] for load in loads] == [load_id]
+    assert client.get("/boats/%d" % boat_id, headers=headers).get_json()["loads"][0]["id"] == load_id
+
+
+def test_other_owners_pages_are_not_shared(client, headers_for, owner):
+    create_boat(client, headers_for(owner), owner)
+    assert client.get("/boats", headers=headers_for(owner + "-other")).get_json() == {}
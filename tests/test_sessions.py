@@ -0,0 +1,102 @@
+import pytest
+from flask import Flask, session
+
+import sessions
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def session_app():
+    app = Flask(__name__)
+    app.secret_key = "test"
+    app.session_interface = sessions.ServerSessionInterface(sessions.MemoryStore)
+
+    @app.route("/start")
+    def start():
+        session["state"] = "abc"
+        return "ok"
+
+    @app.route("/login")
+    def login():
+        session[sessions.LOGIN_KEY] = {"userinfo": {"sub": "auth0|a"}}
+        return "ok"
+
+    @app.route("/change")
+    def change():
+        session["seen"] = True
+        return "ok"
+
+    @app.route("/whoami")
+    def whoami():
+        return {"user": session.get(sessions.LOGIN_KEY), "state": session.get("state")}
+
+    @app.route("/logout")
+    def logout():
+        session.clear()
+        return "ok"
+    return app
+
+
+def session_id(response):
+    return response.headers["Set-Cookie"].split("=", 1)[1].split(";")[0]
+
+
+def test_requests_without_a_cookie_do_not_touch_the_store(session_app):
+    response = session_app.test_client().get("/whoami")
+    assert "Set-Cookie" not in response.headers
+    assert session_app.session_interface.store_instance is None
+
+
+def test_login_gets_a_new_session_id(session_app):
+    client = session_app.test_client()
+    before = session_id(client.get("/start"))
+    after = session_id(client.get("/login"))
+    assert before != after
+    store = session_app.session_interface.store
+    assert store.load(before) is None
+    assert store.load(after)["state"] == "abc"
+    assert client.get("/whoami").get_json()["user"]["userinfo"]["sub"] == "auth0|a"
+    # A later change keeps the id
+    assert session_id(client.get("/change")) == after
+
+
+def test_the_id_from_before_the_login_is_no_use(session_app):
+    client = session_app.test_client()
+    before = session_id(client.get("/start"))
+    client.get("/login")
+    other = session_app.test_client()
+    other.set_cookie("localhost", "session", before)
+    assert other.get("/whoami").get_json() == {"user": None, "state": None}
+
+
+def test_logout_deletes_the_session(session_app):
+    client = session_app.test_client()
+    sid = session_id(client.get("/login"))
+    client.get("/logout")
+    assert session_app.session_interface.store.load(sid) is None
+
+
+def test_expired_sessions_are_evicted_in_batches():
+    clock = Clock()
+    store = sessions.MemoryStore(clock=clock)
+    for index in range(5):
+        store.save("sid-%d" % index, {}, clock.now + index)
+    assert store.evict(clock.now + 3, 2) == 2
+    assert store.evict(clock.now + 3, 2) == 2
+    assert store.evict(clock.now + 3, 2) == 0
+    assert store.load("sid-4") == {}
+
+
+def test_memory_store_is_bounded():
+    store = sessions.MemoryStore(max_size=2)
+    for index in range(3):
+        store.save("sid-%d" % index, {"index": index}, float("inf"))
+    assert store.load("sid-0") is None
+    assert store.load("sid-2") == {"index": 2}
@@ -0,0 +1,155 @@
+import pytest
+
+import storage
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return storage.MemoryBackend()
+    return storage.SQLiteBackend(str(tmp_path / "marina.db"))
+
+
+def put_boats(backend, count):
+    boats = []
+    for index in range(count):
+        boat = backend.entity(backend.key("boats"))
+        boat.update({"name": "boat-%d" % index, "owner": "auth0|a" if index % 3 else "auth0|b", "loads": []})
+        boats.append(boat)
+    backend.put_multi(boats)
+    return boats
+
+
+def test_cursor_paging_returns_every_entity_once(backend):
+    boats = put_boats(backend, 12)
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        results, cursor = backend.query("boats", limit=5, cursor=cursor)
+        seen.extend(boat.key.id for boat in results)
+        pages += 1
+        if cursor is None:
+            break
+    assert pages == 3
+    assert sorted(seen) == sorted(boat.key.id for boat in boats)
+
+
+def test_cursor_is_none_when_the_last_page_is_exactly_full(backend):
+    put_boats(backend, 10)
+    results, cursor = backend.query("boats", limit=5)
+    results, cursor = backend.query("boats", limit=5, cursor=cursor)
+    assert len(results) == 5
+    assert cursor is None
+
+
+def test_offset_skips_matching_entities(backend):
+    put_boats(backend, 6)
+    everything, _ = backend.query("boats")
+    results, _ = backend.query("boats", limit=2, offset=3)
+    assert [boat.key for boat in results] == [boat.key for boat in everything[3:5]]
+
+
+def test_equality_filters_with_paging(backend):
+    put_boats(backend, 12)
+    seen = []
+    cursor = None
+    while True:
+        results, cursor = backend.query("boats", [("owner", "=", "auth0|b")], limit=2, cursor=cursor)
+        seen.extend(results)
+        if cursor is None:
+            break
+    assert len(seen) == 4
+    assert all(boat["owner"] == "auth0|b" for boat in seen)
+
+
+def test_equality_filters_on_nested_and_missing_values(backend):
+    carried = backend.entity(backend.key("loads"))
+    carried.update({"item": "a", "carrier": {"id": 7, "name": "seven"}})
+    loose = backend.entity(backend.key("loads"))
+    loose.update({"item": "b", "carrier": None})
+    backend.put_multi([carried, loose])
+    results, _ = backend.query("loads", [("carrier.id", "=", 7)])
+    assert [load["item"] for load in results] == ["a"]
+    results, _ = backend.query("loads", [("carrier", "=", None)])
+    assert [load["item"] for load in results] == ["b"]
+
+
+def test_keys_only_and_projection(backend):
+    put_boats(backend, 3)
+    results, _ = backend.query("boats", keys_only=True)
+    assert all(len(boat) == 0 for boat in results)
+    results, _ = backend.query("boats", projection=["owner"])
+    assert all(set(boat) == {"owner"} for boat in results)
+
+
+def test_invalid_cursor(backend):
+    with pytest.raises(storage.InvalidCursor):
+        backend.query("boats", limit=5, cursor="not a cursor")
+
+
+def test_transaction_is_rolled_back_on_error(backend):
+    boat = put_boats(backend, 1)[0]
+
+    def rename():
+        boat["name"] = "renamed"
+        backend.put(boat)
+        raise RuntimeError("stop")
+    with pytest.raises(RuntimeError):
+        backend.run_in_transaction(rename)
+    assert backend.get(boat.key)["name"] == "boat-0"
+
+
+def test_after_commit_runs_only_for_the_attempt_that_commits(backend):
+    ran = []
+    attempts = []
+
+    def work():
+        attempts.append(1)
+        storage.after_commit(lambda: ran.append(len(attempts)))
+        if len(attempts) == 1:
+            raise backend.conflict_errors[0]("lost a race")
+    backend.run_in_transaction(work)
+    assert ran == [2]
+
+
+class FakeIterator(object):
+    def __init__(self, page, next_page_token):
+        self.pages = iter([page])
+        self.next_page_token = next_page_token
+
+
+class FakeQuery(object):
+    def __init__(self, iterator):
+        self.iterator = iterator
+
+    def add_filter(self, name, op, value):
+        pass
+
+    def fetch(self, **kwargs):
+        return self.iterator
+
+
+class FakeClient(object):
+    def __init__(self, iterator):
+        self.iterator = iterator
+
+    def query(self, kind):
+        return FakeQuery(self.iterator)
+
+
+def datastore_backend(page, next_page_token):
+    pytest.importorskip("google.cloud.datastore")
+    return storage.DatastoreBackend(client=FakeClient(FakeIterator(page, next_page_token)))
+
+
+# Datastore can stop at a scan limit and send back fewer results than asked for with more still to come
+def test_datastore_short_batch_keeps_its_cursor():
+    results, cursor = datastore_backend(["one", "two"], b"more").query("boats", limit=5)
+    assert results == ["one", "two"]
+    assert cursor == "more"
+
+
+def test_datastore_cursor_ends_with_the_iterator():
+    results, cursor = datastore_backend(["one"] * 5, None).query("boats", limit=5)
+    assert cursor is None
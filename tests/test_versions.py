@@ -0,0 +1,75 @@
+import pytest
+
+import versions
+
+LOAD = {"volume": 5, "item": "Crate", "creation_date": "1/1/2022"}
+
+
+@pytest.fixture
+def load_id(client, headers):
+    response = client.post("/loads", json=LOAD, headers=headers)
+    assert response.status_code == 201
+    assert response.headers["ETag"] == '"1"'
+    return response.get_json()["id"]
+
+
+def test_get_sends_the_version_as_an_etag(client, headers, load_id):
+    response = client.get("/loads/%d" % load_id, headers=headers)
+    assert response.headers["ETag"] == '"1"'
+    assert "version" not in response.get_json()
+
+
+@pytest.mark.parametrize("tag, status", [('"1"', 304), ('W/"1"', 304), ("*", 304), ('"2"', 200)])
+def test_if_none_match(client, headers, load_id, tag, status):
+    response = client.get("/loads/%d" % load_id, headers=dict(headers, **{"If-None-Match": tag}))
+    assert response.status_code == status
+
+
+def test_if_match_turns_away_an_old_copy(client, headers, load_id):
+    response = client.patch("/loads/%d" % load_id, json={"item": "Barrel"},
+                            headers=dict(headers, **{"If-Match": '"2"'}))
+    assert response.status_code == 412
+    # A weak tag never matches If-Match
+    response = client.patch("/loads/%d" % load_id, json={"item": "Barrel"},
+                            headers=dict(headers, **{"If-Match": 'W/"1"'}))
+    assert response.status_code == 412
+    response = client.patch("/loads/%d" % load_id, json={"item": "Barrel"},
+                            headers=dict(headers, **{"If-Match": '"1"'}))
+    assert response.status_code == 204
+    assert response.headers["ETag"] == '"2"'
+    response = client.get("/loads/%d" % load_id, headers=dict(headers, **{"If-None-Match": '"1"'}))
+    assert response.status_code == 200
+    assert response.get_json()["item"] == "Barrel"
+
+
+def test_retried_create_stays_at_version_one(app, client, headers, monkeypatch):
+    import main
+    run_in_transaction = main.client.run_in_transaction
+    conflicts = []
+
+    def conflict_once(work, *args, **kwargs):
+        def attempt():
+            result = work()
+            if len(conflicts) == 0:
+                conflicts.append(1)
+                raise main.client.conflict_errors[0]("lost a race")
+            return result
+        return run_in_transaction(attempt, *args, **kwargs)
+    monkeypatch.setattr(main.client, "run_in_transaction", conflict_once)
+    response = client.post("/loads", json=LOAD, headers=headers)
+    assert conflicts == [1]
+    assert response.headers["ETag"] == '"1"'
+    key = main.client.key("loads", response.get_json()["id"])
+    assert main.client.get(key)["version"] == 1
+
+
+def test_version_cache_only_moves_forward(app):
+    import main
+    cache = versions.VersionCache()
+    key = main.client.key("loads", 1)
+    cache.remember(key, 2)
+    cache.remember(key, 1)
+    assert cache.get(key) == (2, None)
+    cache.forget(key)
+    cache.remember(key, 3)
+    assert cache.get(key) is None
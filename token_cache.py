@@ -0,0 +1,75 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file keeps a bounded
+# LRU of JWT payloads that have already been verified, so a client that keeps sending the same bearer token
+# does not pay for an RS256 signature check on every request.
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 4096
+
+
+class PayloadCache(object):
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Tokens are never stored as-is, only their digest
+    @staticmethod
+    def key_for(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token):
+        key = self.key_for(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, payload = entry
+            if self.clock() >= expires_at:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(payload)
+
+    # Like get, but left out of the hit and miss counts and of the LRU order, for lookups that only want to
+    # know who a token belongs to
+    def peek(self, token):
+        key = self.key_for(token)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or self.clock() >= entry[0]:
+            return None
+        return dict(entry[1])
+
+    # Payloads without an exp claim are not cached since we would not know when to drop them
+    def put(self, token, payload):
+        expires_at = payload.get("exp")
+        if not isinstance(expires_at, (int, float)) or self.max_size <= 0:
+            return
+        key = self.key_for(token)
+        with self.lock:
+            self.entries[key] = (expires_at, dict(payload))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
@@ -1,33 +1,50 @@
 # Author: Manbir Singh
 # Description: This program represents a rest API that deals with boats and loads. This file deals with
-# API calls to /users.
+# API calls to /users. Users are keyed by their Auth0 subject (the "sub" claim), so the user behind a
+# token can be read with a single key lookup.
 
 from flask import Blueprint, request, make_response
-from google.cloud import datastore
-import json
 from json2html import *
 import constants
+import entity_cache
+import pagination
+import storage
+import responses
 
-client = datastore.Client()
+client = storage.get_backend()
 
 bp = Blueprint('users', __name__, url_prefix='/users')
 
+RECENT_LOGIN_CACHE_SIZE = 4096
+RECENT_LOGIN_TTL = 300
+MIGRATION_BATCH_SIZE = 250
+
+# Subjects that have logged in recently on this instance and are known to have a user entity
+recent_logins = entity_cache.LRUCache(RECENT_LOGIN_CACHE_SIZE, RECENT_LOGIN_TTL)
+
 @bp.route('', methods=['GET'])
 def users_get():
     if request.method == 'GET':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
-        query = client.query(kind=constants.users)
-        list_of_users = (list(query.fetch()))
-        total_number = len(list_of_users)
-        if total_number == 0:
-            return ({},200)
+        try:
+            q_limit, q_offset, q_cursor = pagination.page_args(request.args)
+        except pagination.InvalidPageRequest:
+            return (invalid_page_request(), 400)
+        try:
+            list_of_users, next_cursor = pagination.fetch_page(client, constants.users, [], q_limit, q_offset,
+                                                               q_cursor)
+        except pagination.InvalidPageRequest:
+            return (invalid_page_request(), 400)
+        if len(list_of_users) == 0 and q_cursor is None and q_offset == 0:
+            return responses.json_response({})
         else:
-            for user in list_of_users:
-                user["id"] = user.key.id
-                user["self"] = request.base_url + "/" + str(user["id"])
-            res = make_response(json.dumps(list_of_users))
-            res.status_code = 200
+            prefix = responses.url_prefix()
+            res = responses.json_response([user_body(user, prefix) for user in list_of_users])
+            # The body stays a plain array, so the link to the next page travels in a Link header
+            if next_cursor:
+                res.headers.set('Link', '<' + pagination.next_link(request.base_url, q_limit, next_cursor) +
+                                '>; rel="next"')
             return res
     else:
         return (not_supported_route(), 405)
@@ -37,29 +54,69 @@ def users_get_one(id):
     if request.method == 'GET':
         if 'application/json' not in request.accept_mimetypes:
             return (json_not_accepted_in_request(), 406)
-        user_key = client.key(constants.users, int(id))
+        user_key = client.key(constants.users, id)
         user = client.get(key=user_key)
         if user is None:
             return (missing_user_id(), 404)
-        user["id"] = user.key.id
-        user["self"] = request.base_url
-        return (json.dumps(user), 200)
+        return responses.json_response(user_body(user))
     else:
         return (not_supported_route(), 405)
 
-def missing_attribute_error():
-    error_message_for_missing_attributes = '{"Error" : "The request object is missing at ' \
-                                           'least one of the required attributes"}'
-    return (json.loads(error_message_for_missing_attributes))
+def user_body(user, prefix=None):
+    body = dict(user)
+    body["id"] = user.key.id_or_name
+    body["self"] = responses.link(constants.users, user.key.id_or_name, prefix)
+    return body
+
+
+# Called by the login callback. The user is created with an insert-if-absent transaction on the key
+# for its subject, so two logins racing each other cannot create the same user twice.
+def record_login(userinfo):
+    subject = userinfo["sub"]
+    if recent_logins.get(subject) is not None:
+        return
+    user_key = client.key(constants.users, subject)
+
+    def insert_if_absent():
+        if client.get(key=user_key) is None:
+            new_user = client.entity(user_key)
+            new_user.update({"first_name": userinfo["given_name"], "last_name": userinfo["family_name"],
+                             "email": userinfo["email"], "unique_id": subject})
+            client.put(new_user)
+    client.run_in_transaction(insert_if_absent)
+    recent_logins.set(subject, True)
+
 
-def missing_user_id():
-    error_message_for_missing_id = '{"Error": "No user with this user_id exists"}'
-    return (json.loads(error_message_for_missing_id))
+# One-time job that moves users stored under numeric ids to keys named by their subject. When both
+# exist, the entity already under the subject wins and the old one is removed. The old users are listed
+# before anything is written, since the scan would otherwise run over the keys it is deleting.
+def migrate_user_keys(client):
+    old_users = [user for user in client.iterate(constants.users)
+                 if user.key.id is not None and user.get("unique_id")]
+    moved = 0
+    for start in range(0, len(old_users), MIGRATION_BATCH_SIZE):
+        old_batch = old_users[start:start + MIGRATION_BATCH_SIZE]
+        batch = {}
+        for user in old_batch:
+            batch.setdefault(client.key(constants.users, user["unique_id"]), user)
 
-def not_supported_route():
-    error_message_not_supported_route = '{"Error": "This method is not supported on this URL"}'
-    return (json.loads(error_message_not_supported_route))
+        def migrate_batch():
+            existing = set(entity.key for entity in client.get_multi(list(batch)))
+            new_users = []
+            for new_key, user in batch.items():
+                if new_key not in existing:
+                    new_user = client.entity(new_key)
+                    new_user.update(user)
+                    new_users.append(new_user)
+            client.put_multi(new_users)
+            client.delete_multi([user.key for user in old_batch])
+            return len(new_users)
+        moved += client.run_in_transaction(migrate_batch)
+    return {"migrated": moved, "removed": len(old_users)}
 
-def json_not_accepted_in_request():
-    error_message_json_not_accepted_in_request= '{"Error" : "This MIME type is not supported by this endpoint."}'
-    return (json.loads(error_message_json_not_accepted_in_request))
+# The error responses. Their bodies are encoded once, when the module is loaded.
+missing_attribute_error = responses.missing_attribute_error
+missing_user_id = responses.Error("No user with this user_id exists")
+not_supported_route = responses.not_supported_route
+json_not_accepted_in_request = responses.json_not_accepted_in_request
+invalid_page_request = responses.invalid_page_request
@@ -0,0 +1,111 @@
+# Author: Manbir Singh
+# Description: This program represents a rest API that deals with boats and loads. This file keeps the
+# version number stored on every boat and load. Each write path bumps it, the GET endpoints send it as an
+# ETag and answer If-None-Match with 304, and PUT/PATCH compare it with If-Match so that an editor working
+# from an old copy gets a 412 instead of silently overwriting someone else's change.
+#
+# Versions seen recently are kept in a small in-process cache so a 304 can be sent without reading the
+# entity. Writes made on this instance update the cache once their transaction has committed; writes made
+# on another instance are only picked up once the entry's TTL runs out. Settings:
+#   VERSION_CACHE_SIZE  - entries in the cache (0 turns it off)
+#   VERSION_CACHE_TTL   - seconds an entry may be used
+
+import threading
+from os import environ as env
+
+from flask import Response
+
+import entity_cache
+import storage
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 5
+
+# Cached in place of a version once an entity is deleted, so a slower reader cannot put it back
+DELETED = (None, None)
+
+
+class VersionCache(object):
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.entries = entity_cache.LRUCache(max_size, ttl)
+        self.lock = threading.Lock()
+
+    # Returns (version, owner) or None
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry is DELETED:
+            return None
+        return entry
+
+    # Versions only move forward, so a read that finished after a newer write cannot replace it
+    def remember(self, key, version, owner=None):
+        if self.entries.max_size <= 0 or key is None or key.is_partial:
+            return
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None and (cached is DELETED or cached[0] >= version):
+                return
+            self.entries.set(key, (version, owner))
+
+    def forget(self, key):
+        if self.entries.max_size > 0:
+            with self.lock:
+                self.entries.set(key, DELETED)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+cache = VersionCache(int(env.get("VERSION_CACHE_SIZE", str(DEFAULT_CACHE_SIZE))),
+                     float(env.get("VERSION_CACHE_TTL", str(DEFAULT_CACHE_TTL))))
+
+
+def version_of(entity):
+    return entity.get("version", 0)
+
+
+# Must be called on every boat or load just before it is written, with the entity as read in the same
+# transaction, so that a retried transaction starts again from the stored version
+def bump(entity):
+    set_version(entity, version_of(entity) + 1)
+
+
+# Must be called on a new boat or load just before it is first written. Unlike bump, calling it again when
+# the transaction is retried does not move the version on.
+def created(entity):
+    set_version(entity, 1)
+
+
+# The cache is only told once the write has committed, so it never holds a version that was not stored.
+# A new entity's key may only be completed by the write, so it is read when the callback runs.
+def set_version(entity, version):
+    entity["version"] = version
+    storage.after_commit(lambda: cache.remember(entity.key, version, entity.get("owner")))
+
+
+def deleted(key):
+    cache.forget(key)
+
+
+def etag(version):
+    return str(version)
+
+
+# True when the request's If-Match header allows a write over this version. No header always allows it.
+def if_match_allows(request, version):
+    return not request.if_match or request.if_match.contains(etag(version))
+
+
+# If-None-Match is compared weakly (RFC 7232 section 3.2), so a tag a front end has weakened, as gzip turns
+# "1" into W/"1", still matches. If-Match above stays a strong comparison.
+def not_modified(request, version):
+    return request.if_none_match.contains_weak(etag(version))
+
+
+def tag_response(response, version):
+    response.set_etag(etag(version))
+    return response
+
+
+def not_modified_response(version):
+    return tag_response(Response(status=304), version)